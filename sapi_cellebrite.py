@@ -28,8 +28,13 @@ from __future__ import print_function
 import platform
 import sys
 import xml.etree.ElementTree as ElementTree
+import xml.parsers.expat
 import multiprocessing
 import signal
+import threading
+import concurrent.futures
+import hashlib
+import tempfile
 
 
 # Verifica se está rodando versão correta de Python
@@ -65,6 +70,10 @@ Gicor = 1
 GtempoEntreAtualizacoesStatus = 180  # Tempo normal de produção
 # GtempoEntreAtualizacoesStatus = 10  # Debug: Gerar bastante log
 
+# Verificação de todas as tarefas no storage (*csg)
+Gmaximo_verificacoes_simultaneas = 16  # Total de verificações simultâneas
+Gmaximo_verificacoes_simultaneas_storage = 4  # Verificações simultâneas em um mesmo storage
+
 # ------- Definição de comandos aceitos --------------
 Gmenu_comandos = dict()
 Gmenu_comandos['comandos'] = {
@@ -77,6 +86,7 @@ Gmenu_comandos['comandos'] = {
     '*ab': 'Abortar tarefa que está (ou deveria estar) em andamento',
     '*ri': 'Reiniciar tarefa que foi concluída com sucesso',
     '*cs': 'Comparar (e ajustar) a situação da tarefa indicada no SETEC3 com a situação observada no storage',
+    '*csg': 'Comparar (e ajustar) a situação de todas as tarefas da solicitação com a situação observada no storage',
     '*du': '(Dump) Mostrar todas as propriedades de uma tarefa (utilizado para Debug)',
     '*ex': 'Excluir tarefa',
     '*logt': 'Exibe log da tarefa',
@@ -94,15 +104,16 @@ Gmenu_comandos['comandos'] = {
 
     # Comandos para diagnóstico de problemas
     '*log': 'Exibir log geral desta instância do sapi_cellebrite.',
-    '*db': 'Ligar/desligar modo debug. No modo debug serão geradas mensagens adicionais no log.'
+    '*db': 'Ligar/desligar modo debug. No modo debug serão geradas mensagens adicionais no log.',
+    '*met': 'Exibir métricas (quantidade, erros e tempo de resposta) das chamadas ao servidor SETEC3.'
 
 }
 
 Gmenu_comandos['cmd_exibicao'] = ["*sg", "*sgr"]
 Gmenu_comandos['cmd_navegacao'] = ["+", "-"]
 Gmenu_comandos['cmd_item'] = ["*cr", "*sto", "*cs", "*ab", "*ri","*ex", "*logt"]
-Gmenu_comandos['cmd_geral'] = ["*s3", "*s3g", "*tt", "*qq"]
-Gmenu_comandos['cmd_diagnostico'] = ["*db", "*log"]
+Gmenu_comandos['cmd_geral'] = ["*csg", "*s3", "*s3g", "*tt", "*qq"]
+Gmenu_comandos['cmd_diagnostico'] = ["*db", "*log", "*met"]
 
 # **********************************************************************
 # PRODUCAO DEPLOYMENT AJUSTAR
@@ -139,90 +150,331 @@ def obter_tarefa_item_corrente():
 # avisos: Lista de avisos
 # ----------------------------------------------------------------------
 def processar_arquivo_xml(arquivo, numero_item, explicar=True):
-    # Cria um arquivo temporario para armazenar a versão sintética do arquivo XML
-    arquivo_temporario = tempfile.NamedTemporaryFile(delete=False)
-    caminho_arquivo_temporario = arquivo_temporario.name
-    arquivo_temporario.close()
 
-    # Sintetiza arquivo recebido, armazenando no arquivo temporário
-    sintetizar_arquivo_xml(arquivo, caminho_arquivo_temporario)
+    # Se o arquivo não foi alterado desde a última validação,
+    # reaproveita o resultado armazenado no índice (apenas um stat no arquivo)
+    indice = carregar_indice_xml(arquivo)
+    if indice is not None and indice.get('versao_extrator', None) == Gversao_extrator_xml:
+        debug("Arquivo XML", arquivo, "não foi alterado. Utilizando resultado armazenado no índice")
+        (resultado, dados_relevantes, erros, avisos) = indice['resultado']
+        for mensagem in erros:
+            if_print(explicar, mensagem)
+        for mensagem in avisos:
+            if_print(explicar, "- AVISO: ", mensagem)
+        return (resultado, dados_relevantes, erros, avisos)
+
+    # Efetua a validação do arquivo.
+    # Se existir índice (gerado por outra versão do extrator), vai direto nas seções relevantes
+    return validar_arquivo_xml(arquivo, numero_item, explicar, indice)
+
+
+# Seções modelType que contém informações úteis para o laudo
+# <modelType type="UserAccount">    # Contas de usuário
+# <modelType type="SIMData">        # Dados do simCard, incluindo MSISDN
+Glista_model_type_relevantes = ['UserAccount', 'SIMData']
+
+# Índice do arquivo XML
+# Gravado em uma pasta local (Gpasta_indice_xml), fora da pasta da extração, pois esta é o material
+# que será copiado para o storage (o índice não pode ser incluído na cópia, nem alterar tamanho e quantidade
+# de arquivos). O nome do arquivo de índice é derivado do caminho, tamanho e data de modificação do XML.
+# Contém:
+# - tamanho e data de modificação do XML no momento da validação
+# - posição (bytes) de cada seção relevante no XML
+# - resultado da validação (dados para laudo, erros e avisos)
+# Incrementar a versão do extrator sempre que mudar a forma de compor o resultado da validação,
+# para que os índices já existentes sejam refeitos
+Gpasta_indice_xml = os.path.join(tempfile.gettempdir(), "sapi_indice_xml")
+# Sufixo do índice gravado ao lado do XML por versões anteriores (é excluído quando encontrado)
+Gsufixo_indice_xml = ".sapi_indice"
+Gversao_extrator_xml = 2
+
+
+# Retorna o nome do tag sem o namespace
+# Exemplo: {http://pa.cellebrite.com/report/2.0}project => project
+def _tag_sem_namespace(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+# O expat (com separador de namespace) retorna nomes no formato
+# http://pa.cellebrite.com/report/2.0}project
+# Ajusta para o formato do ElementTree: {http://pa.cellebrite.com/report/2.0}project
+def _nome_expat_para_elementtree(nome):
+    if '}' in nome:
+        return '{' + nome
+    return nome
+
+
+# Dependendo do caso, o arquivo XML é muito grande (20GB ou mais)
+# Nesta situação, o parse completo fica muito lento e em alguns casos acaba a memória.
+# Logo, percorre o arquivo uma única vez, mantendo em memória apenas as partes relevantes:
+#  - <extractionInfo ...>
+#  - <metadata section="..."> filhos diretos de <project> (Extraction Data, Device Info, Additional Fields)
+#  - <modelType type="UserAccount"> e <modelType type="SIMData">
+# Todos os demais elementos são descartados sem serem montados.
+# Utiliza o expat diretamente (e não o iterparse), pois o expat informa a posição (byte) de cada elemento,
+# que é armazenada no índice do arquivo.
+# O CurrentByteIndex do expat é um long do C, que no Windows tem 32 bits (trunca acima de 2 GiB).
+# Logo, a posição real é recomposta a partir da quantidade de bytes entregues ao parser (ver posicao_corrente).
+# Retorna tupla:
+#   1) Elemento <project> sintético, contendo apenas as seções relevantes como filhos diretos
+#   2) Índice com a raiz e a posição (inicio, fim) de cada seção relevante
+def extrair_secoes_relevantes_xml(arquivo):
+
+    raiz = None
+    secoes = list()
+    posicoes = list()
+
+    # Controle do parse
+    profundidade = 0
+    construtor = None
+    profundidade_secao = 0
+    inicio_secao = 0
+    aguardando_fim_secao = False
+
+    parser = xml.parsers.expat.ParserCreate(namespace_separator='}')
+    parser.buffer_text = True
+
+    # Quantidade de bytes entregues ao parser antes do bloco corrente
+    entregues = 0
+
+    # Posição (byte) do evento corrente no arquivo
+    # O evento está a menos de 2 GiB dos bytes já entregues (no bloco corrente, ou em trecho
+    # ainda pendente do bloco anterior), logo basta o deslocamento truncado em 32 bits
+    def posicao_corrente():
+        deslocamento = (parser.CurrentByteIndex - entregues + 2 ** 31) % 2 ** 32 - 2 ** 31
+        return entregues + deslocamento
+
+    # O fim de uma seção é a posição do próximo evento após o seu encerramento
+    def registrar_fim_secao():
+        nonlocal aguardando_fim_secao
+        posicoes.append([inicio_secao, posicao_corrente()])
+        aguardando_fim_secao = False
+
+    def inicio_elemento(nome, atributos):
+        nonlocal raiz, profundidade, construtor, profundidade_secao, inicio_secao
+
+        if aguardando_fim_secao:
+            registrar_fim_secao()
+
+        tag = _nome_expat_para_elementtree(nome)
+        if raiz is None:
+            atributos = {_nome_expat_para_elementtree(k): v for (k, v) in atributos.items()}
+            raiz = ElementTree.Element(tag, atributos)
+        elif construtor is None:
+            nome_local = _tag_sem_namespace(tag)
+            if nome_local == 'extractionInfo' \
+                    or (nome_local == 'metadata' and profundidade == 1) \
+                    or (nome_local == 'modelType' and atributos.get('type', None) in Glista_model_type_relevantes):
+                # Início de seção relevante
+                construtor = ElementTree.TreeBuilder()
+                profundidade_secao = profundidade
+                inicio_secao = posicao_corrente()
+                parser.CharacterDataHandler = construtor.data
+
+        if construtor is not None:
+            atributos = {_nome_expat_para_elementtree(k): v for (k, v) in atributos.items()}
+            construtor.start(tag, atributos)
+
+        profundidade += 1
+
+    def fim_elemento(nome):
+        nonlocal profundidade, construtor, aguardando_fim_secao
+
+        if aguardando_fim_secao:
+            registrar_fim_secao()
+
+        profundidade -= 1
+        if construtor is None:
+            return
 
-    # Efetua a validação do arquivo temporário
-    (resultado, dados_relevantes, erros, avisos) = validar_arquivo_xml(caminho_arquivo_temporario, numero_item,
-                                                                       explicar)
+        elem = construtor.end(_nome_expat_para_elementtree(nome))
+        if profundidade == profundidade_secao:
+            # Seção completa
+            secoes.append(elem)
+            construtor = None
+            parser.CharacterDataHandler = None
+            aguardando_fim_secao = True
 
-    # Elimina arquivo temporário, pois não é mais necessário
-    os.unlink(caminho_arquivo_temporario)
+    parser.StartElementHandler = inicio_elemento
+    parser.EndElementHandler = fim_elemento
 
-    # Retorna resultado
-    return (resultado, dados_relevantes, erros, avisos)
+    # Tamanho e data de modificação antes da leitura, para compor o índice
+    estatistica = os.stat(arquivo)
 
+    with open(arquivo, 'rb') as f:
+        while True:
+            bloco = f.read(1024 * 1024)
+            if not bloco:
+                break
+            parser.Parse(bloco, False)
+            entregues += len(bloco)
+        parser.Parse(b'', True)
 
-# Dependendo do caso, o arquivo XML é muito grande
-# Nesta situação, o parse completo fica muito lento e em alguns casos acaba a memória.
-# Logo, extrai apenas as partes relevantes do arquivo
-def sintetizar_arquivo_xml(arquivo, caminho_arquivo_temporario):
-    # Criar arquivo de saída e copia inicio do arquivo XML
-    # -----------------------------------------------------
-    with codecs.open(caminho_arquivo_temporario, 'w+b', encoding='utf-8') as ftemp:
-        with codecs.open(arquivo, "r", "utf-8") as fentrada:
-            for linha in fentrada:
-                # Interrompe a cópia quando encontrar um dos elementos da lista abaixo
-                irrelevantes = ["<images", "<taggedFiles", "<decodedData", "<carvedFiles", "<infectedFiles"]
-                encontrou = False
-                for termo in irrelevantes:
-                    if termo in linha: encontrou = True
-
-                if encontrou:
-                    ftemp.write("")
-                    break
-
-                # Grava linha na saída
-                ftemp.write(linha)
-
-    # Extrai as linhas de bloco de modelType relevantes
-    # -------------------------------------------------
-    # <modelType type="SIMData">
-    # ...
-    # </modelType>
-
-    # Lista de seções modelType que contém informações úteis
-    # <modelType type="UserAccount">    # Contas de usuário
-    # <modelType type="SIMData">        # Dados do simCard, incluindo MSISDN
-    lista_model_type = ['<modelType type="UserAccount">', '<modelType type="SIMData">']
-
-    with codecs.open(caminho_arquivo_temporario, 'a+b', encoding='utf-8') as ftemp:
-        with codecs.open(arquivo, "r", "utf-8") as fentrada:
-            iniciado = False
-            for linha in fentrada:
-
-                if not iniciado:
-                    for mt in lista_model_type:
-                        if mt in linha:
-                            iniciado = True
-
-                if iniciado:
-                    # Grava linha linha
-                    ftemp.write(linha)
-
-                if iniciado and '</modelType>' in linha:
-                    ftemp.write("")
-                    iniciado = False
-
-    # Encerra XML
-    with codecs.open(caminho_arquivo_temporario, 'a+b', encoding='utf-8') as ftemp:
-        ftemp.write("</project>")
-
-    debug("Arquivo XML sintetizado gravado em ", caminho_arquivo_temporario)
+    if aguardando_fim_secao:
+        posicoes.append([inicio_secao, estatistica.st_size])
 
-    return
+    if raiz is None:
+        return (None, None)
+
+    # Monta raiz sintética, contendo apenas as seções relevantes
+    raiz.extend(secoes)
+
+    indice = dict()
+    indice['tamanho'] = estatistica.st_size
+    indice['data_modificacao'] = estatistica.st_mtime
+    indice['raiz'] = {'tag': raiz.tag, 'atributos': dict(raiz.attrib)}
+    indice['secoes'] = posicoes
+
+    debug("XML", arquivo, "processado em passada única. Seções relevantes: ", len(secoes))
+
+    return (raiz, indice)
+
+
+# Recupera as seções relevantes do XML diretamente pelas posições armazenadas no índice,
+# sem percorrer o arquivo
+# Retorna o elemento <project> sintético (da mesma forma que extrair_secoes_relevantes_xml)
+# Se não for possível, retorna None
+def carregar_secoes_indexadas_xml(arquivo, indice):
+
+    try:
+        tag_raiz = indice['raiz']['tag']
+        raiz = ElementTree.Element(tag_raiz, indice['raiz']['atributos'])
+
+        # As seções são lidas isoladamente, logo precisam ser envolvidas
+        # por um elemento que declare o namespace da raiz
+        envelope_inicio = b'<project>'
+        if tag_raiz.startswith('{'):
+            namespace = tag_raiz[1:].split('}', 1)[0]
+            envelope_inicio = ('<project xmlns="' + namespace + '">').encode('utf-8')
+
+        # Confere as posições antes de utilizá-las
+        # (índice gerado por versão com posições truncadas, por exemplo)
+        validar_posicoes_indice_xml(indice)
+
+        with open(arquivo, 'rb') as f:
+            for (inicio, fim) in indice['secoes']:
+                f.seek(inicio)
+                trecho = f.read(fim - inicio)
+                # Cada trecho deve conter exatamente um elemento
+                if not trecho.startswith(b'<') or not trecho.rstrip().endswith(b'>'):
+                    raise Exception("Trecho " + str(inicio) + "-" + str(fim) + " não corresponde a um elemento")
+                envelope = ElementTree.fromstring(envelope_inicio + trecho + b'</project>')
+                if len(envelope) != 1:
+                    raise Exception("Trecho " + str(inicio) + "-" + str(fim) + " contém " + str(len(envelope)) +
+                                    " elementos")
+                raiz.extend(list(envelope))
+
+    except BaseException as e:
+        print_log("Não foi possível utilizar as posições do índice do arquivo", arquivo, ":", str(e))
+        return None
+
+    debug("XML", arquivo, "seções relevantes recuperadas pelo índice: ", len(indice['secoes']))
+
+    return raiz
+
+
+# Confere as posições das seções armazenadas no índice
+# As seções devem estar dentro do arquivo, em ordem crescente e sem sobreposição
+# Se alguma posição for inválida, gera exceção (e o índice deve ser refeito)
+def validar_posicoes_indice_xml(indice):
+    anterior = 0
+    for (inicio, fim) in indice['secoes']:
+        if not (anterior <= inicio < fim <= indice['tamanho']):
+            raise Exception("Posição de seção inválida no índice: " + str(inicio) + "-" + str(fim))
+        anterior = fim
+
+
+# Caminho do arquivo de índice do XML (na pasta local de índices)
+def _caminho_indice_xml(arquivo):
+    estatistica = os.stat(arquivo)
+    chave = "|".join([os.path.normcase(os.path.abspath(arquivo)),
+                      str(estatistica.st_size),
+                      str(int(estatistica.st_mtime))])
+    return os.path.join(Gpasta_indice_xml, hashlib.sha1(chave.encode('utf-8')).hexdigest() + ".json")
+
+
+# Exclui o índice gravado ao lado do XML por versões anteriores, que faria parte da cópia
+def _excluir_indice_xml_legado(arquivo):
+    caminho_legado = arquivo + Gsufixo_indice_xml
+    if not os.path.isfile(caminho_legado):
+        return
+    try:
+        os.remove(caminho_legado)
+        print_log("Excluído índice de XML de versão anterior:", caminho_legado)
+    except OSError as e:
+        print_log("Exclusão de índice de XML de versão anterior", caminho_legado, "falhou, erro: ", str(e))
+
+
+# Carrega índice do arquivo XML
+# Se o índice não existir, for inválido ou se o arquivo XML foi alterado após a geração do índice,
+# retorna None
+def carregar_indice_xml(arquivo):
+
+    _excluir_indice_xml_legado(arquivo)
+
+    try:
+        caminho_indice = _caminho_indice_xml(arquivo)
+        if not os.path.isfile(caminho_indice):
+            return None
+        with open(caminho_indice, "r") as arq:
+            indice = json.load(arq)
+        estatistica = os.stat(arquivo)
+    except BaseException as e:
+        print_log("Leitura de índice do arquivo XML", arquivo, "falhou, erro: ", str(e))
+        return None
+
+    # Confere se o XML continua o mesmo
+    # A data de modificação é comparada com tolerância,
+    # pois alguns sistemas de arquivo (e cópias) não preservam frações de segundo
+    if indice.get('tamanho', None) != estatistica.st_size:
+        return None
+    if abs(indice.get('data_modificacao', 0) - estatistica.st_mtime) > 2:
+        return None
+
+    return indice
+
+
+# Grava índice do arquivo XML, juntamente com o resultado da validação
+# Se não conseguir gravar, apenas registra em log
+def gravar_indice_xml(arquivo, indice, resultado):
+
+    if indice is None:
+        return False
+
+    indice['versao_extrator'] = Gversao_extrator_xml
+    indice['resultado'] = resultado
+
+    caminho_indice = None
+    try:
+        os.makedirs(Gpasta_indice_xml, exist_ok=True)
+        caminho_indice = _caminho_indice_xml(arquivo)
+        with open(caminho_indice, "w") as arq:
+            json.dump(indice, arq)
+    except BaseException as e:
+        debug("Gravação de índice do arquivo XML", caminho_indice, "falhou, erro: ", str(e))
+        return False
+
+    debug("Gravado índice do arquivo XML em", caminho_indice)
+    return True
 
 
 # Validar arquivo XML do cellebrite
+# Se for fornecido índice, recupera as seções relevantes diretamente pelas posições armazenadas
 # ----------------------------------------------------------------------
-def validar_arquivo_xml(caminho_arquivo, numero_item, explicar=True):
+def validar_arquivo_xml(caminho_arquivo, numero_item, explicar=True, indice=None):
     try:
-        return _validar_arquivo_xml(caminho_arquivo, numero_item, explicar)
+        root = None
+        if indice is not None:
+            root = carregar_secoes_indexadas_xml(caminho_arquivo, indice)
+        if root is None:
+            (root, indice) = extrair_secoes_relevantes_xml(caminho_arquivo)
+
+        resultado = _validar_arquivo_xml(root, numero_item, explicar)
+
+        # Guarda resultado, para que uma próxima validação do mesmo arquivo seja imediata
+        gravar_indice_xml(caminho_arquivo, indice, resultado)
+
+        return resultado
     except BaseException as e:
         trc_string=traceback.format_exc()
         erro=texto("[310]: Erro inesperado validação de arquivo XML. Assegure-se que o arquivo selecionado foi gerado corretamente pelo Cellebrite: ",
@@ -231,10 +483,10 @@ def validar_arquivo_xml(caminho_arquivo, numero_item, explicar=True):
         return (False, {}, [erro], [])
 
 
-
 # Validar arquivo XML do cellebrite
+# Recebe a raiz (sintética) com as seções relevantes do XML, gerada por extrair_secoes_relevantes_xml
 # ----------------------------------------------------------------------
-def _validar_arquivo_xml(caminho_arquivo, numero_item, explicar=True):
+def _validar_arquivo_xml(root, numero_item, explicar=True):
     # Dados para retorno
     # ------------------------------------------------------------------
     dados = {}
@@ -253,10 +505,12 @@ def _validar_arquivo_xml(caminho_arquivo, numero_item, explicar=True):
     # dicionários para montagem de dados para laudo
     d_aquis_geral = {}  # Dados gerais da aquisição
 
-    # Abre arquivo XML sintetico e faz parse
-    # ------------------------------------------------------------------
-    tree = ElementTree.parse(caminho_arquivo)
-    root = tree.getroot()
+    if root is None:
+        mensagem = "XML sem conteúdo"
+        erros += [mensagem]
+        if_print(explicar, mensagem)
+        return (False, dados, erros, avisos)
+
 
     # ------------------------------------------------------------------
     # Valida cabeçalho do XML
@@ -973,6 +1227,11 @@ def pode_abortar(tarefa):
         print_log("Encontrado processo da tarefa a ser abortada em execução")
         return True
 
+    # Aguardando na fila de cópias
+    if nome_processo in obter_copias_agendadas():
+        print_log("Tarefa a ser abortada está aguardando na fila de cópias")
+        return True
+
     # ------------------------------------------------------------------------------------------------------------------
     # O status foi atualizado recentemente
     # ------------------------------------------------------------------------------------------------------------------
@@ -1070,6 +1329,9 @@ def _abortar_tarefa():
 
     print_log("Abortando tarefa ",codigo_tarefa, " por solicitação do usuário (*AB)")
 
+    # Retira da fila de cópias, se ainda não foi iniciada
+    cancelar_copia_agendada("executar:" + str(codigo_tarefa))
+
     # Mata qualquer processo relacionado com esta tarefa
     for ix in sorted(Gpfilhos):
 
@@ -1215,8 +1477,8 @@ def exibir_log_tarefa(filtro_usuario):
     print()
     print("- Exibir log da tarefa", codigo_tarefa)
 
-    filtro_base=":"+codigo_tarefa+"]"
-    exibir_log(comando='*logt',filtro_base=filtro_base, filtro_usuario=filtro_usuario, limpar_tela=False)
+    # Utiliza o índice do log para ler apenas os registros da tarefa
+    exibir_log(comando='*logt', filtro_usuario=filtro_usuario, limpar_tela=False, codigo_tarefa=codigo_tarefa)
 
     return
 
@@ -2247,7 +2509,13 @@ def copiar_pasta(tarefa, codigo_tarefa, dados_relevantes, caminho_origem, caminh
             print("- Pasta de destino JÁ EXISTE")
             print("- Procedimento de cópia irá tornar a pasta de destino idêntica à pasta de origem")
             print("- Isto significa que arquivos da pasta de destino poderão ser excluídos, caso estes não estejam na pasta de origem (sincronização)")
-        if metodo_copia==2: # Copia tradicional (python/Windows)
+        if metodo_copia==2 and os.path.isfile(montar_caminho(caminho_destino, Gnome_arquivo_diario_copia)):
+            # Cópia anterior (python/Windows) foi interrompida
+            print("- Pasta de destino JÁ EXISTE e contém o diário de uma cópia anterior que foi interrompida")
+            print("- A cópia será retomada: Os arquivos já copiados (e inalterados na origem) serão aproveitados,")
+            print("  e os arquivos copiados parcialmente serão continuados")
+            print_log("Cópia anterior interrompida será retomada: ", caminho_destino)
+        elif metodo_copia==2: # Copia tradicional (python/Windows)
             print()
             print("- IMPORTANTE: A pasta de destino JÁ EXISTE:", caminho_destino)
             print()
@@ -2272,6 +2540,17 @@ def copiar_pasta(tarefa, codigo_tarefa, dados_relevantes, caminho_origem, caminh
             limpar_pasta_destino_antes_copiar = True
 
 
+    # Cópias aguardando na fila: Permite priorizar esta cópia
+    prioridade = 0
+    copias_agendadas = obter_copias_agendadas()
+    if len(copias_agendadas) > 0:
+        print()
+        print("- Existem", len(copias_agendadas), "cópias aguardando na fila de cópias.")
+        print("- Por padrão, as cópias menores são iniciadas primeiro.")
+        if pergunta_sim_nao("< Dar prioridade a esta cópia (será iniciada antes das demais)?", default="n"):
+            prioridade = 1
+        print()
+
     #print_atencao()
     print("- Confira se a pasta de destino no storage (exibida acima) está bem formada,")
     print("  ou seja, se o memorando e o item estão ok,")
@@ -2319,34 +2598,43 @@ def copiar_pasta(tarefa, codigo_tarefa, dados_relevantes, caminho_origem, caminh
     #print("caminho_destino=", caminho_destino)
     #die('ponto2415')
 
-    # Inicia processo filho para execução da cópia
+    # Coloca na fila de cópias o processo filho para execução da cópia
+    # A fila limita as cópias simultâneas por dispositivo de origem e storage de destino
     # ------------------------------------------------------------------------------------------------------------------
     label_processo = "executar:" + str(codigo_tarefa)
     dados_pai_para_filho=obter_dados_para_processo_filho()
-    p_executar = multiprocessing.Process(
-        target=background_executar_copia,
-        args=(tarefa,
-              codigo_tarefa,
-              caminho_origem,
-              caminho_destino,
-              dados_relevantes,
-              limpar_pasta_destino_antes_copiar,
-              nome_arquivo_log_para_processos_filhos,
-              label_processo,
-              dados_pai_para_filho,
-              metodo_copia,
-              label_metodo_copia,
-              log_copia
-              )
+    a_frente = agendar_copia(
+        label_processo,
+        background_executar_copia,
+        (tarefa,
+         codigo_tarefa,
+         caminho_origem,
+         caminho_destino,
+         dados_relevantes,
+         limpar_pasta_destino_antes_copiar,
+         nome_arquivo_log_para_processos_filhos,
+         label_processo,
+         dados_pai_para_filho,
+         metodo_copia,
+         label_metodo_copia,
+         log_copia
+         ),
+        caminho_origem,
+        caminho_destino,
+        chave_destino=tarefa["dados_storage"]["maquina_netbios"],
+        prioridade=prioridade
     )
-    p_executar.start()
-
-    registra_processo_filho(label_processo, p_executar)
 
     # Tudo certo, agora é só aguardar
     print()
-    print("- Ok, procedimento de cópia foi iniciado em background.")
-    print("- Você pode continuar trabalhando, inclusive efetuar outras cópias simultaneamente.")
+    if a_frente == 0:
+        print("- Ok, procedimento de cópia foi iniciado em background.")
+    else:
+        print("- Ok, procedimento de cópia foi colocado na fila de cópias (", a_frente, "cópias à frente).")
+        print("- A cópia será iniciada automaticamente em background, assim que houver vaga para a origem e o storage.")
+        sapisrv_atualizar_status_tarefa_informativo(
+            codigo_tarefa, texto("Aguardando na fila de cópias do sapi_cellebrite (", a_frente, "cópias à frente)"))
+    print("- Você pode continuar trabalhando, inclusive efetuar outras cópias (que serão coordenadas pela fila de cópias).")
     print("- Para acompanhar a situação da cópia, utilize o comando *SG (Situação Geral), ou então *SGR (Situação Geral Repetitiva)")
     print("- Também é possível acompanhar a situação através do SETEC3 (*s3)")
     print("- Em caso de problema/dúvida, utilize *LG para visualizar o log")
@@ -2477,7 +2765,8 @@ def background_executar_copia(tarefa,
                               dados_pai_para_filho,
                               metodo_copia,
                               label_metodo_copia,
-                              log_copia
+                              log_copia,
+                              limite_banda=None
                               ):
 
     # Impede interrupção por sigint
@@ -2571,12 +2860,29 @@ def background_executar_copia(tarefa,
         if metodo_copia==1:
             # Cópia via Robocopy
             caminho_log_robocopy = "sapi_log_robocopy_tarefa_" + str(codigo_tarefa) + ".txt"
-            (sucesso, resultado_copia) = copiar_pasta_via_robocopy(caminho_origem, caminho_destino, caminho_log_robocopy)
+            # O limite de banda do robocopy é definido no início da cópia, e não é reajustado depois
+            # Com limite, o robocopy copia em fluxo único (sem /MT)
+            limite_robocopy = None
+            if limite_banda is not None and limite_banda.value > 0:
+                limite_robocopy = limite_banda.value
+            (sucesso, resultado_copia) = copiar_pasta_via_robocopy(caminho_origem, caminho_destino, caminho_log_robocopy,
+                                                                   limite_robocopy)
         elif metodo_copia==2:
-            # Cópia tradicional
-            shutil.copytree(caminho_origem, caminho_destino)
+            # Cópia via python (paralela), com cálculo de hash durante a cópia
+            # O manifesto de hash é gravado na pasta de destino
+            # Cópia retomável: Se for interrompida, um novo comando de cópia continua de onde parou
+            resumo_copia = copiar_pasta_paralelo(
+                caminho_origem, caminho_destino,
+                progresso=lambda situacao: atualizar_status_progresso_copia(codigo_tarefa, situacao),
+                algoritmo_hash='sha256',
+                retomavel=True,
+                limite_banda=limite_banda)
             resultado_copia="Cópia efetuada por python/windows"
-            sucesso=True # Supostamente se falhar irá gerar exception
+            if resumo_copia["arquivos_aproveitados"] > 0 or resumo_copia["bytes_aproveitados"] > 0:
+                resultado_copia = texto(resultado_copia, "(retomada, aproveitando",
+                                        converte_bytes_humano(resumo_copia["bytes_aproveitados"]),
+                                        "da cópia anterior)")
+            sucesso=True # Se falhar irá gerar exception
         else:
             raise Exception("Opção de cópia com valor inválido" + str(metodo_copia))
 
@@ -2598,56 +2904,65 @@ def background_executar_copia(tarefa,
 
         # 7) Confere se cópia foi efetuada com sucesso
         # ------------------------------------------------------------------
-        # Compara tamanho total e quantidade de arquivos
-        sapisrv_atualizar_status_tarefa_informativo(codigo_tarefa, "Conferindo cópia (tamanho e quantidade de arquivos)")
-
-        carac_destino = obter_caracteristicas_pasta(caminho_destino)
+        if metodo_copia==2:
+            # O hash de cada arquivo foi calculado durante a cópia,
+            # de modo que a conferência lê apenas a pasta de destino
+            sapisrv_atualizar_status_tarefa_informativo(codigo_tarefa, "Conferindo hash da cópia")
+            res_hash = conferir_pasta_manifesto_hash(caminho_destino, resumo_copia["manifesto"])
+            carac_destino = {"tamanho_total": resumo_copia["bytes_copiados"],
+                             "quantidade_arquivos": res_hash["manifesto"]["quantidade_arquivos"]}
+            sapisrv_atualizar_status_tarefa_informativo(
+                codigo_tarefa, texto("Hash da cópia confere (sha256). Hash raiz:", res_hash["raiz"]))
+        else:
+            # Compara tamanho total e quantidade de arquivos
+            sapisrv_atualizar_status_tarefa_informativo(codigo_tarefa, "Conferindo cópia (tamanho e quantidade de arquivos)")
 
+            carac_destino = obter_caracteristicas_pasta(caminho_destino)
 
-        # Simula uma divergência
-        #print_log("Simulando divergência entre origem e destino")
-        #carac_destino["tamanho_total"] = carac_destino["tamanho_total"] + 4096
-        #carac_destino["quantidade_arquivos"] = carac_destino["quantidade_arquivos"] + 1
-        # rrrr
 
-        # Guarda detalhes no log
-        print_log("Comparando características da pasta de origem com pasta de destino")
-        print_log("Origem: ", var_dump_string(carac_origem))
-        print_log("Destino: ", var_dump_string(carac_destino))
+            # Simula uma divergência
+            #print_log("Simulando divergência entre origem e destino")
+            #carac_destino["tamanho_total"] = carac_destino["tamanho_total"] + 4096
+            #carac_destino["quantidade_arquivos"] = carac_destino["quantidade_arquivos"] + 1
+            # rrrr
 
-        # Efetuar comparação de características
-        if carac_origem["tamanho_total"]==carac_destino["tamanho_total"]:
-            print_log("Tamanho total confere")
-        else:
-            msg_exception=texto("Divergência entre tamanho total de origem (",
-                                carac_origem["tamanho_total"],
-                                ") e destino (",
-                                carac_destino["tamanho_total"],
-                                ")")
-            # O dir /s, quando chamado de dentro do sapi_cellbrite,
-            # acusa tamanho de 4.096 para uma pasta que tem zero arquivos...como se apenas a existência
-            # da pasta já utilizasse este espaço
-            # Mas para a pasta local, não faz isto
-            # Provavelmente é para a rede não está mapeado (não tem a letra)
-            # enquanto para a pasta local está
-            print_log(msg_exception)
-            print_log("Aviso: Houve divergência de tamanho, mas isto não é confiável, pois estamos utilizando dir /s")
-            print_log("Se for este problema já conhecido, a diferença será multiplo de 4.096 (pois são pastas sem arquivos)")
-            # Desativeir o erro, pois este procedimento não está confiável
-            #raise Exception(msg_exception)
-
-        if carac_origem["quantidade_arquivos"]==carac_destino["quantidade_arquivos"]:
-            print_log("Quantidade de arquivos confere")
-        else:
-            msg_exception = texto("Divergência de quantidade de arquivos entre origem (",
-                                  carac_origem["quantidade_arquivos"],
-                                  ") e destino (",
-                                  carac_destino["quantidade_arquivos"],
-                                  ")")
-            raise Exception(msg_exception)
+            # Guarda detalhes no log
+            print_log("Comparando características da pasta de origem com pasta de destino")
+            print_log("Origem: ", var_dump_string(carac_origem))
+            print_log("Destino: ", var_dump_string(carac_destino))
 
-        sapisrv_atualizar_status_tarefa_informativo(codigo_tarefa, "Tamanho total e quantidade de arquivos compatíveis")
+            # Efetuar comparação de características
+            if carac_origem["tamanho_total"]==carac_destino["tamanho_total"]:
+                print_log("Tamanho total confere")
+            else:
+                msg_exception=texto("Divergência entre tamanho total de origem (",
+                                    carac_origem["tamanho_total"],
+                                    ") e destino (",
+                                    carac_destino["tamanho_total"],
+                                    ")")
+                # O dir /s, quando chamado de dentro do sapi_cellbrite,
+                # acusa tamanho de 4.096 para uma pasta que tem zero arquivos...como se apenas a existência
+                # da pasta já utilizasse este espaço
+                # Mas para a pasta local, não faz isto
+                # Provavelmente é para a rede não está mapeado (não tem a letra)
+                # enquanto para a pasta local está
+                print_log(msg_exception)
+                print_log("Aviso: Houve divergência de tamanho, mas isto não é confiável, pois estamos utilizando dir /s")
+                print_log("Se for este problema já conhecido, a diferença será multiplo de 4.096 (pois são pastas sem arquivos)")
+                # Desativeir o erro, pois este procedimento não está confiável
+                #raise Exception(msg_exception)
+
+            if carac_origem["quantidade_arquivos"]==carac_destino["quantidade_arquivos"]:
+                print_log("Quantidade de arquivos confere")
+            else:
+                msg_exception = texto("Divergência de quantidade de arquivos entre origem (",
+                                      carac_origem["quantidade_arquivos"],
+                                      ") e destino (",
+                                      carac_destino["quantidade_arquivos"],
+                                      ")")
+                raise Exception(msg_exception)
 
+            sapisrv_atualizar_status_tarefa_informativo(codigo_tarefa, "Tamanho total e quantidade de arquivos compatíveis")
 
 
         # Se chegou aqui, sucesso
@@ -2672,6 +2987,8 @@ def background_executar_copia(tarefa,
         print_tela_log(erro)
         print_log(trc_string)
         print("- Consulte log para mais informações")
+        if metodo_copia==2:
+            print("- Ao repetir o comando de cópia, a cópia será retomada do ponto em que parou")
         print("- Caso o problema persista, experimente:")
         print("  - Excluir primeiramente a tarefa (*EX) para limpar a pasta de destino, caso exista.")
         print("  - Copiar a pasta de origem para outra máquina, e executar novamente em outra máquina.")
@@ -2697,6 +3014,8 @@ def background_executar_copia(tarefa,
             # Prossegue por gravidade, pois está em background e irá encerrar logo em seguida
 
         # Encerra
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(0)
 
     # -----------------------------------------------------------------------------------------------------------------
@@ -2718,6 +3037,8 @@ def background_executar_copia(tarefa,
         print_tela_log("- Esta tarefa ficará em estado inconsistente, pois para o sistema ainda está em execução")
         print("- Após sanar o problema, utilize comando *cs para atualizar situação da tarefa")
         print_falha_comunicacao()
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(0)
 
     # Tudo certo
@@ -2725,9 +3046,23 @@ def background_executar_copia(tarefa,
     print("- Cópia de relatório para tarefa", codigo_tarefa, "foi concluída com SUCESSO")
     print("- Utilize comando *SG para conferir a situação atual da tarefa")
     print_log("Fim da cópia em background para tarefa", codigo_tarefa)
+    publicar_metricas_sapisrv()
+    log_descarregar()
     os._exit(0)
 
 
+# Atualiza o status da tarefa com o andamento da cópia via python (ver copiar_pasta_paralelo)
+def atualizar_status_progresso_copia(codigo_tarefa, situacao):
+    percentual = 100
+    if situacao["tamanho_total"] > 0:
+        percentual = situacao["bytes_copiados"] * 100 // situacao["tamanho_total"]
+    texto_status = texto("Copiados", converte_bytes_humano(situacao["bytes_copiados"]),
+                         "de", converte_bytes_humano(situacao["tamanho_total"]),
+                         "(" + str(percentual) + "%) -",
+                         situacao["arquivos_copiados"], "de", situacao["quantidade_arquivos"], "arquivos")
+    sapisrv_atualizar_status_tarefa_informativo(codigo_tarefa, texto_status)
+
+
 # Acompanhamento de copia em background
 def background_acompanhar_copia(codigo_tarefa,
                                 caminho_origem,
@@ -2776,8 +3111,13 @@ def background_acompanhar_copia(codigo_tarefa,
                    trc_string)
         print_tela_log(erro)
 
+    # Envia status pendentes (os._exit não executa atexit)
+    sapisrv_descarregar_fila_status()
+
     # Encerra normalmente
     print_log("Processo de acompanhamento de cópia finalizado")
+    publicar_metricas_sapisrv()
+    log_descarregar()
     os._exit(0)
 
 
@@ -2794,9 +3134,10 @@ def _background_acompanhar_copia_tradicional(codigo_tarefa,
 
 
 # Acompanhamento de cópia efetuada via robocopy
-# Monitora o arquivo de log e efetua calculo aproxima de progresso,
-# Um acompanhamento preciso da evolução da cópia é difícil,
-# uma vez que o robocopy pré-aloca o espaço nos arquivos de destino
+# Monitora o arquivo de log (de forma incremental) e calcula o progresso com base no tamanho (bytes)
+# dos arquivos que já constam no log.
+# O robocopy pré-aloca o espaço nos arquivos de destino, de modo que o tamanho da pasta de destino
+# não serve para acompanhar a evolução da cópia
 def _background_acompanhar_copia_robocopy(codigo_tarefa,
                                           caminho_origem,
                                           caminho_destino,
@@ -2814,6 +3155,10 @@ def _background_acompanhar_copia_robocopy(codigo_tarefa,
         # Se não tem conteúdo, encerrra....Não deveria acontecer nunca
         raise Exception("[2027] Falha na obtençao do tamanho da pasta de origem")
 
+    # Pasta vazia, não tem o que acompanhar
+    if tam_pasta_origem == 0:
+        return
+
     # Aguarda até ter sido criada a pasta de destino
     while True:
         if not os.path.exists(caminho_destino):
@@ -2825,7 +3170,9 @@ def _background_acompanhar_copia_robocopy(codigo_tarefa,
     # Fica em loop enquanto tarefa estiver em situação EmAndamento
     primeira=True
     tempo_pausa = 30
-    quantidade_arquivos_processados_anterior = 0
+    bytes_processados_anterior = 0
+    # Estado da análise incremental do log (posição de leitura e contadores)
+    estado_log = dict()
     while True:
 
         # Intervalo entre atualizações de status
@@ -2840,71 +3187,60 @@ def _background_acompanhar_copia_robocopy(codigo_tarefa,
             codigo_situacao_tarefa = int(tarefa['codigo_situacao_tarefa'])
             if codigo_situacao_tarefa != GEmAndamento:
                 print_log("Interrompendo acompanhamento, pois situação da tarefa",codigo_tarefa,"foi modificada para",codigo_situacao_tarefa)
+                # O status de progresso ainda na fila deste processo ficou obsoleto,
+                # e não pode ser enviado depois da nova situação
+                sapisrv_descartar_status_tarefa_fila(codigo_tarefa)
                 return
 
-        # Analisa o log e determina a quantidade total de arquivos processados
-        res=acompanhar_log_copia_robocopy(log_copia)
+        # Analisa as novas linhas do log e atualiza os totais processados
+        res=acompanhar_log_copia_robocopy(log_copia, estado_log)
         if not res["sucesso"]:
             print_log("Analise do arquivo de log falhou: ", res.get("explicacao","") )
             continue
 
-        # Estima quantidade de arquivos para o qual já foi iniciado a cópia
-        quantidade_arquivos_processados = res.get("quantidade_arquivos_processados",0)
-        # Despreza os registros de exclusão de arquivos (/mir)
-        quantidade_arquivos_excluidos = res.get("quantidade_arquivos_excluidos",0)
-        if quantidade_arquivos_excluidos >0:
-            quantidade_arquivos_processados -= quantidade_arquivos_excluidos
+        quantidade_arquivos_processados = res["quantidade_arquivos_processados"]
+        bytes_processados = res["bytes_processados"]
         if quantidade_arquivos_processados==0:
-            print_log("Arquivo de log do robocopy ainda não contém nenhum arquivo processado.")
             # É comum que o robocopy demore um pouco para escrever os primeiros registros no arquivo de log
-            # Enquanto não tem dados no log, vamos ler direto da pasta da destino
-            # Isto aqui também demora....também não funciona
-            #print_log("Obtendo caracteristiscas da pasta de destino")
-            #carac_destino = obter_caracteristicas_pasta_ok(caminho_destino)
-            #if carac_destino is None:
-            #    # Se falhar, ignora e tenta mais tarde
-            #    print_log("Leitura de característica da pasta de destino falhou")
-            #    continue
-            #quantidade_arquivos_processados = carac_destino.get("quantidade_arquivos", 0)
-            #print_log("Arquivos na pasta de destino = ", quantidade_arquivos_processados)
-
-            # Mecanismo anti-ansiedades....serve para dar um número, indicando que a cópia foi iniciada
-            # apenas para usuário não ficar ansioso
-            # Calculando quantidade de arquivos copiados...não é a quantidade real
-            taxa_dummy_bytes_segundo = 5*1024*1024 #5MB/s
-            tempo_decorrido = time.time() - start_time
-            tamanho_total_copiado_estimado = tempo_decorrido * taxa_dummy_bytes_segundo
-            tamanho_medio_arquivo = tam_pasta_origem / quantidade_arquivos_pasta_origem
-            quantidade_arquivos_copiados_estimados = int(tamanho_total_copiado_estimado / tamanho_medio_arquivo)
-
-            # Fictício => Anti-ansiedade
-            quantidade_arquivos_processados = quantidade_arquivos_copiados_estimados
-            print_log("progresso estimado")
-
-        # Se não houve progresso, ou em função de método conflituosos (direto da pasta x log)
-        # houve um decréscimo no número de arquivo processados, ignora a atualização
-        if quantidade_arquivos_processados < quantidade_arquivos_processados_anterior:
+            print_log("Arquivo de log do robocopy ainda não contém nenhum arquivo processado.")
             continue
 
-        # A medição de arquivos processados é bastante imprecisa
-        # Logo, se a quantidade de arquivos processados igualar ou superar a quantidade de arquivos
-        # na pasta de origem, é melhor abandonar o acompanhamento para evitar confusão
-        if quantidade_arquivos_processados >= quantidade_arquivos_pasta_origem:
+        # Se não houve progresso, não atualiza
+        if bytes_processados <= bytes_processados_anterior:
+            continue
+
+        # Se tudo já foi processado, a cópia está sendo finalizada
+        # O processo principal irá atualizar a situação da tarefa (o status de progresso pendente ficou obsoleto)
+        if bytes_processados >= tam_pasta_origem:
+            sapisrv_descartar_status_tarefa_fila(codigo_tarefa)
             return
 
         # Calcula o percentual de avanço
-        percentual = (quantidade_arquivos_processados / quantidade_arquivos_pasta_origem) * 100
+        percentual = (bytes_processados / tam_pasta_origem) * 100
         percentual = round(percentual,1)
-        #if percentual==0:
-        #    # Despreza, se o percentual é muito baixo
-        #    continue
         percentual_texto="("+str(percentual)+"%)"
-        texto_status = texto("Arquivos copiados:", quantidade_arquivos_processados, percentual_texto)
+
+        # Taxa de cópia, considerando apenas os arquivos efetivamente copiados
+        # (arquivos que já estavam no destino são apenas conferidos pelo robocopy)
+        tempo_decorrido = time.time() - start_time
+        taxa_texto = ""
+        if tempo_decorrido > 0 and res["bytes_copiados"] > 0:
+            taxa_bytes_segundo = res["bytes_copiados"] / tempo_decorrido
+            taxa_texto = texto("Taxa:", converte_bytes_humano(taxa_bytes_segundo) + "/s")
+            # Tempo restante estimado
+            tempo_restante = (tam_pasta_origem - bytes_processados) / taxa_bytes_segundo
+            taxa_texto = texto(taxa_texto, "Término em", converte_segundos_humano(int(tempo_restante)))
+
+        texto_status = texto("Copiados:", converte_bytes_humano(bytes_processados),
+                             "de", converte_bytes_humano(tam_pasta_origem), percentual_texto,
+                             "em", quantidade_arquivos_processados, "arquivos.",
+                             taxa_texto)
 
         # Atualiza status
         print_log(texto_status)
-        sapisrv_atualizar_status_tarefa_informativo(codigo_tarefa, texto_status)
-        quantidade_arquivos_processados_anterior = quantidade_arquivos_processados
+        # Status vai para a fila, enviada em lote (não bloqueia o acompanhamento)
+        sapisrv_atualizar_status_tarefa_fila(codigo_tarefa, texto_status)
+        bytes_processados_anterior = bytes_processados
 
         # Depois que fez primeira atualização, diminui a frequencia
         tempo_pausa = GtempoEntreAtualizacoesStatus
@@ -2926,7 +3262,7 @@ def comparar_sistema_com_storage():
 #   2) texto_situacao: Texto complementar da situação
 #   3) dados_relevantes: Dados relevantes, para utilização em laudo
 # ----------------------------------------------------------------------
-def determinar_situacao_no_storage(tarefa):
+def determinar_situacao_no_storage(tarefa, ponto_montagem=None, explicar=True):
     # Constantes de codigo_situacao
     erro_interno = -1
     erros = list()
@@ -2940,7 +3276,9 @@ def determinar_situacao_no_storage(tarefa):
     # Montagem de storage
     # -------------------
     # Confirma que tem acesso ao storage escolhido
-    ponto_montagem=conectar_storage_consulta_ok(dados_storage=tarefa["dados_storage"])
+    # (se o chamador ainda não efetuou a conexão)
+    if ponto_montagem is None:
+        ponto_montagem=conectar_storage_consulta_ok(dados_storage=tarefa["dados_storage"])
     if ponto_montagem is None:
         # Mensagens de erro já foram apresentadas pela função acima
         return (erro_interno, status, {}, erros, avisos)
@@ -2950,14 +3288,14 @@ def determinar_situacao_no_storage(tarefa):
     # Verifica se pasta de destino existe
     # -----------------------------------
     caminho_destino = os.path.join(ponto_montagem, tarefa["caminho_destino"])
-    print("- Pasta de destino: ", caminho_destino)
+    if_print(explicar, "- Pasta de destino: ", caminho_destino)
 
     if not os.path.exists(caminho_destino):
         status = "Não iniciado (sem pasta)"
-        print("- Pasta de destino ainda não foi criada.")
+        if_print(explicar, "- Pasta de destino ainda não foi criada.")
         return (GSemPastaNaoIniciado, status, {}, erros, avisos)  # Não iniciado
 
-    print("- Pasta de destino existente.")
+    if_print(explicar, "- Pasta de destino existente.")
 
     # Procura arquivo XML
     # --------------------------------------------------------------------
@@ -2965,7 +3303,7 @@ def determinar_situacao_no_storage(tarefa):
     arquivo_xml = ""
     for file in os.listdir(caminho_destino):
         if file.endswith(".xml"):
-            print("- Localizado arquivo XML: ",os.path.join(caminho_destino, file))
+            if_print(explicar, "- Localizado arquivo XML: ",os.path.join(caminho_destino, file))
             arquivo_xml = file
             qtd_arquivo_xml=qtd_arquivo_xml+1
 
@@ -2979,31 +3317,32 @@ def determinar_situacao_no_storage(tarefa):
     if msg_erro != "":
         status = msg_erro
         codigo_status = GAbortou
-        print("-",status)
+        if_print(explicar, "-",status)
         return (codigo_status, status, {}, erros, avisos)
 
     # Ok, já tem todos os arquivos básicos
     status = "Pasta contém todos os arquivos básicos."
-    print("-",status)
+    if_print(explicar, "-",status)
 
     # Valida arquivo xml
     caminho_arquivo_xml = os.path.join(caminho_destino, arquivo_xml)
-    print("- Validando XML. Isto pode demorar, dependendo do tamanho do arquivo. Aguarde...")
+    if_print(explicar, "- Validando XML. Isto pode demorar, dependendo do tamanho do arquivo. Aguarde...")
     (resultado, dados_relevantes, erros, avisos) = processar_arquivo_xml(
         arquivo=caminho_arquivo_xml,
         numero_item=item["item"],
-        explicar=True
+        explicar=explicar
     )
     if (not resultado):
         status = "Arquivo XML inconsistente"
         codigo_status = GAbortou
-        print("-",status)
+        if_print(explicar, "-",status)
         return (codigo_status, status, {}, erros, avisos)
 
     # Exibe o resultado dos dados coletados para laudo
-    print("- XML válido.")
-    print("- Os seguintes dados foram selecionados do XML armazenado armazenado no Storage e serão utilizados em laudo:")
-    exibir_dados_laudo(dados_relevantes['laudo'])
+    if_print(explicar, "- XML válido.")
+    if_print(explicar, "- Os seguintes dados foram selecionados do XML armazenado armazenado no Storage e serão utilizados em laudo:")
+    if explicar:
+        exibir_dados_laudo(dados_relevantes['laudo'])
 
     # No storage aparentemente está tudo ok
     status = "Relatório Cellebrite armazenado com sucesso"
@@ -3011,6 +3350,40 @@ def determinar_situacao_no_storage(tarefa):
     return (codigo_status, status, dados_relevantes, erros, avisos)
 
 
+# Compara situação do SETEC3 com situação observada no storage
+# Retorna tupla:
+#   1) ajustar: True se a situação do SETEC3 deve ser atualizada com a situação observada no storage
+#   2) Lista de mensagens explicativas
+# ----------------------------------------------------------------------
+def comparar_situacao_setec3_storage(codigo_situacao_setec3, codigo_situacao_storage):
+
+    coerente = "Situação observada na pasta de destino está coerente com a situação do servidor."
+
+    # Se a situação é mesma, está tudo certo
+    if (codigo_situacao_storage == codigo_situacao_setec3):
+        return (False, [coerente])
+
+    # Se no storage está em andamento (tem alguns arquivos)
+    # e no servidor está abortada, tudo bem, faz sentido
+    if (    (codigo_situacao_storage == GEmAndamento)
+        and (codigo_situacao_setec3 == GAbortou)):
+        return (False, [coerente, "Tarefa foi abortada sem ser concluída."])
+
+    # Se no storage está em andamento (tem alguns arquivos)
+    # e no servidor está aguardando PCF, talvez tenha sido reinicida, tudo bem, faz sentido
+    if (    (codigo_situacao_storage == GEmAndamento)
+        and (codigo_situacao_setec3 == GAguardandoPCF)):
+        return (False, [coerente, "Possivelmente tarefa foi reiniciada."])
+
+    # Se a situação no storage é menor que no setec3, tem alguma inconsistência...ou falha na verificação
+    if (codigo_situacao_storage < codigo_situacao_setec3):
+        return (False, ["Situação observada é divergente da situação reportada pelo servidor.",
+                        "Reporte esta situação ao desenvolvedor (ponto2184)."])
+
+    # Divergência que pode ser ajustada
+    return (True, ["A situação da tarefa no SETEC3 não está coerente com a situação observada na pasta de destino do storage."])
+
+
 def _comparar_sistema_com_storage():
 
     print()
@@ -3054,37 +3427,11 @@ def _comparar_sistema_com_storage():
 
     # Compara situação do SETEC3 com situação do storage
     # --------------------------------------------------
-
-    # Se a situação é mesma, está tudo certo
-    # --------------------------------------
-    if (codigo_situacao_storage == codigo_situacao_setec3):
+    (ajustar, mensagens) = comparar_situacao_setec3_storage(codigo_situacao_setec3, codigo_situacao_storage)
+    if not ajustar:
         print()
-        print("- Situação observada na pasta de destino está coerente com a situação do servidor.")
-        return
-
-    # Se no storage está em andamento (tem alguns arquivos)
-    # e no servidor está abortada, tudo bem, faz sentido
-    if (    (codigo_situacao_storage == GEmAndamento)
-        and (codigo_situacao_setec3 == GAbortou)):
-        print()
-        print("- Situação observada na pasta de destino está coerente com a situação do servidor.")
-        print("- Tarefa foi abortada sem ser concluída.")
-        return
-
-    # Se no storage está em andamento (tem alguns arquivos)
-    # e no servidor está aguardando PCF, talvez tenha sido reinicida, tudo bem, faz sentido
-    if (    (codigo_situacao_storage == GEmAndamento)
-        and (codigo_situacao_setec3 == GAguardandoPCF)):
-        print()
-        print("- Situação observada na pasta de destino está coerente com a situação do servidor.")
-        print("- Possivelmente tarefa foi reiniciada.")
-        return
-
-    # Se a situação no storage é menor que no setec3, tem alguma inconsistência...ou falha na verificação
-    if (codigo_situacao_storage < codigo_situacao_setec3):
-        print()
-        print("- Situação observada é divergente da situação reportada pelo servidor.")
-        print("- Reporte esta situação ao desenvolvedor (ponto2184).")
+        for mensagem in mensagens:
+            print("-", mensagem)
         return
 
     # Se houver divergência entre situação atual e situação no servidor
@@ -3122,6 +3469,170 @@ def _comparar_sistema_com_storage():
     return
 
 
+# @*csg - Compara situação (servidor x storage) de todas as tarefas da solicitação
+# As tarefas são verificadas em paralelo, limitando a quantidade de verificações simultâneas em cada storage
+# ----------------------------------------------------------------------------------------------------------------------
+def comparar_sistema_com_storage_todas():
+    console_executar_tratar_ctrc(funcao=_comparar_sistema_com_storage_todas)
+
+
+# Determina a situação de uma tarefa no storage (executado em thread)
+# O semáforo limita a quantidade de verificações simultâneas em um mesmo storage
+def _determinar_situacao_no_storage_thread(tarefa, ponto_montagem, semaforo_storage):
+    with semaforo_storage:
+        try:
+            return determinar_situacao_no_storage(tarefa, ponto_montagem=ponto_montagem, explicar=False)
+        except BaseException as e:
+            print_log("Verificação da tarefa", tarefa['codigo_tarefa'], "no storage falhou: ", str(e))
+            return (-1, "Falha na verificação: " + str(e), {}, [str(e)], [])
+
+
+def _comparar_sistema_com_storage_todas():
+
+    print()
+    print("- Comparar situação de todas as tarefas, verificando compatibilidade entre Setec3 com dados no Storage")
+
+    # Label para diferenciar mensagens de log
+    definir_label_log('*csg')
+
+    # Recupera lista atualizada de tarefas
+    # -----------------------------------------------------------------------------------------------------------------
+    if not refresh_tarefas():
+        return False
+
+    codigos_tarefas = [dado["tarefa"]["codigo_tarefa"] for dado in Gtarefas]
+    if len(codigos_tarefas) == 0:
+        print("- Não existe nenhuma tarefa de extração para este exame")
+        return False
+
+    print("- Recuperando dados atualizados de", len(codigos_tarefas), "tarefas no SETEC3: Aguarde...")
+    tarefas = sapisrv_gather([executar_async(recupera_tarefa_do_setec3, codigo_tarefa)
+                              for codigo_tarefa in codigos_tarefas])
+
+    # Seleciona as tarefas que podem ser verificadas
+    # e efetua a conexão (uma única vez) com cada storage envolvido
+    # -----------------------------------------------------------------------------------------------------------------
+    pontos_montagem = dict()
+    semaforos = dict()
+    verificar = list()
+    ignoradas = dict()
+    for (codigo_tarefa, tarefa) in zip(codigos_tarefas, tarefas):
+        if tarefa is None:
+            ignoradas[codigo_tarefa] = "Não foi possível recuperar dados do SETEC3"
+            continue
+        if int(tarefa["codigo_situacao_tarefa"]) == GEmAndamento:
+            ignoradas[codigo_tarefa] = "Em execução. Para comparar, aborte a tarefa (*AB)"
+            continue
+        dados_storage = tarefa['dados_storage']
+        if dados_storage is None:
+            ignoradas[codigo_tarefa] = "Tarefa não possui storage definido"
+            continue
+
+        storage_id = dados_storage.get('storage_id', dados_storage.get('maquina_netbios', ""))
+        if storage_id not in pontos_montagem:
+            pontos_montagem[storage_id] = conectar_storage_consulta_ok(dados_storage=dados_storage)
+            semaforos[storage_id] = threading.BoundedSemaphore(Gmaximo_verificacoes_simultaneas_storage)
+        if pontos_montagem[storage_id] is None:
+            ignoradas[codigo_tarefa] = "Sem acesso ao storage " + storage_id
+            continue
+
+        verificar.append((tarefa, storage_id))
+
+    # Verifica as tarefas em paralelo
+    # -----------------------------------------------------------------------------------------------------------------
+    resultados = dict()
+    if len(verificar) > 0:
+        print("- Verificando", len(verificar), "tarefas no storage. Isto pode demorar, dependendo do tamanho dos arquivos. Aguarde...")
+        quantidade_threads = min(len(verificar), Gmaximo_verificacoes_simultaneas)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=quantidade_threads) as executor:
+            futuros = dict()
+            for (tarefa, storage_id) in verificar:
+                futuro = executor.submit(_determinar_situacao_no_storage_thread,
+                                         tarefa,
+                                         pontos_montagem[storage_id],
+                                         semaforos[storage_id])
+                futuros[futuro] = tarefa
+            for futuro in concurrent.futures.as_completed(futuros):
+                tarefa = futuros[futuro]
+                resultados[tarefa['codigo_tarefa']] = futuro.result()
+                print("- Verificada tarefa", tarefa['codigo_tarefa'], "(", len(resultados), "de", len(verificar), ")")
+
+    # Relatório consolidado
+    # -----------------------------------------------------------------------------------------------------------------
+    print()
+    print_centralizado(" Comparação SETEC3 x Storage ")
+    string_formatacao = '%6s %-35.35s %-40.40s %-s'
+    print(string_formatacao % ("tarefa", "Situação no SETEC3", "Situação observada no storage", "Conclusão"))
+    print_centralizado()
+
+    ajustar = list()
+    for (codigo_tarefa, tarefa) in zip(codigos_tarefas, tarefas):
+        if codigo_tarefa in ignoradas:
+            situacao_setec3 = ""
+            if tarefa is not None:
+                situacao_setec3 = texto(tarefa["codigo_situacao_tarefa"], "-", tarefa['descricao_situacao_tarefa'])
+            print(string_formatacao % (codigo_tarefa, situacao_setec3, "", "Ignorada: " + ignoradas[codigo_tarefa]))
+            continue
+
+        (codigo_situacao_storage, texto_status, dados_relevantes, erros, avisos) = resultados[codigo_tarefa]
+        situacao_setec3 = texto(tarefa["codigo_situacao_tarefa"], "-", tarefa['descricao_situacao_tarefa'])
+        situacao_storage = texto(codigo_situacao_storage, "-", texto_status)
+
+        if codigo_situacao_storage == -1:
+            conclusao = "Não foi possível determinar a situação no storage"
+        else:
+            (ajustar_tarefa, mensagens) = comparar_situacao_setec3_storage(int(tarefa["codigo_situacao_tarefa"]),
+                                                                           codigo_situacao_storage)
+            conclusao = " ".join(mensagens)
+            if ajustar_tarefa:
+                conclusao = "Divergente: SETEC3 pode ser atualizado"
+                ajustar.append((tarefa, codigo_situacao_storage, dados_relevantes))
+
+        print(string_formatacao % (codigo_tarefa, situacao_setec3, situacao_storage, conclusao))
+        for mensagem in erros:
+            print("       * ERRO:", mensagem)
+
+    print_centralizado()
+
+    if len(ajustar) == 0:
+        print("- Nenhuma tarefa necessita de ajuste de situação no SETEC3")
+        return
+
+    # Transições de situação
+    # -----------------------------------------------------------------------------------------------------------------
+    print()
+    print_atencao()
+    print('- A situação de', len(ajustar), 'tarefa(s) no SETEC3 não está coerente com a situação observada no storage.')
+    print('- Isto pode ocorrer caso tenha havido alguma falha no procedimento')
+    print('  de atualização da situação após a cópia no sapi_cellebrite.')
+    print()
+    print('- Caso você tenha certeza que os dados armazenados no servidor estão ok,')
+    print('  basta efetuar a atualização do situação (respondendo S na próxima pergunta)')
+    print('- Em caso de dúvida, refaça a cópia da tarefa (comando *CR)')
+    print()
+    atualizar = pergunta_sim_nao("< Atualizar SETEC3 com a situação observada no storage para estas tarefas? ", default="n")
+    if (not atualizar):
+        return
+
+    for (tarefa, codigo_situacao_storage, dados_relevantes) in ajustar:
+        print("- Atualizando tarefa", tarefa['codigo_tarefa'])
+        if not troca_situacao_tarefa_ok(codigo_tarefa=tarefa['codigo_tarefa'],
+                                        codigo_nova_situacao=codigo_situacao_storage,
+                                        texto_status="Dados confirmados no storage (PCF comando *CSG)",
+                                        dados_relevantes=dados_relevantes
+                                        ):
+            # Se falhar, encerra. Mensagens já foram dadas na função chamada
+            return
+
+    # Tudo certo
+    # ----------
+    print()
+    print("- Tarefas atualizadas com sucesso no servidor")
+    exibir_situacao_apos_comando()
+
+    return
+
+
 def refresh_exibir_situacao():
     refresh_tarefas()
     exibir_situacao()
@@ -3260,7 +3771,7 @@ def exibir_situacao(comando=''):
 # ----------------------------------------------------------------------------------------------------------------------
 # Exibe conteúdo do arquivo de log
 # ----------------------------------------------------------------------------------------------------------------------
-def exibir_log(comando, filtro_base="", filtro_usuario="", limpar_tela=True):
+def exibir_log(comando, filtro_base="", filtro_usuario="", limpar_tela=True, codigo_tarefa=None):
 
     # Filtros
     filtro_base     =filtro_base.strip()
@@ -3279,41 +3790,7 @@ def exibir_log(comando, filtro_base="", filtro_usuario="", limpar_tela=True):
        print("Contendo termo: ", filtro_usuario)
        print_centralizado()
 
-    arquivo_log = obter_nome_arquivo_log()
-
-    # Não tem arquivo de log
-    if (not os.path.isfile(arquivo_log)):
-        print("*** Arquivo de log vazio ***")
-        return
-
-    with codecs.open(arquivo_log, 'r', "utf-8") as sapi_log:
-        qtd=0
-        for linha in sapi_log:
-            exibir=True
-            if filtro_base!="" and filtro_base.lower() not in linha.lower():
-                exibir=False
-            if filtro_usuario!="" and filtro_usuario.lower() not in linha.lower():
-                exibir=False
-
-            # Sanitiza para utf8 na console
-            # ignora os ajustes efetuados
-            (linha, ajustes)=console_sanitiza_utf8(linha)
-
-            if exibir:
-                qtd=qtd+1
-                print(format(qtd, '03d'),":", linha.strip())
-
-    sapi_log.close()
-
-    if qtd==0:
-        print("*** Nenhuma mensagem de log disponível ***")
-        return
-
-
-    if filtro_usuario=="":
-        print()
-        print("- Dica: Para filtrar o log, forneça um string após comando.")
-        print("  Exemplo: ",comando," erro => Lista apenas linhas que contém o termo 'erro'")
+    exibir_conteudo_log(comando, filtro_base=filtro_base, filtro_usuario=filtro_usuario, codigo_tarefa=codigo_tarefa)
 
     return
 
@@ -3572,6 +4049,10 @@ def finalizar_programa():
             dummy, codigo_tarefa = ix.split(':')
             print("- Tarefa",codigo_tarefa, "ainda não foi concluída (está rodando em background - ",ix,Gpfilhos[ix].pid,")")
             qtd_ativos += 1
+    for ix in obter_copias_agendadas():
+        dummy, codigo_tarefa = ix.split(':')
+        print("- Tarefa",codigo_tarefa, "ainda não foi iniciada (está aguardando na fila de cópias)")
+        qtd_ativos += 1
 
     # Se não tem nenhum programa em background
     # pode finalizar imediatamente
@@ -3594,6 +4075,11 @@ def finalizar_programa():
     print_log("Usuário foi avisado que existem processos rodando, e respondeu que desejava encerrar mesmo assim")
     print("- Finalizando processos e ajustando situação de tarefas. Aguarde...")
     lista_tarefa_abortar = []
+    # Cópias que aguardam na fila não serão mais iniciadas
+    for ix in obter_copias_agendadas():
+        if cancelar_copia_agendada(ix):
+            dummy, codigo_tarefa = ix.split(':')
+            lista_tarefa_abortar.append(codigo_tarefa)
     for ix in sorted(Gpfilhos):
         if Gpfilhos[ix].is_alive():
             # Finaliza processo
@@ -3671,13 +4157,34 @@ def exibir_situacao_repetir():
         return
 
 
-def acompanhar_log_copia_robocopy(caminho_log_robocopy):
+# Linha de arquivo do log do robocopy (/v /bytes): classe <tab> tamanho <tab> caminho
+Gregex_linha_arquivo_robocopy = re.compile(r'^\s*(?P<classe>[^\t]*?)\s*\t+\s*(?P<tamanho>\d+)\s*\t(?P<caminho>.+)$')
+# Classes de arquivo que já estão íntegros no destino (não são copiados)
+Glista_classes_robocopy_sem_copia = ['mesmo', 'same']
+# Contadores mantidos no estado do acompanhamento do log
+Glista_contadores_log_robocopy = ["quantidade_arquivos_processados", "quantidade_arquivos_excluidos",
+                                  "bytes_processados", "bytes_copiados"]
+
+
+# Analisa o arquivo de log do robocopy (executado com /v /bytes), determinando o progresso da cópia
+# A análise é incremental: Se for passado um dicionário de estado (inicialmente vazio),
+# a posição de leitura e os contadores são mantidos nele, e cada chamada processa apenas as linhas novas do log
+# Retorna dicionário com:
+#  - sucesso: True/False
+#  - explicacao: Motivo da falha
+#  - quantidade_arquivos_processados: Arquivos que constam no log (copiados ou já existentes no destino)
+#  - quantidade_arquivos_excluidos: Arquivos extras na pasta de destino (excluídos em função do /mir)
+#  - bytes_processados: Soma do tamanho dos arquivos processados
+#  - bytes_copiados: Soma do tamanho dos arquivos efetivamente copiados (exclui os que já estavam no destino)
+def acompanhar_log_copia_robocopy(caminho_log_robocopy, estado=None):
 
     # Dicionário de resultado
     res = dict()
     res["sucesso"]=False
     res["quantidade_arquivos_processados"]=0
     res["quantidade_arquivos_excluidos"]=0
+    res["bytes_processados"]=0
+    res["bytes_copiados"]=0
     res["explicacao"]=""
 
     # Arquivo de log não existe
@@ -3685,33 +4192,61 @@ def acompanhar_log_copia_robocopy(caminho_log_robocopy):
         res["explicacao"] = "Arquivo não existe"
         return res
 
+    # Sem estado, processa o arquivo inteiro
+    if estado is None:
+        estado = dict()
+    if "seguidor" not in estado:
+        estado["seguidor"] = criar_seguidor_arquivo(caminho_log_robocopy)
+        for chave in Glista_contadores_log_robocopy:
+            estado[chave] = 0
 
-    # Procurar por linha que contem tamanho
-    quantidade_arquivos_processados = 0
-    quantidade_arquivos_excluidos = 0
-    with open(caminho_log_robocopy, "r") as fentrada:
-        for linha in fentrada:
-            #print_sanitizado(linha)
+    seguidor = estado["seguidor"]
+    for linha in ler_novas_linhas_seguidor(seguidor):
 
-            # Despreza linhas pequenas, que normalmente contém apenas um percentual
-            if len(linha)<10:
-                continue
+        # Se o log foi recriado (nova execução do robocopy), a contagem recomeça
+        if estado.get("reinicios", 0) != seguidor['reinicios']:
+            estado["reinicios"] = seguidor['reinicios']
+            for chave in Glista_contadores_log_robocopy:
+                estado[chave] = 0
+
+        #print_sanitizado(linha)
+
+        # Linha de arquivo (/v /bytes), no formato: classe <tab> tamanho <tab> caminho
+        # Exemplo:
+        #     Novo arquivo  		     1048576	C:\origem\arquivo.bin
+        #   *Arquivo EXTRA 		        2048	\\storage\destino\outro.bin
+        # As demais linhas (pastas, erros, tentativas) são desprezadas
+        match = Gregex_linha_arquivo_robocopy.match(linha.rstrip('\r\n'))
+        if not match:
+            continue
+        # Linhas de pasta terminam com barra
+        if match.group('caminho').endswith('\\'):
+            continue
 
-            # Como o robocopy está rodando com /mir
-            # é possível que a pasta de destino contenha arquivos que serão excluídos
-            # durante o procedimento
-            if "*Arquivo EXTRA" in linha:
-                quantidade_arquivos_excluidos = quantidade_arquivos_excluidos + 1
+        classe = match.group('classe').lower()
+        tamanho = int(match.group('tamanho'))
 
-            # Está no logo, considerada como processado
-            # Isto não significa que a cópia foi concluída
-            quantidade_arquivos_processados=quantidade_arquivos_processados+1
+        # Como o robocopy está rodando com /mir
+        # é possível que a pasta de destino contenha arquivos que serão excluídos
+        # durante o procedimento
+        if "extra" in classe:
+            estado["quantidade_arquivos_excluidos"] += 1
+            continue
 
+        # Está no log, considerado como processado
+        estado["quantidade_arquivos_processados"] += 1
+        estado["bytes_processados"] += tamanho
+
+        # Arquivo idêntico já existente no destino não é copiado
+        if classe not in Glista_classes_robocopy_sem_copia:
+            estado["bytes_copiados"] += tamanho
 
     # Tudo certo
     res["sucesso"]=True
-    res["quantidade_arquivos_processados"]=quantidade_arquivos_processados
-    res["quantidade_arquivos_excluidos"]=quantidade_arquivos_excluidos
+    res["quantidade_arquivos_processados"]=estado["quantidade_arquivos_processados"]
+    res["quantidade_arquivos_excluidos"]=estado["quantidade_arquivos_excluidos"]
+    res["bytes_processados"]=estado["bytes_processados"]
+    res["bytes_copiados"]=estado["bytes_copiados"]
     return res
 
 
@@ -3871,12 +4406,18 @@ def main():
             if refresh_tarefas():
                 exibir_situacao(comando)
             continue
+        elif (comando == '*csg'):
+            comparar_sistema_com_storage_todas()
+            continue
         elif (comando == '*sgr'):
             exibir_situacao_repetir()
             continue
         elif (comando == '*log'):
             exibir_log(comando='*log', filtro_base='', filtro_usuario=argumento)
             continue
+        elif (comando == '*met'):
+            exibir_metricas_sapisrv()
+            continue
         elif (comando == '*s3'):
             abrir_browser_setec3_exame(GdadosGerais["codigo_solicitacao_exame_siscrim"])
             continue
@@ -38,7 +38,6 @@ try:
     import time
     import random
     import re
-    import hashlib
     import shutil
     import multiprocessing
 except ImportError:
@@ -326,6 +325,19 @@ def solicita_tarefas(lista_tipos, storage=None):
     return None
 
 
+# Aguarda até que surja tarefa (execução ou exclusão) que este agente possa processar
+def aguardar_tarefa():
+    lista_tipos = ["iped-" + tipo.lower() for tipo in Giped_profiles_habilitados]
+    lista_tipos.append("iped-excluir")
+
+    # Com storage preferencial, o agente também processa tarefas de outros storages
+    storage = None
+    if Gconfiguracao["storage_escopo"] == CONST_storage_unico():
+        storage = Gconfiguracao["storage_selecionado"]
+
+    return sapisrv_aguardar_tarefa(lista_tipos, unidade=Gunidade, storage=storage, espera=GdormirSemServico)
+
+
 # Tenta obter uma tarefa para exclusão
 def solicita_tarefa_exclusao(lista_tipos, storage=None):
     # Exclui qualquer tarefa que inicia por 'iped-'
@@ -353,46 +365,20 @@ def solicita_tarefa_exclusao(lista_tipos, storage=None):
     return None
 
 
-# Atualiza arquivo de texto no servidor
-# Fica em loop até conseguir
-def armazenar_texto_tarefa(codigo_tarefa, titulo, conteudo):
-    # Se a atualização falhar, fica tentando até conseguir
-    # Se for problema transiente, vai resolver
-    # Caso contrário, algum humano irá mais cedo ou mais tarde intervir
-    while not sapisrv_armazenar_texto(tipo_objeto='tarefa',
-                                      codigo_objeto=codigo_tarefa,
-                                      titulo=titulo,
-                                      conteudo=conteudo
-                                      ):
-        print_log("Falhou upload de texto para tarefa [", codigo_tarefa, "]. Tentando novamente")
-        dormir(60)  # Tenta novamente em 1 minuto
-
-    # Ok, conseguiu atualizar
-    print_log("Efetuado upload de texto [", titulo, "] para tarefa [", codigo_tarefa, "]")
-
-
 def armazenar_texto_log_iped(codigo_tarefa, caminho_log_iped):
     # Le arquivo de log do iped e faz upload
     if not os.path.exists(caminho_log_iped):
         print_log("Arquivo de log de IPED não existe, logo, upload não foi efetuado")
         return
 
-    # Por enquanto, vamos ler tudo, mas talvez mais tarde seja melhor sintetizar, removendo informações sem valor
+    # Por enquanto, vamos enviar tudo, mas talvez mais tarde seja melhor sintetizar, removendo informações sem valor
     # que só interesseriam para o desenvolvedor
     # Neste caso, talvez ter dois logs: O completo e o sintético.
-    # Para arquivos maiores, terá que configurar no /etc/php.ini os parâmetros post_max_size e upload_max_filesize
-    # para o tamanho necessário (atualmente no SETEC3 está bem baixo...8M)
+    # O log é enviado comprimido e em partes, de modo que não esbarra no post_max_size do /etc/php.ini do SETEC3
 
     # Se precisar sintetizar no futuro, ver sapi_cellebrite => sintetizar_arquivo_xml
     # Fazer uma função específica
-    conteudo = ""
-    # with codecs.open(caminho_log_iped, "r", "utf-8") as fentrada:
-    # Tem algo no arquivo de log que não é UTF8
-    with open(caminho_log_iped, "r") as fentrada:
-        for linha in fentrada:
-            conteudo = conteudo + linha
-
-    armazenar_texto_tarefa(codigo_tarefa, 'Arquivo de log do IPED', conteudo)
+    sapisrv_armazenar_texto_arquivo_tarefa(codigo_tarefa, 'Arquivo de log do IPED', caminho_log_iped)
 
 
 # Aborta tarefa.
@@ -659,13 +645,7 @@ def executa_iped(codigo_tarefa, comando, caminho_origem, caminho_destino, caminh
     p_acompanhar.terminate()
 
     # Faz upload da tela de resultado do IPED (mensagens que seriam exibidas na tela)
-    conteudo_tela = ""
-    # Upload do resultado do IPED
-    with open(caminho_tela_iped, "r") as fentrada:
-        for linha in fentrada:
-            conteudo_tela = conteudo_tela + linha
-
-    armazenar_texto_tarefa(codigo_tarefa, 'Resultado IPED', conteudo_tela)
+    sapisrv_armazenar_texto_arquivo_tarefa(codigo_tarefa, 'Resultado IPED', caminho_tela_iped)
 
     # Faz upload do log do IPED
     armazenar_texto_log_iped(codigo_tarefa, caminho_log_iped)
@@ -718,6 +698,12 @@ def background_acompanhar_iped(codigo_tarefa,
 
     print_log("Processo de acompanhamento de IPED")
 
+    # O arquivo de tela é lido de forma incremental (apenas as linhas acrescentadas desde a última leitura),
+    # pois em processamentos longos pode chegar a centenas de MB
+    seguidor = criar_seguidor_arquivo(caminho_tela_iped)
+    texto_status = None
+    linha = None
+
     # Fica em loop infinito. Será encerrado pelo pai (com terminate)
     while True:
 
@@ -726,32 +712,30 @@ def background_acompanhar_iped(codigo_tarefa,
             dormir(30)
             continue
 
-        # Le arquivo de resultado (tela) e busca pela última mensagem de situação e projeção
+        # Le as novas linhas do arquivo de resultado (tela) e busca pela última mensagem de situação e projeção
         # Exemplo:
-        texto_status = None
-        linha = None
-        with open(caminho_tela_iped, "r") as fentrada:
-            for linha in fentrada:
-                # Troca tabulação por espaço
-                linha = linha.replace('\t', ' ')
-                # Ignora se estiver em branco
-                if linha.strip() == "":
-                    continue
-                # Formato da linha de status na versão 3.12
-                # IPED-2017-01-31 17:14:11 [MSG] Processando 29308/39593 (25%) 31GB/h Termino em 0h 5m 33s
-                if "[MSG] Processando" in linha:
-                    texto_status = linha
-                else:
-                    # Formato da linha de status na versão 3.14
-                    # 2018-09-28 11:12:22	[MSG]	[indexer.process.ProgressConsole]			Processando 28028/54313 (74%) 68GB/h Termino em 0h 0m 37s
-                    matchObj = re.match(r'^(.*)\[MSG\].*(Processando .*)$', linha, re.I)
-                    if matchObj:
-                        texto_status = matchObj.group(1).strip() + " " + matchObj.group(2).strip()
+        for linha in ler_novas_linhas_seguidor(seguidor):
+            # Troca tabulação por espaço
+            linha = linha.replace('\t', ' ')
+            # Ignora se estiver em branco
+            if linha.strip() == "":
+                continue
+            # Formato da linha de status na versão 3.12
+            # IPED-2017-01-31 17:14:11 [MSG] Processando 29308/39593 (25%) 31GB/h Termino em 0h 5m 33s
+            if "[MSG] Processando" in linha:
+                texto_status = linha
+            else:
+                # Formato da linha de status na versão 3.14
+                # 2018-09-28 11:12:22	[MSG]	[indexer.process.ProgressConsole]			Processando 28028/54313 (74%) 68GB/h Termino em 0h 0m 37s
+                matchObj = re.match(r'^(.*)\[MSG\].*(Processando .*)$', linha, re.I)
+                if matchObj:
+                    texto_status = matchObj.group(1).strip() + " " + matchObj.group(2).strip()
 
         # Atualiza status
         if texto_status is not None:
             print_log("Atualizando status para tarefa", codigo_tarefa, ":", texto_status)
-            sapisrv_atualizar_status_tarefa_informativo(codigo_tarefa, texto_status)
+            # Status vai para a fila, enviada em lote (não bloqueia o acompanhamento)
+            sapisrv_atualizar_status_tarefa_fila(codigo_tarefa, texto_status)
             # Intervalo entre atualizações de status
             dormir(GtempoEntreAtualizacoesStatus, "Dormindo entre atualização de status do IPED")
         else:
@@ -773,43 +757,38 @@ def verificar_sucesso_iped(caminho_tela_iped):
         return False
 
     # Processa arquivo de tela
-    with open(caminho_tela_iped, "r") as fentrada:
-        for linha in fentrada:
-            # Sucesso
-            indicativo = "IPED finalizado"
-            if indicativo in linha:
-                print_log("Indicativo de sucesso [", indicativo, " ] encontrado.")
-                return True
-            # Sucesso (Mensagem em Inglês, a partir da versão 3.12.4)
-            indicativo = "IPED finished"
-            if indicativo in linha:
-                print_log("Indicativo de sucesso [", indicativo, " ] encontrado.")
-                return True
-            # Erro
-            indicativo = 'ERRO!!!'
-            if indicativo in linha:
-                print_log("Indicativo de erro [", indicativo, "] encontrado.")
-                return False
-            # Erro (Mensagem em Inglês)
-            indicativo = 'ERROR!!!'
-            if indicativo in linha:
-                print_log("Indicativo de erro [", indicativo, "] encontrado.")
-                return False
+    # A leitura é feita em blocos, sem carregar o arquivo inteiro
+    seguidor = criar_seguidor_arquivo(caminho_tela_iped)
+    for linha in ler_novas_linhas_seguidor(seguidor, final=True):
+        # Sucesso
+        indicativo = "IPED finalizado"
+        if indicativo in linha:
+            print_log("Indicativo de sucesso [", indicativo, " ] encontrado.")
+            return True
+        # Sucesso (Mensagem em Inglês, a partir da versão 3.12.4)
+        indicativo = "IPED finished"
+        if indicativo in linha:
+            print_log("Indicativo de sucesso [", indicativo, " ] encontrado.")
+            return True
+        # Erro
+        indicativo = 'ERRO!!!'
+        if indicativo in linha:
+            print_log("Indicativo de erro [", indicativo, "] encontrado.")
+            return False
+        # Erro (Mensagem em Inglês)
+        indicativo = 'ERROR!!!'
+        if indicativo in linha:
+            print_log("Indicativo de erro [", indicativo, "] encontrado.")
+            return False
 
     # Se não tem informação conclusiva, retorna falso
     print_log("Sem informação conclusiva na análise do arquivo de resultado do IPED")
     return False
 
 
-def calcula_sha256_arquivo(caminho_arquivo, blocksize=2 ** 20):
-    m = hashlib.sha256()
-    with open(caminho_arquivo, "rb") as f:
-        while True:
-            buf = f.read(blocksize)
-            if not buf:
-                break
-            m.update(buf)
-    return m.hexdigest()
+def calcula_sha256_arquivo(caminho_arquivo):
+    # Leitura em paralelo com o cálculo (sapilib)
+    return calcular_hash_arquivo(caminho_arquivo, ['sha256'])['sha256']
 
 
 def calcula_hash_iped(codigo_tarefa, caminho_destino):
@@ -835,6 +814,19 @@ def calcula_hash_iped(codigo_tarefa, caminho_destino):
         # Não deveria ocorrer este erro??? Abortar e analisar
         return (False, erro)
 
+    # Manifesto com o hash de todos os arquivos da pasta do IPED
+    # O manifesto fica gravado na pasta, e permite conferir posteriormente a integridade da pasta
+    # (e de suas cópias, como na geração de mídia)
+    try:
+        sapisrv_atualizar_status_tarefa_informativo(
+            codigo_tarefa=codigo_tarefa,
+            texto_status="Gerando manifesto de hash da pasta do IPED"
+        )
+        manifesto = gerar_manifesto_hash(caminho_destino, algoritmo=algoritmo_hash)
+    except Exception as e:
+        erro = "Não foi possível gerar manifesto de hash para " + caminho_destino + " => " + str(e)
+        return (False, erro)
+
     # Extrai a subpasta de destino
     partes = caminho_destino.split("/")
     subpasta_destino = partes[len(partes) - 1]
@@ -848,6 +840,13 @@ def calcula_hash_iped(codigo_tarefa, caminho_destino):
     h["sapiHashAlgoritmo"] = algoritmo_hash
     lista_hash = [h]
 
+    h = dict()
+    h["sapiHashDescricao"] = "Hash raiz do manifesto " + subpasta_destino + "/" + Gnome_arquivo_manifesto_hash + \
+                             " (" + str(manifesto['quantidade_arquivos']) + " arquivos)"
+    h["sapiHashValor"] = manifesto['raiz']
+    h["sapiHashAlgoritmo"] = algoritmo_hash
+    lista_hash.append(h)
+
     armazenar_dados_laudo('sapiHashes', lista_hash)
 
     print_log("Hash calculado para resultado do IPED: ", valor_hash, "(", algoritmo_hash, ")")
@@ -1382,35 +1381,36 @@ def recupera_dados_laudo(codigo_tarefa, caminho_log_iped):
     # Processa arquivo
     versao = None
     total_itens = None
-    with open(caminho_log_iped, "r") as fentrada:
-        for linha in fentrada:
-            # Troca tabulação por espaço
-            linha = linha.replace('\t', ' ')
-
-            # Versão do IPED
-            # 2017-01-31 17:12:11	[INFO]	Indexador e Processador de Evidências Digitais 3.11
-            # 2018-07-09 17:33:28	[INFO]	[gpinf.indexer.IndexFiles]			Indexador e Processador de Evidências Digitais 3.14.2
-            if "Indexador e Processador de Evidências Digitais" in linha:
-                (inicio, numero_versao) = linha.split('Digitais')
-                numero_versao = numero_versao.strip()
-                if not numero_versao == "":
-                    versao = "IPED " + numero_versao
-
-            # Quantidade de itens processados
-            # 2017-01-31 17:21:19	[INFO]	Total processado: 153329 itens em 542 segundos (4084 MB)
-            if "[INFO] Total processado:" in linha:
-                match = re.search(r'processado: (\d+) itens', linha)
-                if match:
-                    total_itens = (match.group(1))
-
-            # A partir de 3.14.2 começou a exibir textos em inglês
-            # 2018-07-09 17:33:43	[INFO]	[indexer.process.Statistics]			Total processed: 15 items in 14 seconds (4 MB)
-            if "Total processed:" in linha:
-                match = re.search(r'processed: (\d+) items', linha)
-                if match:
-                    total_itens = (match.group(1))
-
-                    # Todo: Como calcular a quantidade de itens com erro (que não foram processados...)
+    # A leitura é feita em blocos, sem carregar o arquivo inteiro
+    seguidor = criar_seguidor_arquivo(caminho_log_iped)
+    for linha in ler_novas_linhas_seguidor(seguidor, final=True):
+        # Troca tabulação por espaço
+        linha = linha.replace('\t', ' ')
+
+        # Versão do IPED
+        # 2017-01-31 17:12:11	[INFO]	Indexador e Processador de Evidências Digitais 3.11
+        # 2018-07-09 17:33:28	[INFO]	[gpinf.indexer.IndexFiles]			Indexador e Processador de Evidências Digitais 3.14.2
+        if "Indexador e Processador de Evidências Digitais" in linha:
+            (inicio, numero_versao) = linha.split('Digitais')
+            numero_versao = numero_versao.strip()
+            if not numero_versao == "":
+                versao = "IPED " + numero_versao
+
+        # Quantidade de itens processados
+        # 2017-01-31 17:21:19	[INFO]	Total processado: 153329 itens em 542 segundos (4084 MB)
+        if "[INFO] Total processado:" in linha:
+            match = re.search(r'processado: (\d+) itens', linha)
+            if match:
+                total_itens = (match.group(1))
+
+        # A partir de 3.14.2 começou a exibir textos em inglês
+        # 2018-07-09 17:33:43	[INFO]	[indexer.process.Statistics]			Total processed: 15 items in 14 seconds (4 MB)
+        if "Total processed:" in linha:
+            match = re.search(r'processed: (\d+) items', linha)
+            if match:
+                total_itens = (match.group(1))
+
+                # Todo: Como calcular a quantidade de itens com erro (que não foram processados...)
 
     if versao is None:
         erro = "Não foi possível recuperar versão do IPED"
@@ -1723,6 +1723,8 @@ def executa_sequencia_exclusao_tarefa(
         )
         sapisrv_reportar_erro("Tarefa " + str(Gcodigo_tarefa_executando) + "Erro => " + trc_string)
         # subprocesso será abortado, e deixa o processo principal decidir o que fazer
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(1)
 
     # Tudo certo, todos os passos foram executados com sucesso
@@ -2181,6 +2183,8 @@ def executa_sequencia_iped(
         )
         sapisrv_reportar_erro("Tarefa " + str(Gcodigo_tarefa_executando) + "Erro => " + trc_string)
         # subprocesso será abortado, e deixa o processo principal decidir o que fazer
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(1)
 
     # Tudo certo, todos os passos foram executados com sucesso
@@ -2220,6 +2224,8 @@ def finalizar_programa():
     # Ok, tudo encerrado
     # -----------------------------------------------------------------------------------------------------------------
     print_log(" ===== FINAL ", Gprograma, " - (Versao", Gversao, ")")
+    publicar_metricas_sapisrv()
+    log_descarregar()
     os._exit(1)
 
 
@@ -2942,9 +2948,9 @@ def main():
             time.sleep(60)
             continue
         else:
-            # Se não fez nada no ciclo,
-            # faz uma pausa para evitar sobrecarregar o servidor com requisições
-            dormir(GdormirSemServico)
+            # Se não fez nada no ciclo, aguarda até que surja uma tarefa
+            # (ou até GdormirSemServico, se o servidor não suportar a espera)
+            aguardar_tarefa()
             # Depois que volta da soneca da ociosidade e reinicializa
             # pois algo pode ter mudado (versão do IPED por exemplo)
             # Se isto acontecer, finaliza sapi_iped para que seja atualizado
@@ -67,6 +67,7 @@ Gstorages = None
 Gsolicitacao_exame = None
 Gmateriais_solicitacao = None
 Gstorages_laudo = list()  # Lista de storages associados a tarefas do laudo
+Gtarefas_laudo_item = dict()  # Tarefas finalizadas de cada item, por (item, fase). Ver carregar_tarefas_laudo_itens
 
 
 # Variáveis atualizadas durante a carga de um modelo SAPI
@@ -103,6 +104,7 @@ Gmenu_comandos['comandos'] = {
     # Comandos para diagnóstico de problemas
     '*db': 'Ligar/desligar modo debug. No modo debug serão geradas mensagens adicionais no log.',
     '*log': 'Exibir log geral.',
+    '*met': 'Exibir métricas (quantidade, erros e tempo de resposta) das chamadas ao servidor SETEC3.',
 
     # Comandos gerais
     '*ml': 'Geração de modelo de laudo SAPI (Siscrim)',
@@ -119,7 +121,7 @@ Gmenu_comandos['cmd_exibicao'] = ["*sg"]
 Gmenu_comandos['cmd_navegacao'] = ["+", "-"]
 Gmenu_comandos['cmd_item'] = ["*si"]
 Gmenu_comandos['cmd_geral'] = ['*ml', '*gl', '*s3', '*s3g', '*sto', '*cl',  '*tt', '*qq']
-Gmenu_comandos['cmd_diagnostico'] = ['*log', '*db']
+Gmenu_comandos['cmd_diagnostico'] = ['*log', '*met', '*db']
 
 # ---------------------------------------------------------
 # Menu de Administrador
@@ -137,6 +139,7 @@ Gmenu_admin['comandos'] = {
     # Comandos para diagnóstico de problemas
     '*db': 'Ligar/desligar modo debug. No modo debug serão geradas mensagens adicionais no log.',
     '*log': 'Exibir log geral.',
+    '*met': 'Exibir métricas (quantidade, erros e tempo de resposta) das chamadas ao servidor SETEC3.',
 
     # Comandos gerais
     '*gm': 'Geração automática de modelo de laudo SAPI para unidade com quesitos mais comuns',
@@ -149,7 +152,7 @@ Gmenu_admin['cmd_exibicao'] = []
 Gmenu_admin['cmd_navegacao'] = ["+", "-"]
 Gmenu_admin['cmd_item'] = []
 Gmenu_admin['cmd_geral'] = ['*gm', '*vm', '*aq']
-Gmenu_admin['cmd_diagnostico'] = ['*log', '*db']
+Gmenu_admin['cmd_diagnostico'] = ['*log', '*met', '*db']
 
 
 # ------------------------------------------------------------------------------------------------
@@ -1331,6 +1334,40 @@ def carrega_blocos(base, excluir_blocos=True):
     return (True, dblocos)
 
 
+# Parâmetros para recuperação das tarefas finalizadas de um item
+def _parametros_tarefas_laudo_item(item, fase=None):
+    param = {'codigo_solicitacao_exame_siscrim': GdadosGerais["codigo_solicitacao_exame_siscrim"],
+             'item': item,
+             'tipo': 'todos',
+             'situacao': 'finalizada'}
+    if fase is not None:
+        param['fase'] = fase
+    return param
+
+
+# Carrega simultaneamente as tarefas finalizadas de todos os itens do laudo,
+# nas combinações utilizadas na geração do laudo (todas as fases e fase de aquisição)
+# Evita que a geração do laudo faça uma consulta ao servidor após a outra, para cada item
+def carregar_tarefas_laudo_itens():
+    global Gtarefas_laudo_item
+
+    chaves = list()
+    for dados_item in Gitens:
+        # Despreza materiais de destino
+        if dados_item['item'] == 'destino':
+            continue
+        for fase in [None, '10-aquisicao']:
+            chaves.append((dados_item['item'], fase))
+
+    print("- Recuperando dados das tarefas de", len(chaves) // 2, "itens. Aguarde...")
+    resultados = sapisrv_gather([
+        sapisrv_chamar_programa_sucesso_ok_async(programa="sapisrv_obter_tarefas.php",
+                                                 parametros=_parametros_tarefas_laudo_item(item, fase))
+        for (item, fase) in chaves])
+
+    Gtarefas_laudo_item = dict(zip(chaves, resultados))
+
+
 def recupera_dados_para_laudo_das_tarefas_item(dados_item, fase=None):
     lista_dados_laudo = []
 
@@ -1369,18 +1406,14 @@ def recupera_dados_para_laudo_das_tarefas_item(dados_item, fase=None):
     #var_dump(dados_item)
     #die('ponto1099')
 
-    print_log("- Recuperando dados para laudo das tarefas do item ", item)
-    param = {'codigo_solicitacao_exame_siscrim': GdadosGerais["codigo_solicitacao_exame_siscrim"],
-             'item': item,
-             'tipo': 'todos',
-             'situacao': 'finalizada'}
-    if fase is not None:
-        param['fase'] = fase
-
-    tarefas = sapisrv_chamar_programa_sucesso_ok(
-        programa="sapisrv_obter_tarefas.php",
-        parametros=param
-    )
+    # As tarefas podem já ter sido carregadas (ver carregar_tarefas_laudo_itens)
+    tarefas = Gtarefas_laudo_item.get((item, fase), None)
+    if tarefas is None:
+        print_log("- Recuperando dados para laudo das tarefas do item ", item)
+        tarefas = sapisrv_chamar_programa_sucesso_ok(
+            programa="sapisrv_obter_tarefas.php",
+            parametros=_parametros_tarefas_laudo_item(item, fase)
+        )
 
     #var_dump(tarefas)
     #die('ponto1386')
@@ -3853,6 +3886,9 @@ def _gerar_laudo():
         print("- Comando cancelado")
         return
 
+    # Dados das tarefas de todos os itens, utilizados nos vários passos da geração
+    carregar_tarefas_laudo_itens()
+
     # ------------------------------------------------------------------------------------------------------------------
     # Verifica dados básicos do exame
     # ------------------------------------------------------------------------------------------------------------------
@@ -4513,30 +4549,33 @@ def refresh_itens():
     # Irá atualizar a variável global de itens
     global Gitens
     global Gstorages_laudo
+    global Gtarefas_laudo_item
 
     print("- Buscando situação atualizada do servidor. Aguarde...")
 
     # Carrega os materiais do exame
+    # e, simultaneamente, a solicitação de exame, para verificar se o laudo é parcial,
+    # ou seja, se existem itens na solicitação de exame que não fazem parte do laudo
     # --------------------------------------------------------------
     codigo_solicitacao_exame_siscrim = GdadosGerais["codigo_solicitacao_exame_siscrim"]
     codigo_laudo = GdadosGerais["codigo_laudo"]
-    dados = sapisrv_chamar_programa_sucesso_ok(
-        programa="sapisrv_obter_itens_laudo.php",
-        parametros={'codigo_solicitacao_exame_siscrim': codigo_solicitacao_exame_siscrim,
-                    'codigo_laudo': codigo_laudo},
-        registrar_log=Gverbose
-    )
+    (dados, ok) = sapisrv_gather([
+        sapisrv_chamar_programa_sucesso_ok_async(
+            programa="sapisrv_obter_itens_laudo.php",
+            parametros={'codigo_solicitacao_exame_siscrim': codigo_solicitacao_exame_siscrim,
+                        'codigo_laudo': codigo_laudo},
+            registrar_log=Gverbose),
+        executar_async(carregar_solicitacao_exame)
+    ])
 
     # Guarda na global
     Gitens = dados["itens"]
     Gstorages_laudo = dados["storages"]
+    # Tarefas dos itens serão recarregadas quando necessário
+    Gtarefas_laudo_item = dict()
 
     GdadosGerais["data_hora_ultima_atualizacao_status"] = datetime.datetime.now().strftime('%H:%M:%S')
 
-    # Verifica se o laudo é parcial, ou seja, se existem itens na solicitação de exame
-    # que não fazem parte do laudo
-    carregar_solicitacao_exame()
-
     return True
 
 
@@ -4647,7 +4686,7 @@ def exibir_storage_file_explorer():
 # ----------------------------------------------------------------------------------------------------------------------
 # Exibe conteúdo do arquivo de log
 # ----------------------------------------------------------------------------------------------------------------------
-def exibir_log(comando, filtro_base="", filtro_usuario="", limpar_tela=True):
+def exibir_log(comando, filtro_base="", filtro_usuario="", limpar_tela=True, codigo_tarefa=None):
 
     # Filtros
     filtro_base     =filtro_base.strip()
@@ -4666,37 +4705,7 @@ def exibir_log(comando, filtro_base="", filtro_usuario="", limpar_tela=True):
        print("Contendo termo: ", filtro_usuario)
        print_centralizado()
 
-    arquivo_log = obter_nome_arquivo_log()
-
-    # Não tem arquivo de log
-    if (not os.path.isfile(arquivo_log)):
-        print("*** Arquivo de log vazio ***")
-        return
-
-    with codecs.open(arquivo_log, 'r', "utf-8") as sapi_log:
-        qtd=0
-        for linha in sapi_log:
-            exibir=True
-            if filtro_base!="" and filtro_base.lower() not in linha.lower():
-                exibir=False
-            if filtro_usuario!="" and filtro_usuario.lower() not in linha.lower():
-                exibir=False
-
-            if exibir:
-                qtd=qtd+1
-                print(format(qtd, '03d'),":", linha.strip())
-
-    sapi_log.close()
-
-    if qtd==0:
-        print("*** Nenhuma mensagem de log disponível ***")
-        return
-
-
-    if filtro_usuario=="":
-        print()
-        print("- Dica: Para filtrar o log, forneça um string após comando.")
-        print("  Exemplo: ",comando," erro => Lista apenas linhas que contém o termo 'erro'")
+    exibir_conteudo_log(comando, filtro_base=filtro_base, filtro_usuario=filtro_usuario, codigo_tarefa=codigo_tarefa)
 
     return
 
@@ -6985,6 +6994,9 @@ def execucao_admin():
         elif (comando == '*aq'):
             adicionar_quesitos()
             continue
+        elif (comando == '*met'):
+            exibir_metricas_sapisrv()
+            continue
 
 
 # Modo usuário
@@ -7059,6 +7071,9 @@ def execucao_usuario():
         elif (comando == '*log'):
             exibir_log(comando='*log', filtro_base='', filtro_usuario=argumento)
             continue
+        elif (comando == '*met'):
+            exibir_metricas_sapisrv()
+            continue
         elif (comando == '*tt'):
             obter_laudo_ok()
             exibir_situacao()
@@ -86,6 +86,7 @@ Gmenu_comandos['comandos'] = {
     # Comandos para diagnóstico de problemas
     '*db': 'Ligar/desligar modo debug. No modo debug serão geradas mensagens adicionais no log.',
     '*lg': 'Exibir log geral.',
+    '*met': 'Exibir métricas (quantidade, erros e tempo de resposta) das chamadas ao servidor SETEC3.',
 
     # Comandos gerais
     '*tm': 'Troca mídia de destino dos itens',
@@ -101,7 +102,7 @@ Gmenu_comandos['cmd_exibicao'] = ["*sg"]
 Gmenu_comandos['cmd_navegacao'] = ["+", "-"]
 Gmenu_comandos['cmd_item'] = ["*si", "*tm"]
 Gmenu_comandos['cmd_geral'] = ['*sg', '*gm', '*s3', '*s3g', '*sto', '*cl',  '*tt', '*qq']
-Gmenu_comandos['cmd_diagnostico'] = ['*lg', '*db']
+Gmenu_comandos['cmd_diagnostico'] = ['*lg', '*met', '*db']
 
 # Debug
 Gverbose = False  # Aumenta a exibição de detalhes (para debug)
@@ -112,7 +113,7 @@ Gverbose = False  # Aumenta a exibição de detalhes (para debug)
 
 # Para código produtivo, o comando abaixo deve ser substituído pelo
 # código integral de sapi_xxx.py, para evitar dependência
-from sapilib_0_8 import *
+from sapilib_2_0 import *
 
 # **********************************************************************
 # PRODUCAO
@@ -489,22 +490,33 @@ def _gerar_midia_destino():
                 Gsolicitacao_exame["pasta_memorando"])
             print("- Pasta de destino (a ser criada):")
             print("  ", pasta_memorando_destino)
+            sincronizar = False
             if os.path.exists(pasta_memorando_destino):
                 print_atencao()
                 print("- Pasta a ser criada na mídia de destino já existe.")
                 print("- Isto pode ocorrer se o comando de geração de mídia já foi iniciado anteriormente.")
                 print("- Caso contrário, procure entender a situação antes de prosseguir.")
                 print()
-                print("- Para prosseguir, será necessário primeiramente excluir a pasta existente")
-                prosseguir = pergunta_sim_nao(
-                    "< Você realmente deseja excluir a pasta de destino?",
-                    default="n")
-                if not prosseguir:
-                    # Encerra
-                    print("- Cancelado pelo usuário.")
-                    return
-                print("- Ok, pasta de destino será excluída.")
-                print_log("Usuário solicitou exclusão da pasta de destino na mídia de destino: ", pasta_memorando_destino)
+                print("- A pasta existente pode ser atualizada, copiando apenas os arquivos novos ou alterados")
+                print("  e excluindo o que não existe mais no storage (por exemplo, após um ajuste no laudo).")
+                sincronizar = pergunta_sim_nao(
+                    "< Atualizar a pasta existente (copiar apenas as diferenças)?",
+                    default="s")
+                if sincronizar:
+                    print("- Ok, pasta de destino será atualizada.")
+                    print_log("Usuário solicitou atualização (sincronização) da pasta de destino na mídia de destino: ",
+                              pasta_memorando_destino)
+                else:
+                    print("- Para prosseguir, será necessário primeiramente excluir a pasta existente")
+                    prosseguir = pergunta_sim_nao(
+                        "< Você realmente deseja excluir a pasta de destino?",
+                        default="n")
+                    if not prosseguir:
+                        # Encerra
+                        print("- Cancelado pelo usuário.")
+                        return
+                    print("- Ok, pasta de destino será excluída.")
+                    print_log("Usuário solicitou exclusão da pasta de destino na mídia de destino: ", pasta_memorando_destino)
 
             # Verifica se usuário repetiu a pasta de destino por engano
             if pasta_memorando_destino in lista_pasta_destino:
@@ -516,6 +528,7 @@ def _gerar_midia_destino():
 
             # Tudo certo, armazena pasta de destino na mídia e passa para a próxima
             Gresumo_midia[k_m]["pasta_memorando_destino"]=pasta_memorando_destino
+            Gresumo_midia[k_m]["sincronizar"]=sincronizar
             break
 
     # ------------------------------------------------------------------------------------------------------------------
@@ -574,7 +587,7 @@ def _gerar_midia_destino():
             target=background_gm,
             args=(pasta_memorando_storage, pasta_memorando_destino, lista_subpastas,
                   nome_arquivo_log_para_processos_filhos, label_processo,
-                  dados_pai_para_filho)
+                  dados_pai_para_filho, m.get("sincronizar", False))
         )
         p_executar.start()
 
@@ -591,11 +604,67 @@ def _gerar_midia_destino():
 
     return
 
+# Compara o manifesto de hash da cópia (calculado durante a cópia) com os manifestos de hash existentes
+# na origem (gerados no cálculo de hash do IPED), sem ler novamente os arquivos.
+# Apenas registra no log os arquivos que foram alterados após a geração do manifesto do IPED,
+# pois a integridade da cópia é conferida pelo manifesto da cópia (conferir_pasta_manifesto_hash)
+def comparar_manifestos_hash_midia(caminho_origem, manifesto_copia):
+
+    quantidade_manifestos = 0
+    for raiz, subpastas, arquivos in os.walk(caminho_origem):
+        if Gnome_arquivo_manifesto_hash not in arquivos:
+            continue
+        # O manifesto da raiz foi substituído pelo manifesto da cópia
+        relativo_pasta = os.path.relpath(raiz, caminho_origem).replace("\\", "/")
+        if relativo_pasta == ".":
+            continue
+        quantidade_manifestos += 1
+
+        manifesto = carregar_manifesto_hash(raiz)
+        if manifesto["algoritmo"] != manifesto_copia["algoritmo"]:
+            print_log("Manifesto de hash de", raiz, "utiliza algoritmo", manifesto["algoritmo"],
+                      ". Comparação com a cópia não efetuada")
+            continue
+
+        prefixo = relativo_pasta + "/"
+        copiados = dict()
+        for relativo in manifesto_copia["arquivos"]:
+            if relativo.startswith(prefixo) and relativo != prefixo + Gnome_arquivo_manifesto_hash:
+                copiados[relativo[len(prefixo):]] = manifesto_copia["arquivos"][relativo]
+
+        alterados = [r for r in manifesto["arquivos"]
+                     if r in copiados and copiados[r]["hash"] != manifesto["arquivos"][r]["hash"]]
+        excluidos = set(manifesto["arquivos"]) - set(copiados)
+        incluidos = set(copiados) - set(manifesto["arquivos"])
+        if len(alterados) + len(excluidos) + len(incluidos) > 0:
+            print_log("Pasta", raiz, "foi alterada após a geração do manifesto de hash.",
+                      "Alterados:", len(alterados),
+                      "Excluídos:", len(excluidos),
+                      "Incluídos:", len(incluidos))
+        else:
+            print_log("Cópia de", raiz, "confere com o manifesto de hash gerado no IPED. Hash raiz:",
+                      manifesto["raiz"])
+
+    if quantidade_manifestos == 0:
+        print_log("Nenhuma pasta com manifesto de hash do IPED em", caminho_origem)
+
+
+# Registra no log o andamento da cópia da *GM (ver copiar_pasta_paralelo)
+def registrar_progresso_copia_gm(situacao):
+    percentual = 100
+    if situacao["tamanho_total"] > 0:
+        percentual = situacao["bytes_copiados"] * 100 // situacao["tamanho_total"]
+    print_log("Copiados", converte_bytes_humano(situacao["bytes_copiados"]), "de",
+              converte_bytes_humano(situacao["tamanho_total"]), "(" + str(percentual) + "%) -",
+              situacao["arquivos_copiados"], "de", situacao["quantidade_arquivos"], "arquivos")
+
+
 # Efetua a geração da mídia (cópia, ajustes multicase, checagens, etc)
+# sincronizar: Atualiza a pasta de destino existente (copia apenas as diferenças), ao invés de recriá-la
 def background_gm(
         pasta_memorando_storage, pasta_memorando_destino, lista_subpastas,
         nome_arquivo_log, label_processo,
-        dados_pai_para_filho):
+        dados_pai_para_filho, sincronizar=False):
 
     # Impede interrupção por sigint
     signal.signal(signal.SIGINT, signal.SIG_IGN)
@@ -621,8 +690,22 @@ def background_gm(
 
         # 2) Prepara pasta de destino
         # ------------------------------------------------------------------
-        # Se pasta do memorando já existe, exclui
-        if os.path.exists(pasta_memorando_destino):
+        lista_avulsos=["ferramenta_pesquisa.bat"]
+        if sincronizar and os.path.exists(pasta_memorando_destino):
+            # Sincronização: Exclui apenas o que não faz mais parte da mídia
+            # O conteúdo de cada subpasta é sincronizado durante a cópia
+            print_log("Atualizando pasta de destino existente (sincronização):", pasta_memorando_destino)
+            for nome in os.listdir(pasta_memorando_destino):
+                if nome in lista_subpastas or nome in lista_avulsos:
+                    continue
+                caminho_excluir = montar_caminho(pasta_memorando_destino, nome)
+                print_log("Excluindo da pasta de destino (não faz mais parte da mídia):", nome)
+                if os.path.isdir(caminho_excluir):
+                    shutil.rmtree(caminho_excluir)
+                else:
+                    os.remove(caminho_excluir)
+        elif os.path.exists(pasta_memorando_destino):
+            # Se pasta do memorando já existe, exclui
             # Exclui pasta de destino
             print_log("Excluindo pasta de destino:", pasta_memorando_destino)
             shutil.rmtree(pasta_memorando_destino)
@@ -643,46 +726,50 @@ def background_gm(
             print_log("Copiar de:", caminho_origem)
             print_log("Copiar para:", caminho_destino)
 
-            # 3.1) Determina características da pasta de origem
-            # ---------------------------------------------------
-            print_log("Calculando tamanho da pasta de origem...")
-            # Registra características da pasta de origem
-            carac_origem = obter_caracteristicas_pasta(caminho_origem)
-            tam_pasta_origem = carac_origem.get("tamanho_total", None)
-            if tam_pasta_origem is None:
-                # Se não tem conteúdo, aborta...
-                # Isto não deveria acontecer nunca....
-                raise Exception("Pasta de origem com tamanho indefinido")
-            # Registra em log
-            print_log("Pasta de origem com " + converte_bytes_humano(tam_pasta_origem) + \
-                           " (" + str(carac_origem["quantidade_arquivos"]) + " arquivos)")
-
-            # 3.2) Executa a cópia
+            # 3.1) Executa a cópia
             # ------------------------------------------------------------------
-            print_log("Copiando", subpasta,"...")
-            shutil.copytree(caminho_origem, caminho_destino)
-            print_log("Cópia finalizada")
-
-            # 3.3) Confere se cópia foi efetuada com sucesso
+            # Cópia paralela: Os arquivos são copiados simultaneamente, e o tamanho de cada um é conferido
+            # logo após a cópia, de modo que não é necessário percorrer novamente origem e destino
+            # O hash de cada arquivo é calculado durante a cópia, e o manifesto de hash é gravado no destino
+            # Na sincronização, apenas os arquivos novos ou alterados são copiados
+            # A cópia ocupa uma vaga na fila de cópias da máquina (compartilhada com o sapi_cellebrite),
+            # respeitando os limites de cópias simultâneas e de banda
+            vaga = obter_vaga_copia(caminho_origem, pasta_memorando_destino)
+            try:
+                print_log("Copiando", subpasta,"...")
+                resumo = copiar_pasta_paralelo(caminho_origem, caminho_destino, progresso=registrar_progresso_copia_gm,
+                                               algoritmo_hash='sha256',
+                                               sincronizar=sincronizar, sincronizar_hash=sincronizar,
+                                               limite_banda=vaga['banda'])
+            finally:
+                liberar_vaga_copia(vaga)
+            print_log("Cópia finalizada em", int(resumo["tempo"]), "segundos")
+            if sincronizar:
+                print_log("Sincronização de", subpasta, ":", len(resumo["copiados"]), "arquivos copiados,",
+                          resumo["arquivos_aproveitados"], "inalterados,", len(resumo["excluidos"]), "excluídos")
+
+            # 3.2) Confere se cópia foi efetuada com sucesso
             # ------------------------------------------------------------------
             # Compara tamanho total e quantidade de arquivos
-            print_log("Conferindo cópia (tamanho e quantidade de arquivos)...")
-
-            carac_destino = obter_caracteristicas_pasta(caminho_destino)
-            if carac_origem["tamanho_total"]==carac_destino["tamanho_total"]:
-                print_log("Tamanho total confere")
-            else:
-                print("Divergência entre tamanho total de origem (",carac_origem["tamanho_total"],") e destino (",carac_origem["tamanho_total"],")")
+            print_log("Pasta de origem com " + converte_bytes_humano(resumo["tamanho_total"]) + \
+                           " (" + str(resumo["quantidade_arquivos"]) + " arquivos)")
+            if resumo["tamanho_total"]!=resumo["bytes_copiados"]:
+                print("Divergência entre tamanho total de origem (",resumo["tamanho_total"],") e destino (",resumo["bytes_copiados"],")")
                 raise Exception("Divergência de tamanho")
 
-            if carac_origem["quantidade_arquivos"]==carac_destino["quantidade_arquivos"]:
-                print_log("Quantidade de arquivos confere")
-            else:
-                print("Divergência de quantidade de arquivos entre origem (", carac_origem["quantidade_arquivos"], ") e destino (",
-                      carac_origem["quantidade_arquivos"], ")")
-                raise Exception("Divergência de quantidade de arquivos")
+            print_log("Tamanho total e quantidade de arquivos compatíveis. Assinatura da listagem:", resumo["assinatura"])
 
-            print_log("Tamanho total e quantidade de arquivos compatíveis")
+            # 3.3) Confere hash da cópia
+            # ------------------------------------------------------------------
+            # O manifesto foi gerado durante a cópia, de modo que apenas o destino é lido
+            # Na sincronização, são lidos apenas os arquivos copiados (os demais foram conferidos anteriormente)
+            print_log("Conferindo hash da cópia:", caminho_destino)
+            if sincronizar:
+                conferir_pasta_manifesto_hash(caminho_destino, resumo["manifesto"], recalcular=resumo["copiados"])
+            else:
+                conferir_pasta_manifesto_hash(caminho_destino, resumo["manifesto"])
+            # Compara com os manifestos gerados no IPED (sem nova leitura)
+            comparar_manifestos_hash_midia(caminho_origem, resumo["manifesto"])
 
             # 3.4) Se chegou aqui, sucesso
             # ============================
@@ -695,7 +782,6 @@ def background_gm(
         # 4) Copia de arquivos avulsos
         # ------------------------------------------------------------------
         print_log("Copiando arquivos avulsos...")
-        lista_avulsos=["ferramenta_pesquisa.bat"]
         for arquivo in lista_avulsos:
             caminho_arquivo_origem=montar_caminho(pasta_memorando_storage, arquivo)
             caminho_arquivo_destino=montar_caminho(pasta_memorando_destino, arquivo)
@@ -735,6 +821,11 @@ def background_gm(
                 else:
                     print_log("Pasta descartada do multicase (laudo parcial): ", linha)
 
+        # Atualiza o manifesto de hash da pasta multicase (apenas o arquivo ajustado é lido)
+        pasta_multicase_destino = montar_caminho(pasta_memorando_destino, "multicase")
+        res = verificar_manifesto_hash(pasta_multicase_destino)
+        gravar_manifesto_hash(pasta_multicase_destino, res["manifesto"])
+
     except OSError as e:
         # Erro fatal: Mesmo estando em background, exibe na tela
         print_tela_log("- [2758] ** ERRO em *GM:" + str(e))
@@ -1494,7 +1585,7 @@ def exibir_storage_file_explorer():
 # ----------------------------------------------------------------------------------------------------------------------
 # Exibe conteúdo do arquivo de log
 # ----------------------------------------------------------------------------------------------------------------------
-def exibir_log(comando, filtro_base="", filtro_usuario="", limpar_tela=True):
+def exibir_log(comando, filtro_base="", filtro_usuario="", limpar_tela=True, codigo_tarefa=None):
 
     # Filtros
     filtro_base     =filtro_base.strip()
@@ -1513,37 +1604,7 @@ def exibir_log(comando, filtro_base="", filtro_usuario="", limpar_tela=True):
        print("Contendo termo: ", filtro_usuario)
        print_centralizado()
 
-    arquivo_log = obter_nome_arquivo_log()
-
-    # Não tem arquivo de log
-    if (not os.path.isfile(arquivo_log)):
-        print("*** Arquivo de log vazio ***")
-        return
-
-    with codecs.open(arquivo_log, 'r', "utf-8") as sapi_log:
-        qtd=0
-        for linha in sapi_log:
-            exibir=True
-            if filtro_base!="" and filtro_base.lower() not in linha.lower():
-                exibir=False
-            if filtro_usuario!="" and filtro_usuario.lower() not in linha.lower():
-                exibir=False
-
-            if exibir:
-                qtd=qtd+1
-                print(format(qtd, '03d'),":", linha.strip())
-
-    sapi_log.close()
-
-    if qtd==0:
-        print("*** Nenhuma mensagem de log disponível ***")
-        return
-
-
-    if filtro_usuario=="":
-        print()
-        print("- Dica: Para filtrar o log, forneça um string após comando.")
-        print("  Exemplo: ",comando," erro => Lista apenas linhas que contém o termo 'erro'")
+    exibir_conteudo_log(comando, filtro_base=filtro_base, filtro_usuario=filtro_usuario, codigo_tarefa=codigo_tarefa)
 
     return
 
@@ -1769,6 +1830,9 @@ def main():
         elif (comando == '*lg'):
             exibir_log(comando='*lg', filtro_base='', filtro_usuario=argumento)
             continue
+        elif (comando == '*met'):
+            exibir_metricas_sapisrv()
+            continue
         elif (comando == '*tt'):
             obter_laudo_ok()
             #salvar_estado()
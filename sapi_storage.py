@@ -84,7 +84,8 @@ Gmenu_comandos['comandos'] = {
 
     # Comandos para diagnóstico de problemas
     '*log': 'Exibir log geral desta instância do sapi_storage. Utiliza argumento como filtro (exe: *log status => Exibe apenas registros de log contendo o string "status".',
-    '*db': 'Ligar/desligar modo debug. No modo debug serão geradas mensagens adicionais no log.'
+    '*db': 'Ligar/desligar modo debug. No modo debug serão geradas mensagens adicionais no log.',
+    '*met': 'Exibir métricas (quantidade, erros e tempo de resposta) das chamadas ao servidor SETEC3.'
 
 }
 
@@ -92,7 +93,7 @@ Gmenu_comandos['cmd_exibicao'] = ["*sg"]
 Gmenu_comandos['cmd_navegacao'] = ["+", "-"]
 Gmenu_comandos['cmd_item'] = ["*con", "*tst", "*alt", "*sto"]
 Gmenu_comandos['cmd_geral'] = ["*inc", "*qq"]
-Gmenu_comandos['cmd_diagnostico'] = ["*db", "*log"]
+Gmenu_comandos['cmd_diagnostico'] = ["*db", "*log", "*met"]
 
 # **********************************************************************
 # PRODUCAO DEPLOYMENT AJUSTAR
@@ -1071,9 +1072,11 @@ def validar_storage_id(conf_storage):
     unidade=obter_param_usuario('codigo_unidade_lotacao')
     storage_id=conf_storage['storage_id']
     print("- Verificando ser storage_id é válido. Aguarde...")
+    # A validação não pode se basear em resposta armazenada em cache
     (sucesso, msg_erro, resultado) = sapisrv_consultar_storage(
         storage_id=storage_id,
-        unidade=unidade)
+        unidade=unidade,
+        usar_cache=False)
     if not sucesso:
         print("- ERRO: ", msg_erro)
         return False
@@ -1218,6 +1221,9 @@ def main():
         elif (comando == '*log'):
             exibir_log(comando='*log', filtro_base='', filtro_usuario=argumento)
             continue
+        elif (comando == '*met'):
+            exibir_metricas_sapisrv()
+            continue
         elif (comando == '*inc'):
             if registrar_storage():
                 refresh_exibir_situacao()
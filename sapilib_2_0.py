@@ -74,11 +74,14 @@ Gwiki_instalar_python = "Sapi_instalar_python"
 import codecs
 import copy
 import datetime
+import errno
 import json
+import locale
 import os
 import pprint
 import sys
 import subprocess
+import multiprocessing
 import time
 import traceback
 import platform
@@ -103,6 +106,15 @@ import urllib.request
 import ssl
 import http.client
 import socket
+import select
+import threading
+import queue
+import hashlib
+import gzip
+import io
+import concurrent.futures
+import asyncio
+import atexit
 
 import shutil
 from optparse import OptionParser
@@ -267,6 +279,17 @@ Gconf_ambiente['prod'] = {
     'url_base_s3': 'https://setecpr.dpf.gov.br/setec3/',
     'url_base_siscrim': 'https://ditec.pf.gov.br/sistemas/criminalistica/'
 }
+# --- Local (servidor simulado: sapisrv_simulado.py) ---
+# Utilizado para testes de carga e testes dos agentes sem o SETEC3
+Gconf_ambiente['local'] = {
+    'nome_ambiente': 'LOCAL',
+    'servidor_protocolo': 'http',
+    'ips': ['127.0.0.1'],
+    'servidor_porta': 8088,
+    'servidor_sistema': 'setec3',
+    'url_base_s3': 'http://127.0.0.1:8088/setec3/',
+    'url_base_siscrim': 'http://127.0.0.1:8088/siscrim/'
+}
 
 # Definido durante inicializacao
 # --------------------------------
@@ -551,6 +574,113 @@ def obter_arquivo_data_modificacao(filename):
     return datetime.datetime.fromtimestamp(t)
 
 
+# Seguidor incremental de arquivo texto (similar ao tail -f)
+# ----------------------------------------------------------------------------------------------------------------------
+# Utilizado para acompanhar arquivos que crescem durante a execução (tela do IPED, logs, etc).
+# O seguidor guarda a posição (byte) já lida e a identificação do arquivo (inode),
+# de modo que cada leitura processa apenas as linhas novas, ao invés de reler o arquivo inteiro.
+# Se o arquivo for truncado (tamanho menor que a posição lida) ou substituído (rotação: inode diferente
+# ou início do arquivo diferente), a leitura recomeça do início do novo arquivo.
+#
+# Uso:
+#   seguidor = criar_seguidor_arquivo(caminho)
+#   for linha in ler_novas_linhas_seguidor(seguidor):
+#       ...
+# Tamanho do bloco de leitura do seguidor
+Gseguidor_tamanho_bloco = 1024 * 1024
+# Quantidade de bytes do início do arquivo utilizados para detectar substituição
+# (o inode pode ser reaproveitado ou ser sempre zero em compartilhamentos)
+Gseguidor_tamanho_assinatura = 64
+
+
+def criar_seguidor_arquivo(caminho, encoding=None):
+    # Codificação default é a mesma utilizada pelo open em modo texto
+    if encoding is None:
+        encoding = locale.getpreferredencoding(False)
+
+    seguidor = {
+        'caminho': caminho,
+        'encoding': encoding,
+        'posicao': 0,
+        'inode': None,
+        'dispositivo': None,
+        # Bytes iniciais do arquivo
+        'assinatura': b'',
+        # Quantidade de vezes que a leitura recomeçou do início (truncamento/rotação)
+        'reinicios': 0,
+        # Final de linha ainda não concluído (sem quebra de linha)
+        'pendente': b''
+    }
+    return seguidor
+
+
+# Reinicia a leitura do seguidor a partir do início do arquivo
+def _reiniciar_seguidor_arquivo(seguidor, motivo):
+    debug("Seguidor de arquivo", seguidor['caminho'], "reiniciado:", motivo)
+    seguidor['posicao'] = 0
+    seguidor['pendente'] = b''
+    seguidor['assinatura'] = b''
+    seguidor['reinicios'] += 1
+
+
+# Gerador que retorna as linhas acrescentadas ao arquivo desde a última leitura
+# As linhas são retornadas com a quebra de linha ('\n'), da mesma forma que na leitura de um arquivo texto
+# Uma linha incompleta (sem quebra de linha no final) só é retornada quando for concluída,
+# exceto se final=True (quando o arquivo não vai mais crescer, por exemplo, programa já finalizado)
+# Se o arquivo não existir, não retorna nenhuma linha
+def ler_novas_linhas_seguidor(seguidor, final=False):
+    caminho = seguidor['caminho']
+
+    try:
+        st = os.stat(caminho)
+    except OSError:
+        # Arquivo (ainda) não existe, ou temporariamente inacessível
+        return
+
+    # Arquivo foi substituído (rotação)
+    # Em alguns sistemas de arquivos (compartilhamentos) o inode é sempre zero. Neste caso, só detecta truncamento
+    if st.st_ino != 0 and seguidor['inode'] is not None:
+        if st.st_ino != seguidor['inode'] or st.st_dev != seguidor['dispositivo']:
+            _reiniciar_seguidor_arquivo(seguidor, "arquivo foi substituído")
+    seguidor['inode'] = st.st_ino
+    seguidor['dispositivo'] = st.st_dev
+
+    # Arquivo foi truncado
+    if st.st_size < seguidor['posicao']:
+        _reiniciar_seguidor_arquivo(seguidor, "arquivo foi truncado")
+
+    with open(caminho, "rb") as fentrada:
+        # Confere se o início do arquivo continua o mesmo
+        assinatura = fentrada.read(Gseguidor_tamanho_assinatura)
+        if not assinatura.startswith(seguidor['assinatura']):
+            _reiniciar_seguidor_arquivo(seguidor, "início do arquivo foi alterado")
+        seguidor['assinatura'] = assinatura
+
+        fentrada.seek(seguidor['posicao'])
+        while True:
+            bloco = fentrada.read(Gseguidor_tamanho_bloco)
+            if not bloco:
+                break
+            seguidor['posicao'] += len(bloco)
+
+            linhas = (seguidor['pendente'] + bloco).split(b'\n')
+            # O último elemento é o trecho após a última quebra de linha (linha incompleta)
+            seguidor['pendente'] = linhas.pop()
+            for linha in linhas:
+                yield _decodificar_linha_seguidor(seguidor, linha + b'\n')
+
+    if final and seguidor['pendente'] != b'':
+        linha = seguidor['pendente']
+        seguidor['pendente'] = b''
+        yield _decodificar_linha_seguidor(seguidor, linha)
+
+
+def _decodificar_linha_seguidor(seguidor, linha):
+    # Converte final de linha windows, como faz o open em modo texto
+    linha = linha.replace(b'\r\n', b'\n')
+    return linha.decode(seguidor['encoding'], errors='replace')
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 # Comunicação entre processos
 # ----------------------------------------------------------------------------------------------------------------------
@@ -569,6 +699,8 @@ def obter_dados_para_processo_filho():
     r['Gdic_storage']   =Gdic_storage
     r['Gparini']        =Gparini
     r['Gdados_laudo']   =Gdados_laudo
+    # Fila para envio das linhas de log para o pai
+    r['log_fila']       =_log_obter_fila_filhos()
 
     return r
 
@@ -578,10 +710,16 @@ def restaura_dados_no_processo_filho(r):
     global Gdic_storage
     global Gparini
     global Gdados_laudo
+    global Glog_fila_pai
 
     Gdic_storage    =r['Gdic_storage']
+    _invalidar_ajuste_texto_saida()
     Gparini         =r['Gparini']
     Gdados_laudo    =r['Gdados_laudo']
+
+    # A partir de agora, o log é enviado para o processo pai
+    log_descarregar()
+    Glog_fila_pai   =r.get('log_fila', None)
     return
 
 
@@ -649,6 +787,8 @@ def sapi_processar_parametros_usuario():
                           action="store", dest="logdir", help="Pasta onde será criado o arquivo de log. Pasta deve existir.")
         parser.add_option("--raiz_storage",
                           action="store", dest="raiz_storage", help="Pasta de raiz do storage (default E:/)")
+        parser.add_option("--logjson",
+                          action="store_true", dest="logjson", help="Grava o log no formato JSON lines (um registro por linha)")
 
         (options, args) = parser.parse_args()
         # print(options)
@@ -668,6 +808,9 @@ def sapi_processar_parametros_usuario():
         if options.logfile:
             set_parini('logfile', options.logfile)
 
+        if options.logjson:
+            set_parini('log_formato', 'jsonl')
+
         if options.raiz_storage:
             set_parini('raiz_storage', options.raiz_storage)
         else:
@@ -953,6 +1096,8 @@ def sapisrv_inicializar_ok(*args, **kwargs):
 
     except SapiExceptionVersaoDesatualizada:
         print_tela_log("- Efetue atualização do programa e execute novamente")
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(1)
 
     except SapiExceptionProgramaFoiAtualizado as e:
@@ -967,6 +1112,8 @@ def sapisrv_inicializar_ok(*args, **kwargs):
             print_tela_log("- Finalizando agora. ")
             pausa()
         # Encerra
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(1)
 
     except SapiExceptionProgramaDesautorizado as e:
@@ -978,19 +1125,27 @@ def sapisrv_inicializar_ok(*args, **kwargs):
             print_tela_log(mensagem)
             pausa()
         # Encerra
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(1)
 
 
     except SapiExceptionFalhaComunicacao as e:
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(1)
 
     except SapiExceptionAgenteDesautorizado as e:
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(1)
 
 
     except SystemExit as e:
         # Se programa solicitou encerramento através de system.Exit, simplesmente encerra
         print_log("Programa solicitou encerramento (SystemExit): " + str(e))
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(1)
 
     except BaseException as e:
@@ -999,6 +1154,8 @@ def sapisrv_inicializar_ok(*args, **kwargs):
         print_log("[314]: Exceção abaixo sem tratamento específico. Avaliar se deve ser tratada ou se é realmente um erro de programação")
         print_log(trc_string)
         print("[700] Erro inesperado. Para mais detalhes, consulte arquivo de log: ",obter_nome_arquivo_log())
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(1)
 
 
@@ -1135,6 +1292,7 @@ def sapisrv_registrar_configuracao_cliente(
     # Registra em log
     if sucesso:
         print_log("Registrada configuração com sucesso")
+        sapisrv_invalidar_cache("sapisrv_obter_configuracao_agente.php")
     else:
         # Se der erro, registra no log e prossegue (tolerância a falhas)
         print_log("Não foi possível registrar a configuração no SETEC3: ", msg_erro)
@@ -1174,6 +1332,8 @@ def sapisrv_registrar_storage(
     # Registra em log
     if sucesso:
         print_log("Registrada configuração do storage com sucesso")
+        sapisrv_invalidar_cache("sapisrv_consultar_storage.php")
+        sapisrv_invalidar_cache("sapisrv_obter_lista_storage.php")
     else:
         # Se der erro, registra no log e prossegue (tolerância a falhas)
         print_log("Não foi possível registrar a configuração do storage no SETEC3: ", msg_erro)
@@ -1184,9 +1344,11 @@ def sapisrv_registrar_storage(
 
 # Consulta storage
 # ----------------------------------------------------------------------------------------------------------------------
+# usar_cache=False: Consulta sempre o servidor (ex: validação antes de registrar um storage)
 def sapisrv_consultar_storage(
         storage_id,
-        unidade):
+        unidade,
+        usar_cache=True):
 
     # Lista de parâmetros
     param = dict()
@@ -1195,9 +1357,10 @@ def sapisrv_consultar_storage(
 
     try:
         # Invoca sapi_srv
-        (sucesso, msg_erro, resultado) = sapisrv_chamar_programa(
+        (sucesso, msg_erro, resultado) = sapisrv_chamar_programa_cache(
             programa="sapisrv_consultar_storage.php",
             parametros=param,
+            validade=None if usar_cache else 0,
             registrar_log=False,
             metodo='get'
         )
@@ -1220,9 +1383,11 @@ def sapisrv_consultar_storage(
 # Parâmetros:
 #   programa: Nome do programa
 #   ip (opcional): IP da máquina
+#   usar_cache: Se False, consulta sempre o servidor
 def sapisrv_obter_configuracao_agente(
         programa,
-        ip=None
+        ip=None,
+        usar_cache=True
 ):
     # Lista de parâmetros
     param = dict()
@@ -1231,9 +1396,10 @@ def sapisrv_obter_configuracao_agente(
         param['ip'] = ip
 
     # Invoca sapi_srv
-    (sucesso, msg_erro, configuracao) = sapisrv_chamar_programa(
+    (sucesso, msg_erro, configuracao) = sapisrv_chamar_programa_cache(
         programa="sapisrv_obter_configuracao_agente.php",
         parametros=param,
+        validade=None if usar_cache else 0,
         abortar_insucesso=False,
         registrar_log=True
     )
@@ -1252,6 +1418,12 @@ def sapisrv_obter_configuracao_agente(
     return configuracao
 
 
+# Espera por tarefa (long-poll). Ver sapisrv_aguardar_tarefa
+Gaguardar_tarefa_suportado = True
+Gaguardar_tarefa_intervalo_minimo = 5
+Gaguardar_tarefa_ultima_chamada = 0
+
+
 # Obtem e inicia (atômico) uma tarefa de um certo tipo (iped-ocr, ief, etc)
 # Parâmetros opcionais:
 #  storage: Quando o agente tem conexão limitada (apenas um storage)
@@ -1376,6 +1548,74 @@ def sapisrv_obter_iniciar_tarefa(
     #         # Retornou uma tarefa para processamento
     #         return (True, resultado["tarefa"])
 
+
+# Aguarda (long-poll) até que exista tarefa disponível de algum dos tipos indicados
+# O servidor mantém a requisição aberta até que surja uma tarefa (retornando imediatamente)
+# ou até que o tempo de espera se esgote.
+# Não obtém a tarefa: Ao retornar True, o chamador deve solicitar a tarefa normalmente
+# (sapisrv_obter_iniciar_tarefa / sapisrv_obter_excluir_tarefa), pois outro agente pode ter sido mais rápido.
+# Se o servidor não suportar a espera (versão anterior) ou houver falha de comunicação,
+# simplesmente dorme pelo tempo de espera (comportamento anterior) e retorna True.
+# Retorna:
+#  True: Existe (ou pode existir) tarefa disponível
+#  False: Tempo de espera esgotado, sem tarefa
+# ----------------------------------------------------------------------------------------------------------------------
+def sapisrv_aguardar_tarefa(lista_tipos, unidade, storage=None, espera=60):
+    global Gaguardar_tarefa_suportado
+    global Gaguardar_tarefa_ultima_chamada
+
+    if not Gaguardar_tarefa_suportado:
+        dormir(espera, "Servidor sem suporte para aguardar tarefa")
+        return True
+
+    # Intervalo mínimo entre chamadas, para o caso do servidor retornar imediatamente de forma repetida
+    decorrido = time.time() - Gaguardar_tarefa_ultima_chamada
+    if decorrido < Gaguardar_tarefa_intervalo_minimo:
+        time.sleep(Gaguardar_tarefa_intervalo_minimo - decorrido)
+    Gaguardar_tarefa_ultima_chamada = time.time()
+
+    param = dict()
+    param['tipos'] = ",".join(lista_tipos)
+    param['unidade'] = unidade
+    if storage is not None:
+        param['storage'] = storage
+    param['espera'] = espera
+    _sapisrv_adicionar_parametros_execucao(param)
+
+    print_log("Aguardando tarefa (até", espera, "segundos) com tipos=[" + param['tipos'] + "]")
+    try:
+        # O timeout da requisição tem que comportar a espera no servidor
+        (status, resultado) = http_pool_requisicao("GET",
+                                                   sapisrv_montar_url("sapisrv_aguardar_tarefa.php", param),
+                                                   timeout=espera + Ghttp_timeout_padrao)
+        if status == 404:
+            print_log("Servidor não possui sapisrv_aguardar_tarefa.php. Passando a aguardar com pausa fixa")
+            Gaguardar_tarefa_suportado = False
+            dormir(espera)
+            return True
+
+        retorno = json.loads(resultado.decode('utf-8'))
+
+        if retorno.get("sucesso", "0") != "1":
+            print_log("Erro ao aguardar tarefa: ", retorno.get("msg_erro", ""))
+            dormir(espera, "Presumindo erro intermitente")
+            return True
+
+        # Resposta de sucesso sem dados (ou com formato inesperado) é tratada como erro
+        disponivel = int(retorno["dados"]["disponivel"])
+    except BaseException as e:
+        print_log("Falha ao aguardar tarefa: ", e)
+        dormir(espera, "Presumindo erro intermitente")
+        return True
+
+    if disponivel == 1:
+        print_log("Servidor sinalizou tarefa disponível")
+        return True
+
+    debug("Tempo de espera por tarefa esgotado")
+    return False
+
+
 # Obtem uma tarefa para excluir
 # Parâmetros opcionais:
 #  storage: Quando o agente tem conexão limitada (apenas um storage)
@@ -1554,6 +1794,150 @@ def sapisrv_atualizar_status_tarefa_informativo(
     return True
 
 
+# ---------------------------------------------------------------------------------------------------------------------
+# Fila de atualização de status informativo
+# ---------------------------------------------------------------------------------------------------------------------
+# Os loops de acompanhamento (cópia, IPED, tableau, etc) atualizam o status informativo periodicamente.
+# Ao invés de chamar o servidor imediatamente (bloqueando o loop de acompanhamento),
+# o status é colocado em uma fila, que é enviada em lote por uma única thread a cada Gfila_status_intervalo segundos.
+# Para uma mesma tarefa, apenas o último status da fila é enviado.
+# Se o servidor não possuir o programa de atualização em lote, cada status é atualizado individualmente.
+
+# Intervalo (segundos) entre os envios da fila
+Gfila_status_intervalo = 15
+# codigo_tarefa => status mais recente ainda não enviado
+Gfila_status = dict()
+Gfila_status_lock = threading.Lock()
+# Mantido durante todo o envio da fila (retirada dos itens e chamada ao servidor)
+# A troca de situação aguarda o envio em andamento, para que um status antigo já retirado da fila
+# não chegue ao servidor depois da nova situação
+Gfila_status_envio_lock = threading.Lock()
+Gfila_status_thread = None
+# Se o servidor não suportar atualização em lote, passa a enviar individualmente
+Gfila_status_lote_suportado = True
+
+
+# Coloca o status informativo da tarefa na fila de envio
+# Substitui o status ainda não enviado da mesma tarefa (apenas o último interessa)
+def sapisrv_atualizar_status_tarefa_fila(
+        codigo_tarefa,
+        texto_status,
+        tamanho_destino_bytes = None):
+    global Gfila_status_thread
+
+    with Gfila_status_lock:
+        Gfila_status[str(codigo_tarefa)] = {
+            'codigo_tarefa': codigo_tarefa,
+            'status': texto_status,
+            'tamanho_destino_bytes': tamanho_destino_bytes
+        }
+
+        # Inicia a thread de envio, se ainda não estiver rodando neste processo
+        if Gfila_status_thread is None or not Gfila_status_thread.is_alive():
+            Gfila_status_thread = threading.Thread(target=_fila_status_enviar_periodicamente,
+                                                   name="sapi_fila_status")
+            Gfila_status_thread.daemon = True
+            Gfila_status_thread.start()
+
+    return True
+
+
+# Descarta o status pendente de uma tarefa
+# Utilizado quando a situação da tarefa é trocada, para que um status antigo não seja enviado depois
+# Se houver envio em andamento, aguarda a sua conclusão (o status da tarefa pode estar sendo enviado)
+# A fila é própria de cada processo: a troca de situação descarta apenas a fila do processo que a efetua.
+# Um processo de acompanhamento (que tem sua própria fila) deve invocar esta função quando detectar
+# que a situação da tarefa foi trocada (por outro processo), antes de descarregar a sua fila
+def sapisrv_descartar_status_tarefa_fila(codigo_tarefa):
+    with Gfila_status_envio_lock:
+        with Gfila_status_lock:
+            Gfila_status.pop(str(codigo_tarefa), None)
+
+
+# Thread de envio da fila
+def _fila_status_enviar_periodicamente():
+    while True:
+        time.sleep(Gfila_status_intervalo)
+        sapisrv_descarregar_fila_status()
+
+
+# Envia imediatamente todos os status pendentes da fila
+# Deve ser chamado antes do encerramento de um processo de acompanhamento (os._exit não aguarda a thread de envio)
+# Retorna True se todos os status foram enviados
+def sapisrv_descarregar_fila_status():
+    with Gfila_status_envio_lock:
+        return _descarregar_fila_status()
+
+
+def _descarregar_fila_status():
+    global Gfila_status_lote_suportado
+
+    with Gfila_status_lock:
+        itens = list(Gfila_status.values())
+        Gfila_status.clear()
+
+    if len(itens) == 0:
+        return True
+
+    # Ajusta texto (ip=>netbios), da mesma forma que na atualização individual
+    for item in itens:
+        item['status'] = ajusta_texto_saida(item['status'])
+
+    if Gfila_status_lote_suportado:
+        try:
+            sucesso = _sapisrv_atualizar_status_lote(itens)
+            if sucesso is not None:
+                return sucesso
+            print_log("Servidor não possui atualização de status em lote. Status serão atualizados individualmente")
+            Gfila_status_lote_suportado = False
+        except BaseException as e:
+            # O status é apenas informativo. Ignora
+            print_log("Ignorando atualização de status em lote devido a erro:", str(e))
+            return False
+
+    # Atualização individual
+    sucesso = True
+    for item in itens:
+        if not sapisrv_atualizar_status_tarefa_informativo(
+                codigo_tarefa=item['codigo_tarefa'],
+                texto_status=item['status'],
+                tamanho_destino_bytes=item['tamanho_destino_bytes']):
+            sucesso = False
+
+    return sucesso
+
+
+# Atualiza o status informativo de diversas tarefas em uma única chamada ao servidor
+# O servidor atualiza apenas as tarefas que ainda estão em execução
+# Retorna:
+#  - True/False: Sucesso ou não da atualização
+#  - None: O servidor não possui o programa de atualização em lote
+def _sapisrv_atualizar_status_lote(itens):
+
+    programa = "sapisrv_atualizar_status_lote.php"
+    param = {'lote_json': json.dumps(itens, sort_keys=True)}
+    _sapisrv_adicionar_parametros_execucao(param)
+
+    headers = {"Content-type": "application/x-www-form-urlencoded",
+               "Accept": "text/plain"}
+    (status, resultado) = http_pool_requisicao("POST",
+                                               _sapisrv_montar_url_post(programa),
+                                               urllib.parse.urlencode(param),
+                                               headers)
+    if status == 404:
+        return None
+
+    retorno = json.loads(resultado.decode('utf-8'))
+    if retorno["sucesso"] != "1":
+        print_log("Atualização de status em lote falhou: ", retorno["msg_erro"])
+        return False
+
+    for item in itens:
+        print_log("Tarefa ", item['codigo_tarefa'], ": atualizado status (lote): ", item['status'])
+
+    return True
+
+
 # Troca situação da tarefa
 # Este é uma operação crítica, que tem que ser realizada no momento correto
 # Se ocorrer um erro, repassa para o chamador decidir
@@ -1564,6 +1948,10 @@ def sapisrv_troca_situacao_tarefa_obrigatorio(
         dados_relevantes=None,
         tamanho_destino_bytes = None):
 
+    # Status informativo ainda na fila ficou obsoleto
+    # (se estiver sendo enviado, aguarda o envio, que assim chega ao servidor antes da nova situação)
+    sapisrv_descartar_status_tarefa_fila(codigo_tarefa)
+
     # Se ocorrer alguma exceção aqui, simplesmente será repassada para o chamador,
     # que deverá tratar adequadamente
     (ok, msg_erro) = _sapisrv_atualizar_status_tarefa(
@@ -1686,24 +2074,33 @@ def sapisrv_excluir_tarefa_loop(codigo_tarefa):
 
 
 # Atualiza status da tarefa do sapisrv
+# Textos grandes são enviados comprimidos e em partes (ver _sapisrv_armazenar_texto_partes)
 # ----------------------------------------------------------------------------------------------------------------------
 def sapisrv_armazenar_texto(tipo_objeto, codigo_objeto, titulo, conteudo, registrar_log=False):
-    # Parâmetros
-    param = {'tipo_objeto': tipo_objeto,
-             'codigo_objeto': codigo_objeto,
-             'titulo': titulo,
-             'conteudo': conteudo
-             }
 
-    metodo_invocar = 'post'
+    resultado = None
+    if Garmazenar_texto_partes_suportado and len(conteudo) >= Garmazenar_texto_tamanho_minimo_partes:
+        resultado = _sapisrv_armazenar_texto_partes(tipo_objeto, codigo_objeto, titulo, _comprimir_texto(conteudo))
 
-    # Invoca sapi_srv
-    (sucesso, msg_erro, resultado) = sapisrv_chamar_programa(
-        programa="sapisrv_armazenar_texto.php",
-        parametros=param,
-        registrar_log=registrar_log,
-        metodo=metodo_invocar
-    )
+    if resultado is not None:
+        (sucesso, msg_erro) = resultado
+    else:
+        # Parâmetros
+        param = {'tipo_objeto': tipo_objeto,
+                 'codigo_objeto': codigo_objeto,
+                 'titulo': titulo,
+                 'conteudo': conteudo
+                 }
+
+        metodo_invocar = 'post'
+
+        # Invoca sapi_srv
+        (sucesso, msg_erro, resultado) = sapisrv_chamar_programa(
+            programa="sapisrv_armazenar_texto.php",
+            parametros=param,
+            registrar_log=registrar_log,
+            metodo=metodo_invocar
+        )
 
     # Registra em log
     if registrar_log:
@@ -1717,15 +2114,153 @@ def sapisrv_armazenar_texto(tipo_objeto, codigo_objeto, titulo, conteudo, regist
     return (sucesso, msg_erro)
 
 
-# Invoca Sapi server (sapisrv)
+# Armazena no servidor o texto de um arquivo (ex: log do IPED)
+# O arquivo é lido linha a linha e comprimido em arquivo temporário, sem carregar todo o texto em memória
 # ----------------------------------------------------------------------------------------------------------------------
-def sapisrv_chamar_programa(programa,
-                            parametros,
-                            abortar_insucesso=False,
-                            registrar_log=False,
-                            metodo='get',
-                            resposta_json=True):
-    # Adiciona o token aos parâmetros
+def sapisrv_armazenar_texto_arquivo(tipo_objeto, codigo_objeto, titulo, caminho_arquivo, registrar_log=False):
+
+    if Garmazenar_texto_partes_suportado and os.path.getsize(caminho_arquivo) >= Garmazenar_texto_tamanho_minimo_partes:
+        with _comprimir_arquivo_texto(caminho_arquivo) as arquivo_gz:
+            resultado = _sapisrv_armazenar_texto_partes(tipo_objeto, codigo_objeto, titulo, arquivo_gz)
+        if resultado is not None:
+            return resultado
+
+    # Arquivo pequeno (ou servidor sem envio em partes): Envia o texto inteiro
+    # Pode haver algo no arquivo que não é UTF8 (ex: log do IPED)
+    with open(caminho_arquivo, "r", errors="replace") as fentrada:
+        conteudo = fentrada.read()
+
+    return sapisrv_armazenar_texto(tipo_objeto, codigo_objeto, titulo, conteudo, registrar_log=registrar_log)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Envio de texto comprimido e em partes
+# ----------------------------------------------------------------------------------------------------------------------
+# Textos grandes são comprimidos (gzip) e enviados em partes para sapisrv_armazenar_texto_parte.php.
+# Cada parte vai no corpo do POST em binário (sem a codificação de formulário, que infla o texto), e a url indica
+# o envio (id_envio), o tamanho total comprimido e o deslocamento da parte.
+# O servidor acumula as partes e responde quanto já recebeu ('recebido'). Ao completar o tamanho total,
+# descomprime e armazena o texto ('concluido'=1).
+# O id_envio é derivado do conteúdo comprimido: Se o envio for interrompido (ex: queda do link),
+# uma nova tentativa do mesmo texto continua a partir do que o servidor já recebeu.
+# Servidores sem sapisrv_armazenar_texto_parte.php recebem o texto inteiro via sapisrv_armazenar_texto.php
+Garmazenar_texto_partes_suportado = True
+# Textos menores do que isto são enviados em uma única chamada
+Garmazenar_texto_tamanho_minimo_partes = 256 * 1024
+# Tamanho de cada parte (bytes comprimidos)
+Garmazenar_texto_tamanho_parte = 1024 * 1024
+# Falhas consecutivas no envio de uma parte antes de desistir (o próximo envio retoma de onde parou)
+Garmazenar_texto_tentativas_parte = 3
+
+
+# Comprime texto em memória
+# O mtime fixo faz com que o mesmo texto resulte sempre no mesmo conteúdo comprimido (e no mesmo id_envio)
+def _comprimir_texto(conteudo):
+    arquivo_gz = io.BytesIO()
+    with gzip.GzipFile(fileobj=arquivo_gz, mode='wb', mtime=0) as gz:
+        gz.write(conteudo.encode('utf-8'))
+    arquivo_gz.seek(0)
+    return arquivo_gz
+
+
+# Comprime o texto de um arquivo em arquivo temporário (excluído ao ser fechado)
+def _comprimir_arquivo_texto(caminho_arquivo):
+    arquivo_gz = tempfile.TemporaryFile()
+    with gzip.GzipFile(fileobj=arquivo_gz, mode='wb', mtime=0) as gz:
+        # Pode haver algo no arquivo que não é UTF8 (ex: log do IPED)
+        with open(caminho_arquivo, "r", errors="replace") as fentrada:
+            for linha in fentrada:
+                gz.write(linha.encode('utf-8'))
+    arquivo_gz.seek(0)
+    return arquivo_gz
+
+
+# Identifica o envio: (id_envio, tamanho comprimido)
+def _identificar_envio_texto(tipo_objeto, codigo_objeto, titulo, arquivo_gz):
+    h = hashlib.sha1()
+    h.update((str(tipo_objeto) + "|" + str(codigo_objeto) + "|" + titulo + "|").encode('utf-8'))
+    tamanho = 0
+    for bloco in iter(lambda: arquivo_gz.read(Garmazenar_texto_tamanho_parte), b''):
+        h.update(bloco)
+        tamanho += len(bloco)
+    arquivo_gz.seek(0)
+    return (h.hexdigest(), tamanho)
+
+
+# Envia uma parte do texto comprimido
+# Retorna os dados da resposta {recebido, concluido}, ou None se o servidor não possui o programa
+def _sapisrv_enviar_parte_texto(param, deslocamento, parte):
+    param = dict(param)
+    param['deslocamento'] = deslocamento
+    _sapisrv_adicionar_parametros_execucao(param)
+
+    url = _sapisrv_montar_url_post("sapisrv_armazenar_texto_parte.php") + "?" + urllib.parse.urlencode(param)
+    headers = {"Content-type": "application/octet-stream",
+               "Accept": "text/plain"}
+    (status, resultado) = http_pool_requisicao("POST", url, parte, headers)
+    if status == 404:
+        return None
+    if status >= 400:
+        raise http.client.HTTPException("HTTP Error " + str(status))
+
+    retorno = json.loads(resultado.decode('utf-8'))
+    if retorno["sucesso"] != "1":
+        raise SapiExceptionGeral(retorno["msg_erro"])
+
+    return retorno["dados"]
+
+
+# Envia texto comprimido (arquivo_gz) em partes
+# Retorna (sucesso, msg_erro), ou None se o servidor não suporta o envio em partes
+def _sapisrv_armazenar_texto_partes(tipo_objeto, codigo_objeto, titulo, arquivo_gz):
+    global Garmazenar_texto_partes_suportado
+
+    (id_envio, tamanho_total) = _identificar_envio_texto(tipo_objeto, codigo_objeto, titulo, arquivo_gz)
+    param = {'tipo_objeto': tipo_objeto,
+             'codigo_objeto': codigo_objeto,
+             'titulo': titulo,
+             'id_envio': id_envio,
+             'tamanho_total': tamanho_total
+             }
+
+    # A primeira chamada vai sem conteúdo, apenas para saber quanto o servidor já recebeu deste envio
+    deslocamento = 0
+    parte = b''
+    falhas = 0
+    quantidade_partes = 0
+    while True:
+        try:
+            dados = _sapisrv_enviar_parte_texto(param, deslocamento, parte)
+        except Exception as e:
+            falhas += 1
+            print_log("Falha no envio de parte do texto [", titulo, "] no deslocamento", deslocamento, ":", e)
+            if falhas >= Garmazenar_texto_tentativas_parte:
+                return (False, str(e))
+            time.sleep(5)
+            continue
+
+        if dados is None:
+            print_log("Servidor não possui sapisrv_armazenar_texto_parte.php. Textos serão enviados em uma única chamada")
+            Garmazenar_texto_partes_suportado = False
+            return None
+
+        falhas = 0
+        if int(dados['concluido']) == 1:
+            print_log("Texto [", titulo, "] enviado: ", tamanho_total, "bytes comprimidos em", quantidade_partes, "partes")
+            return (True, "")
+
+        # Próxima parte, a partir do que o servidor efetivamente recebeu
+        if deslocamento == 0 and len(parte) == 0 and int(dados['recebido']) > 0:
+            print_log("Retomando envio do texto [", titulo, "] a partir de", dados['recebido'], "bytes")
+        deslocamento = int(dados['recebido'])
+        arquivo_gz.seek(deslocamento)
+        parte = arquivo_gz.read(Garmazenar_texto_tamanho_parte)
+        quantidade_partes += 1
+
+
+# Adiciona aos parâmetros da chamada a identificação do programa em execução e o token
+# ----------------------------------------------------------------------------------------------------------------------
+def _sapisrv_adicionar_parametros_execucao(parametros):
     # Por equanto, vamos utilizar como token a versão da sapilib
     # Posteriormente, quando houver validação do software, substituir por algo mais elaborado
     parametros['execucao_nome_agente'] = _obter_parini_obrigatorio('nome_agente')
@@ -1738,6 +2273,20 @@ def sapisrv_chamar_programa(programa,
         parametros['conta_usuario'] = Gusuario_autenticado.get('conta_usuario', None)
         parametros['tkcred'] = Gusuario_autenticado.get('tkcred', None)
 
+    return parametros
+
+
+# Invoca Sapi server (sapisrv)
+# ----------------------------------------------------------------------------------------------------------------------
+def sapisrv_chamar_programa(programa,
+                            parametros,
+                            abortar_insucesso=False,
+                            registrar_log=False,
+                            metodo='get',
+                            resposta_json=True):
+    # Adiciona o token aos parâmetros
+    _sapisrv_adicionar_parametros_execucao(parametros)
+
     try:
         if metodo == 'get':
             return _sapisrv_chamar_programa_get(
@@ -1807,6 +2356,213 @@ def sapisrv_chamar_programa_sucesso_ok(programa,
 
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+# Cache de consultas ao servidor (sapisrv)
+# ----------------------------------------------------------------------------------------------------------------------
+# Dados de referência que mudam raramente (lista de storages, perfis do IPED, configuração do agente)
+# são mantidos em cache, evitando consultar o servidor a cada ciclo de inicialização dos agentes.
+# A chave do cache é formada pelo servidor, programa e parâmetros da chamada.
+# O cache é gravado em arquivo local, de modo que um agente reiniciado já parte com o cache preenchido.
+# Entradas que contêm credenciais (ex: storage, com usuário/senha de conexão) são mantidas apenas em memória.
+
+# Configuração por programa do servidor: (validade em segundos, persistir em arquivo)
+Gcache_sapisrv_configuracao = {
+    'sapisrv_obter_lista_storage.php': (3600, False),
+    'sapisrv_consultar_storage.php': (3600, False),
+    'sapisrv_obter_lista_perfil_iped.php': (3600, True),
+    'sapisrv_obter_configuracao_agente.php': (600, True)
+}
+# Entradas: chave => {'programa', 'momento', 'resposta'}
+Gcache_sapisrv = dict()
+Gcache_sapisrv_carregado = False
+Gcache_sapisrv_lock = threading.Lock()
+
+
+# Arquivo local de persistência do cache (um por programa cliente)
+def _cache_sapisrv_arquivo():
+    return os.path.join(tempfile.gettempdir(),
+                        "sapi_cache_" + get_parini(chave='programa', default='sapi') + ".json")
+
+
+# Monta chave do cache. Os parâmetros de execução (token, versão, etc) não fazem parte da chave
+def _cache_sapisrv_chave(programa, parametros):
+    return get_parini('url_base', '') + programa + "?" + json.dumps(parametros, sort_keys=True)
+
+
+# Carrega o cache persistido, na primeira utilização
+def _cache_sapisrv_carregar():
+    global Gcache_sapisrv_carregado
+
+    if Gcache_sapisrv_carregado:
+        return
+    Gcache_sapisrv_carregado = True
+
+    arquivo = _cache_sapisrv_arquivo()
+    if not os.path.isfile(arquivo):
+        return
+
+    try:
+        with codecs.open(arquivo, 'r', "utf-8") as f:
+            Gcache_sapisrv.update(json.load(f))
+        debug("Cache de consultas carregado de", arquivo, ":", len(Gcache_sapisrv), "entradas")
+    except (OSError, ValueError) as e:
+        # Cache é apenas uma otimização. Se estiver corrompido, será recriado
+        debug("Cache de consultas em", arquivo, "ignorado:", e)
+
+
+# Grava as entradas persistentes do cache
+def _cache_sapisrv_gravar():
+    persistir = dict()
+    for chave in Gcache_sapisrv:
+        entrada = Gcache_sapisrv[chave]
+        if Gcache_sapisrv_configuracao.get(entrada['programa'], (0, False))[1]:
+            persistir[chave] = entrada
+
+    arquivo = _cache_sapisrv_arquivo()
+    try:
+        # Grava em temporário e renomeia, para não deixar arquivo truncado
+        temporario = arquivo + "." + str(os.getpid()) + ".tmp"
+        with codecs.open(temporario, 'w', "utf-8") as f:
+            json.dump(persistir, f, sort_keys=True)
+        os.replace(temporario, arquivo)
+    except OSError as e:
+        debug("Gravação do cache de consultas em", arquivo, "falhou:", e)
+
+
+# Invoca Sapi server (sapisrv) através do cache
+# Enquanto a resposta armazenada estiver válida (ver Gcache_sapisrv_configuracao), retorna a resposta armazenada.
+# Caso contrário, consulta o servidor e armazena a resposta, se a chamada tiver sucesso.
+# Se o servidor não puder ser consultado, retorna a resposta armazenada, mesmo que vencida.
+# Aceita os mesmos parâmetros de sapisrv_chamar_programa, e retorna (sucesso, msg_erro, dados)
+# ----------------------------------------------------------------------------------------------------------------------
+def sapisrv_chamar_programa_cache(programa, parametros, validade=None, **kwargs):
+
+    if validade is None:
+        validade = Gcache_sapisrv_configuracao.get(programa, (0, False))[0]
+
+    chave = _cache_sapisrv_chave(programa, parametros)
+
+    with Gcache_sapisrv_lock:
+        _cache_sapisrv_carregar()
+        entrada = Gcache_sapisrv.get(chave, None)
+
+    if entrada is not None and time.time() - entrada['momento'] < validade:
+        debug("Resposta de", programa, "obtida do cache")
+        return copy.deepcopy(tuple(entrada['resposta']))
+
+    try:
+        (sucesso, msg_erro, dados) = sapisrv_chamar_programa(programa, parametros, **kwargs)
+    except BaseException as e:
+        if entrada is None:
+            raise
+        print_log("Consulta a", programa, "falhou (", str(e), "). Utilizando resposta armazenada em cache")
+        return copy.deepcopy(tuple(entrada['resposta']))
+
+    if sucesso:
+        with Gcache_sapisrv_lock:
+            Gcache_sapisrv[chave] = {
+                'programa': programa,
+                'momento': time.time(),
+                'resposta': [sucesso, msg_erro, copy.deepcopy(dados)]
+            }
+            if Gcache_sapisrv_configuracao.get(programa, (0, False))[1]:
+                _cache_sapisrv_gravar()
+
+    return (sucesso, msg_erro, dados)
+
+
+# Descarta entradas do cache de consultas
+# programa: Se informado, descarta apenas as entradas do programa (ex: 'sapisrv_obter_lista_storage.php')
+# ----------------------------------------------------------------------------------------------------------------------
+def sapisrv_invalidar_cache(programa=None):
+
+    with Gcache_sapisrv_lock:
+        _cache_sapisrv_carregar()
+        for chave in list(Gcache_sapisrv.keys()):
+            if programa is None or Gcache_sapisrv[chave]['programa'] == programa:
+                del Gcache_sapisrv[chave]
+        _cache_sapisrv_gravar()
+
+    debug("Cache de consultas invalidado:", programa if programa is not None else "todos")
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Chamadas concorrentes ao servidor (asyncio)
+# ----------------------------------------------------------------------------------------------------------------------
+# Permite disparar várias consultas ao servidor simultaneamente, em vez de uma após a outra.
+# As chamadas são executadas pelas funções bloqueantes de sempre (sapisrv_chamar_programa e afins),
+# em um pool de threads limitado a Gsapisrv_async_maximo_simultaneas, reaproveitando o pool de conexões http.
+# Exemplo:
+#   resultados = sapisrv_gather([sapisrv_chamar_programa_async("sapisrv_obter_tarefas.php", {'item': i})
+#                                for i in lista_itens])
+# Cada resultado segue o contrato de sapisrv_chamar_programa: (sucesso, msg_erro, dados)
+
+# Coincide com o máximo de conexões simultâneas do pool http (Ghttp_pool_maximo_conexoes)
+Gsapisrv_async_maximo_simultaneas = 4
+Gsapisrv_async_executor = None
+Gsapisrv_async_pid = None
+
+
+# Pool de threads para execução das chamadas (recriado se estiver em outro processo)
+def _sapisrv_async_obter_executor():
+    global Gsapisrv_async_executor
+    global Gsapisrv_async_pid
+
+    if Gsapisrv_async_executor is None or Gsapisrv_async_pid != os.getpid():
+        Gsapisrv_async_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=Gsapisrv_async_maximo_simultaneas)
+        Gsapisrv_async_pid = os.getpid()
+
+    return Gsapisrv_async_executor
+
+
+# Executa uma função bloqueante da sapilib no pool, sem bloquear o loop de eventos
+async def executar_async(funcao, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_sapisrv_async_obter_executor(), lambda: funcao(*args, **kwargs))
+
+
+# Versão assíncrona de sapisrv_chamar_programa. Retorna (sucesso, msg_erro, dados)
+# ----------------------------------------------------------------------------------------------------------------------
+async def sapisrv_chamar_programa_async(programa, parametros, **kwargs):
+    return await executar_async(sapisrv_chamar_programa, programa, dict(parametros), **kwargs)
+
+
+# Versão assíncrona de sapisrv_chamar_programa_sucesso_ok. Retorna dados
+# ----------------------------------------------------------------------------------------------------------------------
+async def sapisrv_chamar_programa_sucesso_ok_async(programa, parametros, registrar_log=False):
+    return await executar_async(sapisrv_chamar_programa_sucesso_ok, programa, dict(parametros),
+                                registrar_log=registrar_log)
+
+
+# Aguarda a conclusão de um conjunto de chamadas assíncronas, retornando os resultados na mesma ordem
+# Para ser utilizado no código síncrono (console dos programas)
+# Se alguma chamada gerar exceção, a exceção é repassada, após a conclusão das demais
+# ----------------------------------------------------------------------------------------------------------------------
+def sapisrv_gather(lista_chamadas):
+
+    lista_chamadas = list(lista_chamadas)
+    if len(lista_chamadas) == 0:
+        return list()
+
+    async def _aguardar():
+        return await asyncio.gather(*lista_chamadas, return_exceptions=True)
+
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        resultados = loop.run_until_complete(_aguardar())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    for r in resultados:
+        if isinstance(r, BaseException):
+            raise r
+
+    return resultados
+
+
 # Aborta tarefa.
 # Retorna False sempre, para repassar para cima
 def sapisrv_abortar_tarefa(codigo_tarefa, texto_status):
@@ -1839,12 +2595,35 @@ def sapisrv_armazenar_texto_tarefa(codigo_tarefa, titulo, conteudo):
     # Se a atualização falhar, fica tentando até conseguir
     # Se for problema transiente, vai resolver
     # Caso contrário, algum humano irá mais cedo ou mais tarde intervir
-    while not sapisrv_armazenar_texto(tipo_objeto='tarefa',
-                                      codigo_objeto=codigo_tarefa,
-                                      titulo=titulo,
-                                      conteudo=conteudo
-                                      ):
-        print_log("Falhou upload de texto para tarefa [", codigo_tarefa, "]. Tentando novamente")
+    _armazenar_texto_tarefa_loop(sapisrv_armazenar_texto,
+                                 tipo_objeto='tarefa',
+                                 codigo_objeto=codigo_tarefa,
+                                 titulo=titulo,
+                                 conteudo=conteudo)
+
+
+# Atualiza no servidor o texto de um arquivo (ex: log do IPED)
+# Fica em loop até conseguir. Um envio interrompido é retomado de onde parou
+def sapisrv_armazenar_texto_arquivo_tarefa(codigo_tarefa, titulo, caminho_arquivo):
+    _armazenar_texto_tarefa_loop(sapisrv_armazenar_texto_arquivo,
+                                 tipo_objeto='tarefa',
+                                 codigo_objeto=codigo_tarefa,
+                                 titulo=titulo,
+                                 caminho_arquivo=caminho_arquivo)
+
+
+# Repete o upload (funcao) até conseguir, com pausa entre as tentativas
+def _armazenar_texto_tarefa_loop(funcao, **kwargs):
+    codigo_tarefa = kwargs['codigo_objeto']
+    titulo = kwargs['titulo']
+    while True:
+        try:
+            (sucesso, msg_erro) = funcao(**kwargs)
+        except Exception as e:
+            (sucesso, msg_erro) = (False, str(e))
+        if sucesso:
+            break
+        print_log("Falhou upload de texto para tarefa [", codigo_tarefa, "]: ", msg_erro, ". Tentando novamente")
         dormir(60)  # Tenta novamente em 1 minuto
 
     # Ok, conseguiu atualizar
@@ -1905,8 +2684,7 @@ def testa_comunicacao_servidor_sapi(url_base):
     url = url_base + "sapisrv_ping.php"
     debug("Testando conexao com servidor SAPI em " + url)
     try:
-        f = urllib.request.urlopen(url, timeout=Ghttp_timeout_corrente)
-        resposta = f.read()
+        (status, resposta) = http_pool_requisicao("GET", url)
     except BaseException as e:
         print_log("Erro: ", str(e))
         return False
@@ -1930,6 +2708,8 @@ def testa_comunicacao_servidor_sapi(url_base):
 def assegura_inicializacao():
     if not Ginicializado:
         erro_fatal("[1075]: Faltou invocar função sapisrv_inicializar. Revise seu código")
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(1)
 
     # Tudo certo
@@ -1977,6 +2757,453 @@ def sapisrv_processar_pagina_resultado_ok(resultado, referencia=""):
     return d
 
 
+# =====================================================================================================================
+# Métricas das chamadas ao servidor (sapisrv)
+# =====================================================================================================================
+# Toda requisição feita através do pool de conexões (http_pool_requisicao) é contabilizada, por agente e programa:
+#  - quantidade: Requisições efetuadas
+#  - erros: Falhas de comunicação (exceção) ou resposta http de erro (status >= 400)
+#  - insucessos: Respostas com sucesso=0 (nem sempre é um erro, ver sapisrv_chamar_programa_sucesso_ok)
+#  - conexoes_novas: Requisições que precisaram abrir uma nova conexão (sem keep-alive)
+#  - tempo_total, tempo_maximo (segundos) e histograma do tempo de resposta
+# O tempo inclui a espera por uma conexão livre no pool.
+#
+# As métricas são gravadas periodicamente (Gmetricas_intervalo_gravacao) em arquivo JSON ao lado do arquivo de log
+# (ver obter_nome_arquivo_metricas), e podem ser exibidas com exibir_metricas_sapisrv (comando *met nos programas).
+# Os processos filhos enviam suas métricas para o pai (através da fila do log), que as inclui no arquivo.
+
+# Intervalo (segundos) de gravação do arquivo de métricas
+Gmetricas_intervalo_gravacao = 60
+# Intervalo mínimo (segundos) entre envios das métricas de um processo filho para o pai
+Gmetricas_intervalo_envio_filho = 5
+# Limites (milissegundos) das faixas do histograma. A última faixa contém o que exceder o último limite
+Gmetricas_limites_histograma = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+Gsufixo_arquivo_metricas = ".metricas.json"
+
+# agente => programa => contadores
+Gmetricas = dict()
+# Métricas recebidas dos processos filhos: pid => métricas (mais recentes)
+Gmetricas_filhos = dict()
+Gmetricas_lock = threading.Lock()
+Gmetricas_inicio = time.time()
+Gmetricas_thread = None
+Gmetricas_pid = None
+Gmetricas_ultimo_envio = 0
+
+
+# Reinicializa as métricas se estiver em um novo processo (fork)
+def _metricas_verificar_processo():
+    global Gmetricas
+    global Gmetricas_filhos
+    global Gmetricas_lock
+    global Gmetricas_inicio
+    global Gmetricas_thread
+    global Gmetricas_pid
+
+    if Gmetricas_pid == os.getpid():
+        return
+
+    Gmetricas = dict()
+    Gmetricas_filhos = dict()
+    Gmetricas_lock = threading.Lock()
+    Gmetricas_inicio = time.time()
+    Gmetricas_thread = None
+    Gmetricas_pid = os.getpid()
+
+
+def _metricas_novo_contador():
+    return {'quantidade': 0,
+            'erros': 0,
+            'insucessos': 0,
+            'conexoes_novas': 0,
+            'tempo_total': 0.0,
+            'tempo_maximo': 0.0,
+            'histograma': [0] * (len(Gmetricas_limites_histograma) + 1)}
+
+
+# Obtém o contador do agente corrente para o programa (chamado com Gmetricas_lock)
+def _metricas_contador(programa):
+    agente = get_parini('nome_agente', '-')
+    return Gmetricas.setdefault(agente, dict()).setdefault(programa, _metricas_novo_contador())
+
+
+# Registra uma requisição
+def _metricas_registrar(url, tempo, erro, conexao_nova):
+    programa = urllib.parse.urlsplit(url).path.rsplit("/", 1)[-1]
+    milissegundos = tempo * 1000
+    faixa = 0
+    while faixa < len(Gmetricas_limites_histograma) and milissegundos > Gmetricas_limites_histograma[faixa]:
+        faixa += 1
+
+    _metricas_verificar_processo()
+    with Gmetricas_lock:
+        contador = _metricas_contador(programa)
+        contador['quantidade'] += 1
+        contador['tempo_total'] += tempo
+        contador['tempo_maximo'] = max(contador['tempo_maximo'], tempo)
+        contador['histograma'][faixa] += 1
+        if erro:
+            contador['erros'] += 1
+        if conexao_nova:
+            contador['conexoes_novas'] += 1
+
+    _metricas_publicar()
+
+
+# Registra uma resposta com sucesso=0
+def _metricas_registrar_insucesso(programa):
+    _metricas_verificar_processo()
+    with Gmetricas_lock:
+        _metricas_contador(programa)['insucessos'] += 1
+
+
+# Publica as métricas: No processo filho, envia para o pai; caso contrário, inicia a thread de gravação
+def _metricas_publicar(forcar_envio=False):
+    global Gmetricas_thread
+    global Gmetricas_ultimo_envio
+
+    if Glog_fila_pai is not None:
+        if forcar_envio or time.time() - Gmetricas_ultimo_envio >= Gmetricas_intervalo_envio_filho:
+            Gmetricas_ultimo_envio = time.time()
+            try:
+                Glog_fila_pai.put((None, None, {'pid': os.getpid(), 'metricas': obter_metricas_sapisrv()}))
+            except BaseException:
+                # Processo pai não está mais recebendo. As métricas do filho são apenas informativas
+                pass
+        return
+
+    if Gmetricas_thread is None and not forcar_envio:
+        Gmetricas_thread = threading.Thread(target=_metricas_gravar_periodicamente, name="sapi_metricas")
+        Gmetricas_thread.daemon = True
+        Gmetricas_thread.start()
+
+
+# Envia imediatamente as métricas do processo filho para o pai
+# Deve ser chamado antes de encerrar um processo filho com os._exit (que não executa atexit),
+# caso contrário as chamadas dos últimos Gmetricas_intervalo_envio_filho segundos não são contabilizadas
+def publicar_metricas_sapisrv():
+    _metricas_publicar(forcar_envio=True)
+
+
+# Recebe (no processo pai) as métricas enviadas por um processo filho
+def _metricas_receber_filho(registro):
+    _metricas_verificar_processo()
+    with Gmetricas_lock:
+        Gmetricas_filhos[registro['pid']] = registro['metricas']
+
+
+# Soma os contadores de origem no destino (agente => programa => contadores)
+def _metricas_somar(destino, origem):
+    for agente in origem:
+        for programa in origem[agente]:
+            c_origem = origem[agente][programa]
+            c_destino = destino.setdefault(agente, dict()).setdefault(programa, _metricas_novo_contador())
+            for chave in ['quantidade', 'erros', 'insucessos', 'conexoes_novas', 'tempo_total']:
+                c_destino[chave] += c_origem[chave]
+            c_destino['tempo_maximo'] = max(c_destino['tempo_maximo'], c_origem['tempo_maximo'])
+            c_destino['histograma'] = [a + b for (a, b) in zip(c_destino['histograma'], c_origem['histograma'])]
+
+
+# Retorna cópia das métricas deste processo, incluindo as dos processos filhos
+def obter_metricas_sapisrv():
+    _metricas_verificar_processo()
+    resultado = dict()
+    with Gmetricas_lock:
+        _metricas_somar(resultado, Gmetricas)
+        for pid in Gmetricas_filhos:
+            _metricas_somar(resultado, Gmetricas_filhos[pid])
+    return resultado
+
+
+# Caminho do arquivo de métricas: Ao lado do arquivo de log, com o mesmo nome base
+def obter_nome_arquivo_metricas():
+    return os.path.splitext(obter_nome_arquivo_log())[0] + Gsufixo_arquivo_metricas
+
+
+# Grava o arquivo de métricas (de forma atômica, para não ser lido pela metade)
+def gravar_metricas_sapisrv():
+    conteudo = {'programa': get_parini('programa', None),
+                'programa_versao': get_parini('programa_versao', None),
+                'pid': os.getpid(),
+                'inicio': datetime.datetime.fromtimestamp(Gmetricas_inicio).strftime("%Y-%m-%d %H:%M:%S"),
+                'gravacao': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                'limites_histograma_ms': Gmetricas_limites_histograma,
+                'metricas': obter_metricas_sapisrv()}
+
+    arquivo = obter_nome_arquivo_metricas()
+    temporario = arquivo + "." + str(os.getpid()) + ".tmp"
+    with open(temporario, 'w') as f:
+        json.dump(conteudo, f, indent=1, sort_keys=True)
+    os.replace(temporario, arquivo)
+
+
+# Thread de gravação do arquivo de métricas
+def _metricas_gravar_periodicamente():
+    while True:
+        time.sleep(Gmetricas_intervalo_gravacao)
+        try:
+            gravar_metricas_sapisrv()
+        except BaseException as e:
+            print_log("Gravação do arquivo de métricas falhou: ", str(e))
+
+
+# Estima o percentil (limite superior da faixa do histograma, em ms)
+def _metricas_percentil_ms(histograma, limites, percentil):
+    total = sum(histograma)
+    if total == 0:
+        return "-"
+    acumulado = 0
+    for (faixa, quantidade) in enumerate(histograma):
+        acumulado += quantidade
+        if acumulado >= total * percentil / 100.0:
+            if faixa < len(limites):
+                return "<=" + str(limites[faixa])
+            return ">" + str(limites[-1])
+    return "-"
+
+
+# Exibe as métricas das chamadas ao servidor
+# arquivo: Se informado, exibe as métricas gravadas em arquivo (de outro programa/agente, por exemplo)
+def exibir_metricas_sapisrv(arquivo=None):
+
+    limites = Gmetricas_limites_histograma
+    if arquivo is None:
+        metricas = obter_metricas_sapisrv()
+        print_centralizado(" Métricas das chamadas ao servidor (desde " +
+                           datetime.datetime.fromtimestamp(Gmetricas_inicio).strftime("%d/%m %H:%M") + ") ")
+    else:
+        with open(arquivo, 'r') as f:
+            conteudo = json.load(f)
+        metricas = conteudo['metricas']
+        limites = conteudo['limites_histograma_ms']
+        print_centralizado(" Métricas de " + str(conteudo['programa']) + " (" + conteudo['inicio'] +
+                           " a " + conteudo['gravacao'] + ") ")
+
+    if len(metricas) == 0:
+        print("- Nenhuma chamada ao servidor registrada")
+        return
+
+    for agente in sorted(metricas):
+        print("Agente:", agente)
+        print("  %-40s %7s %5s %5s %5s %8s %8s %8s %8s" %
+              ("Programa", "Qtd", "Erro", "Insuc", "Conex", "Média ms", "p50 ms", "p95 ms", "Máx ms"))
+        for programa in sorted(metricas[agente]):
+            c = metricas[agente][programa]
+            media = "-"
+            if c['quantidade'] > 0:
+                media = "%.0f" % (c['tempo_total'] / c['quantidade'] * 1000)
+            print("  %-40s %7d %5d %5d %5d %8s %8s %8s %8.0f" %
+                  (programa[:40], c['quantidade'], c['erros'], c['insucessos'], c['conexoes_novas'], media,
+                   _metricas_percentil_ms(c['histograma'], limites, 50),
+                   _metricas_percentil_ms(c['histograma'], limites, 95),
+                   c['tempo_maximo'] * 1000))
+    print()
+    print("- Erro: Falha de comunicação ou erro http. Insuc: Resposta com sucesso=0. "
+          "Conex: Requisições que abriram nova conexão.")
+    if arquivo is None:
+        print("- Arquivo de métricas (gravado a cada", Gmetricas_intervalo_gravacao, "segundos):",
+              obter_nome_arquivo_metricas())
+
+
+# =====================================================================================================================
+# Pool de conexões HTTP (keep-alive)
+# =====================================================================================================================
+# As conexões com o servidor (SETEC3) são mantidas abertas e reaproveitadas entre as chamadas,
+# evitando o custo de estabelecer uma nova conexão TCP (e negociação TLS) a cada chamada.
+# Para conexões novas em https, a sessão TLS anterior é reaproveitada (resumption), se o servidor permitir.
+
+# Quantidade máxima de conexões simultâneas (e ociosas mantidas no pool) por servidor
+Ghttp_pool_maximo_conexoes = 4
+
+# Servidor (protocolo, host, porta) => lista de conexões ociosas
+Ghttp_pool_conexoes = dict()
+# Servidor => semáforo que limita as conexões simultâneas
+Ghttp_pool_semaforos = dict()
+# Servidor => última sessão TLS estabelecida
+Ghttp_pool_sessoes_tls = dict()
+Ghttp_pool_lock = threading.Lock()
+# Processo dono do pool. Um processo filho (fork) não pode reaproveitar os sockets do pai
+Ghttp_pool_pid = None
+Ghttp_pool_contexto_ssl = None
+
+# Erros que indicam que uma conexão reaproveitada foi fechada pelo servidor (timeout de keep-alive)
+# Nesta situação, a requisição é repetida uma vez em uma conexão nova, mas apenas se o erro ocorreu
+# no envio da requisição. Se o erro ocorrer ao aguardar a resposta, o servidor pode já ter executado
+# a requisição (ex: sapisrv_obter_iniciar_tarefa.php), e repetir poderia executá-la duas vezes
+Ghttp_erros_conexao_encerrada = (http.client.RemoteDisconnected,
+                                 http.client.BadStatusLine,
+                                 ConnectionResetError,
+                                 ConnectionAbortedError,
+                                 BrokenPipeError)
+
+
+# Conexão https que reaproveita a sessão TLS da última conexão com o mesmo servidor
+class _HTTPSConnectionSessaoTLS(http.client.HTTPSConnection):
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+
+        chave = ('https', self.host, self.port)
+        argumentos = dict()
+        if hasattr(ssl.SSLSocket, 'session'):
+            argumentos['session'] = Ghttp_pool_sessoes_tls.get(chave, None)
+
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host, **argumentos)
+
+        if getattr(self.sock, 'session', None) is not None:
+            Ghttp_pool_sessoes_tls[chave] = self.sock.session
+
+
+# Reinicializa o pool, se estiver sendo utilizado em outro processo
+def _http_pool_verificar_processo():
+    global Ghttp_pool_pid
+    global Ghttp_pool_contexto_ssl
+
+    if Ghttp_pool_pid == os.getpid():
+        return
+
+    Ghttp_pool_pid = os.getpid()
+    Ghttp_pool_conexoes.clear()
+    Ghttp_pool_semaforos.clear()
+    Ghttp_pool_sessoes_tls.clear()
+    # Respeita a configuração de certificado definida no início da sapilib
+    Ghttp_pool_contexto_ssl = ssl._create_default_https_context()
+
+
+# Obtem uma conexão do pool para o servidor indicado.
+# Se não houver conexão ociosa, cria uma nova
+# Retorna tupla: (conexão, reaproveitada)
+def _http_pool_obter_conexao(chave, timeout=None):
+    (protocolo, host, porta) = chave
+
+    if timeout is None:
+        timeout = Ghttp_timeout_corrente
+
+    with Ghttp_pool_lock:
+        _http_pool_verificar_processo()
+        ociosas = Ghttp_pool_conexoes.setdefault(chave, list())
+        semaforo = Ghttp_pool_semaforos.setdefault(chave,
+                                                   threading.BoundedSemaphore(Ghttp_pool_maximo_conexoes))
+
+    # Limita a quantidade de conexões simultâneas com o mesmo servidor
+    semaforo.acquire()
+
+    while True:
+        with Ghttp_pool_lock:
+            if len(ociosas) == 0:
+                break
+            conn = ociosas.pop()
+        # Descarta conexão que o servidor já encerrou enquanto estava ociosa
+        if _http_pool_conexao_encerrada(conn):
+            conn.close()
+            continue
+        # O timeout pode ter sido alterado (set_http_timeout) desde o último uso
+        conn.timeout = timeout
+        conn.sock.settimeout(timeout)
+        return (conn, True)
+
+    if protocolo == 'https':
+        conn = _HTTPSConnectionSessaoTLS(host, port=porta, timeout=timeout,
+                                         context=Ghttp_pool_contexto_ssl)
+    else:
+        conn = http.client.HTTPConnection(host, port=porta, timeout=timeout)
+
+    return (conn, False)
+
+
+# Verifica se a conexão ociosa foi encerrada pelo servidor
+# Uma conexão ociosa não deveria ter nada para ler. Se o socket estiver legível,
+# o servidor encerrou a conexão (ou enviou algo inesperado): de qualquer forma, não pode ser reaproveitada
+def _http_pool_conexao_encerrada(conn):
+    if conn.sock is None:
+        return True
+    try:
+        (legiveis, gravaveis, erros) = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return len(legiveis) > 0
+
+
+# Devolve conexão para o pool
+# Se a conexão não puder ser reaproveitada, fecha
+def _http_pool_devolver_conexao(chave, conn, reaproveitar):
+
+    with Ghttp_pool_lock:
+        ociosas = Ghttp_pool_conexoes.setdefault(chave, list())
+        if reaproveitar and conn.sock is not None and len(ociosas) < Ghttp_pool_maximo_conexoes:
+            ociosas.append(conn)
+            conn = None
+        semaforo = Ghttp_pool_semaforos.get(chave, None)
+
+    if conn is not None:
+        conn.close()
+
+    if semaforo is not None:
+        semaforo.release()
+
+
+# Fecha todas as conexões ociosas do pool
+def http_pool_fechar_conexoes():
+    with Ghttp_pool_lock:
+        for ociosas in Ghttp_pool_conexoes.values():
+            for conn in ociosas:
+                conn.close()
+            del ociosas[:]
+
+
+# Efetua uma requisição http utilizando o pool de conexões
+# url: URL completa (exemplo: https://10.41.84.5:443/setec3/sapisrv_ping.php?x=1)
+# timeout: Se não for informado, utiliza o timeout corrente (ver set_http_timeout)
+# Retorna tupla: (status http, conteúdo da resposta em bytes)
+def http_pool_requisicao(metodo, url, corpo=None, headers=None, timeout=None):
+
+    partes = urllib.parse.urlsplit(url)
+    protocolo = partes.scheme
+    porta = partes.port
+    if porta is None:
+        porta = 443 if protocolo == 'https' else 80
+    chave = (protocolo, partes.hostname, porta)
+
+    url_parcial = partes.path
+    if partes.query:
+        url_parcial += "?" + partes.query
+
+    if headers is None:
+        headers = dict()
+
+    # Uma conexão reaproveitada pode ter sido encerrada pelo servidor enquanto estava ociosa
+    # Neste caso (e apenas se a falha ocorreu no envio da requisição), repete uma vez em uma conexão nova
+    # Falhas ao receber a resposta são repassadas para o chamador, que decide se pode repetir
+    inicio = time.time()
+    while True:
+        (conn, reaproveitada) = _http_pool_obter_conexao(chave, timeout)
+        try:
+            conn.request(metodo, url_parcial, corpo, headers)
+        except Ghttp_erros_conexao_encerrada as e:
+            _http_pool_devolver_conexao(chave, conn, reaproveitar=False)
+            if reaproveitada:
+                debug("Conexão http reaproveitada foi encerrada pelo servidor. Repetindo em nova conexão: ", str(e))
+                continue
+            _metricas_registrar(url, time.time() - inicio, erro=True, conexao_nova=True)
+            raise
+        except BaseException:
+            _http_pool_devolver_conexao(chave, conn, reaproveitar=False)
+            _metricas_registrar(url, time.time() - inicio, erro=True, conexao_nova=not reaproveitada)
+            raise
+
+        try:
+            resposta = conn.getresponse()
+            dados_resposta = resposta.read()
+        except BaseException:
+            _http_pool_devolver_conexao(chave, conn, reaproveitar=False)
+            _metricas_registrar(url, time.time() - inicio, erro=True, conexao_nova=not reaproveitada)
+            raise
+
+        _http_pool_devolver_conexao(chave, conn, reaproveitar=not resposta.will_close)
+        _metricas_registrar(url, time.time() - inicio, erro=resposta.status >= 400, conexao_nova=not reaproveitada)
+        return (resposta.status, dados_resposta)
+
+
 # =====================================================================================================================
 # GET
 # =====================================================================================================================
@@ -2022,6 +3249,8 @@ def _sapisrv_chamar_programa_get(programa, parametros, registrar_log=False, resp
     sucesso = False
     if (retorno["sucesso"] == "1"):
         sucesso = True
+    else:
+        _metricas_registrar_insucesso(programa)
 
     # Outros dados
     msg_erro = retorno["msg_erro"]
@@ -2054,10 +3283,11 @@ def _sapisrv_get_sucesso(url):
 # ----------------------------------------------------------------------
 def sapisrv_get_ok(url, resposta_json=True):
 
-    # Invoca com GET
+    # Invoca com GET, utilizando o pool de conexões (keep-alive)
     try:
-        f = urllib.request.urlopen(url, timeout=Ghttp_timeout_corrente)
-        resultado = f.read()
+        (status, resultado) = http_pool_requisicao("GET", url)
+        if status >= 400:
+            raise http.client.HTTPException("HTTP Error " + str(status))
 
     except BaseException as e:
         print_tela_log("- Não foi recebido resposta em tempo hábil para GET em URL:", url)
@@ -2117,6 +3347,7 @@ def sapisrv_post_sucesso(programa, parametros):
 
     # Se não foi sucesso, aborta
     if (d["sucesso"] == "0"):
+        _metricas_registrar_insucesso(programa)
         print_tela_log("- Erro inesperado reportado por: ", programa, " via post")
         print_tela_log(d["msg_erro"])
         raise SapiExceptionGeral("Operação interrompida")
@@ -2150,34 +3381,26 @@ def _post(programa, parametros):
     # Formata parâmetros
     parametros_formatados = urllib.parse.urlencode(parametros)
 
-    # Efetua conexão com servidor
-    protocolo=_obter_parini_obrigatorio('servidor_protocolo')
-    if protocolo=='https':
-        # HTTPS
-        conn = http.client.HTTPSConnection(
-            _obter_parini_obrigatorio('servidor_ip'),
-            port=_obter_parini_obrigatorio('servidor_porta'),
-            timeout=Ghttp_timeout_corrente)
-    else:
-        # HTTP simples
-        conn = http.client.HTTPConnection(
-            _obter_parini_obrigatorio('servidor_ip'),
-            port=_obter_parini_obrigatorio('servidor_porta'),
-            timeout = Ghttp_timeout_corrente)
-
     # Parâmetros para POST
     headers = {"Content-type": "application/x-www-form-urlencoded",
                "Accept": "text/plain"}
-    url_parcial = "/" + _obter_parini_obrigatorio('servidor_sistema') + "/" + programa
-
-    # Envia POST
-    conn.request("POST", url_parcial, parametros_formatados, headers)
-    resultado = conn.getresponse()
+    url = _sapisrv_montar_url_post(programa)
 
-    dados_resposta = resultado.read()
+    # Envia POST, utilizando o pool de conexões (keep-alive)
+    (status, dados_resposta) = http_pool_requisicao("POST", url, parametros_formatados, headers)
 
     return dados_resposta
 
+
+# Monta URL para POST em programa do servidor
+# ----------------------------------------------------------------------
+def _sapisrv_montar_url_post(programa):
+    url = _obter_parini_obrigatorio('servidor_protocolo') + "://" + \
+          _obter_parini_obrigatorio('servidor_ip') + ":" + \
+          str(_obter_parini_obrigatorio('servidor_porta')) + \
+          "/" + _obter_parini_obrigatorio('servidor_sistema') + "/" + programa
+    return url
+
 # =====================================================================================================================
 #
 # =====================================================================================================================
@@ -2194,6 +3417,8 @@ def erro_fatal(*args):
     print("=================================================================")
     #trc_string = traceback.format_exc()
     #print(trc_string)
+    publicar_metricas_sapisrv()
+    log_descarregar()
     os._exit(1)
 
 
@@ -2201,6 +3426,8 @@ def erro_fatal(*args):
 # ----------------------------------------------------------------------
 def die(s):
     print(s)
+    publicar_metricas_sapisrv()
+    log_descarregar()
     os._exit(1)
 
 
@@ -2407,124 +3634,631 @@ def renomear_arquivo_log_default(nome_novo):
         debug("Arquivo de log não foi renomeado, pois usuário definiu parâmetro logfile")
         return False
 
-    try:
-        # recupera nome atual
-        nome_atual=get_parini('log')
+    # A gravação do log fica bloqueada durante toda a transferência, para que nenhuma linha seja gravada
+    # nos arquivos (atual ou novo) enquanto estes estão sendo renomeados
+    _log_verificar_processo()
+    with Glog_lock_gravacao:
+        return _renomear_arquivo_log_default(nome_novo)
+
+
+def _renomear_arquivo_log_default(nome_novo):
+
+    # Grava linhas pendentes, antes de mexer nos arquivos
+    _log_descarregar_lote()
+
+    try:
+        # recupera nome atual
+        nome_atual=get_parini('log')
+
+        if (nome_atual==nome_novo):
+            debug("renomear_arquivo_log_default: Nome de arquivo de log igual ao atual, logo nada a fazer. ")
+            return
+
+        # Troca nome de log para nome_novo
+        # Linhas ainda enfileiradas com o nome atual serão gravadas no arquivo novo
+        set_parini('log', nome_novo)
+        if nome_atual is not None:
+            for anterior in list(Glog_renomeados):
+                if Glog_renomeados[anterior] == nome_atual:
+                    Glog_renomeados[anterior] = nome_novo
+            Glog_renomeados[nome_atual] = nome_novo
+            Glog_renomeados.pop(nome_novo, None)
+
+        # Se não tem nome atual, nada a fazer, pois arquivo de log ainda não tinha sido criado
+        if nome_atual is None:
+            return False
+
+        # Se o arquivo atual ainda não existe, não tem nada a fazer, pelo mesmo motivo
+        if not os.path.isfile(nome_atual) and len(_listar_segmentos_log(nome_atual)) == 0:
+            return True
+
+        # Ok, arquivo atual existe
+        debug("nome nome de arquivo de log atual", nome_atual)
+
+        # Verifica se o arquivo novo existe
+        novo_existe=os.path.isfile(nome_novo)
+
+        # Os segmentos do log atual passam a ser os segmentos seguintes do log novo
+        # A transferência é feita apenas com renomeação de arquivos, sem cópia de conteúdo
+        with Glog_lock_segmentos:
+            # Aguarda a conclusão de compactação em andamento (os segmentos serão renomeados)
+            while len(Glog_segmentos_em_compactacao) > 0:
+                Glog_lock_segmentos.wait()
+            segmentos_novo = _listar_segmentos_log(nome_novo)
+            numero = 0
+            if len(segmentos_novo) > 0:
+                numero = segmentos_novo[-1][0]
+
+            # O arquivo corrente do log novo (mais antigo) é fechado como segmento
+            if novo_existe:
+                numero += 1
+                _renomear_segmento_log(nome_novo, _caminho_segmento_log(nome_novo, numero))
+                Glog_inicio_segmento.pop(nome_novo, None)
+
+            for (numero_atual, caminho) in _listar_segmentos_log(nome_atual):
+                numero += 1
+                _renomear_segmento_log(caminho, _caminho_segmento_log(nome_novo, numero))
+
+            # O arquivo corrente do log atual passa a ser o arquivo corrente do log novo
+            if os.path.isfile(nome_atual):
+                _renomear_segmento_log(nome_atual, nome_novo)
+            if nome_atual in Glog_inicio_segmento:
+                Glog_inicio_segmento[nome_novo] = Glog_inicio_segmento.pop(nome_atual)
+
+        debug("Conteúdo do arquivo", nome_atual, "transferido para", nome_novo)
+
+        if numero > 0:
+            _log_compactar_segmentos_background(nome_novo)
+
+        return True
+
+    except BaseException as e:
+        print_log("Erro durante ajuste do nome do arquivo de log para",nome_novo, "erro: ",e)
+
+
+# Definir label que será utilizando no arquivo de log
+# ----------------------------------------------------------------------
+def definir_label_log(label_log):
+
+    set_parini('label_log', label_log)
+    debug("label_log alterado para ", label_log)
+
+
+# Ajuste de texto de saída (ip => nome netbios)
+# ----------------------------------------------------------------------
+# As substituições de todos os storages conhecidos (Gdic_storage) são compiladas em uma única expressão regular,
+# que efetua todas as trocas em uma única passada no texto.
+# A expressão é recompilada apenas quando Gdic_storage é alterado.
+Gajuste_texto_chave = None
+Gajuste_texto_regexes = list()
+Gajuste_texto_substituicoes = dict()
+# Endereço ip (v4)
+Gregex_ip = re.compile(r'\d{1,3}(?:\.\d{1,3}){3}')
+# Endereço ip (v4) completo no texto (não faz parte de um número ou ip maior)
+Gregex_ip_texto = re.compile(r'(?<![\d.])\d{1,3}(?:\.\d{1,3}){3}(?!\d)')
+# Quantidade máxima de prefixos (primeiro octeto) para os quais é utilizada uma expressão por prefixo
+Gajuste_texto_maximo_prefixos = 4
+
+
+# Força a recompilação das substituições (deve ser chamado sempre que Gdic_storage for alterado)
+def _invalidar_ajuste_texto_saida():
+    global Gajuste_texto_chave
+    Gajuste_texto_chave = None
+
+
+# Monta as substituições a partir de Gdic_storage
+def _compilar_ajuste_texto_saida():
+    global Gajuste_texto_chave
+    global Gajuste_texto_regexes
+    global Gajuste_texto_substituicoes
+
+    substituicoes = dict()
+    ips = list()
+    netbios_ips = list()
+    for caminho_storage in Gdic_storage:
+        nome_storage = Gdic_storage[caminho_storage]
+
+        # No dicionário tem entrada por IP e correspondente netbios
+        # '\\\\10.41.87.235\\storage': '\\\\gtpi-sto-03\\storage'}
+        # Nem sempre o caminho vem certo, da forma como está acima
+        # Logo, tem que tratar também os casos em que vem o IP junto
+        # com outras coisas (sem as barras iniciais, caminho longo \\?\UNC\, etc)
+        # Caminho completo
+        substituicoes[caminho_storage] = nome_storage
+        # Caminho sem as barras
+        substituicoes[caminho_storage.strip("\\")] = nome_storage.strip("\\")
+        # Isola IP e nome netbios
+        ip = caminho_storage.replace("\\storage", "").replace("\\", "").replace("/", "")
+        netbios = nome_storage.replace("\\storage", "").replace("\\", "").replace("/", "")
+        substituicoes[ip] = netbios
+        ips.append(ip)
+        netbios_ips.append(netbios)
+        # O caminho completo precisa corresponder à simples troca do ip pelo nome
+        if caminho_storage.replace(ip, netbios) != nome_storage:
+            ips.append("")
+
+    # Despreza entradas vazias
+    substituicoes.pop("", None)
+
+    regexes = list()
+    if len(substituicoes) > 0 and all(Gregex_ip.fullmatch(ip) for ip in ips):
+        # Caso normal: Todos os storages são identificados por ip e o caminho netbios corresponde ao caminho
+        # com o ip trocado pelo nome. Neste caso, basta localizar cada ip no texto e trocar pelo nome
+        # (consulta no dicionário).
+        substituicoes = dict(zip(ips, netbios_ips))
+        # Agrupa os ips pelo primeiro octeto
+        grupos = dict()
+        for ip in ips:
+            grupos.setdefault(ip.split(".")[0], list()).append(ip)
+        if len(grupos) <= Gajuste_texto_maximo_prefixos:
+            # Uma expressão por grupo, iniciando pelo prefixo literal comum aos ips do grupo (ex: '10.41.87.'),
+            # que o re localiza diretamente, sem avaliar cada posição do texto (bem mais rápido).
+            # O lookbehind (após o prefixo) impede a troca dentro de um número ou ip maior.
+            for primeiro_octeto in sorted(grupos):
+                prefixo = re.escape(os.path.commonprefix(grupos[primeiro_octeto]))
+                regexes.append(re.compile(prefixo + r'(?<![\d.]' + prefixo + r')[\d.]*'))
+        else:
+            # Muitos prefixos distintos: Localiza qualquer ip completo
+            regexes.append(Gregex_ip_texto)
+    elif len(substituicoes) > 0:
+        # Mais longos primeiro, para que o caminho completo tenha prioridade sobre o ip isolado
+        # Os limites impedem que um ip seja trocado dentro de outro (ex: 10.1.1.2 dentro de 10.1.1.23)
+        alternativas = sorted(substituicoes, key=len, reverse=True)
+        regexes.append(re.compile(r'(?<![\d.])(?:' + '|'.join(re.escape(a) for a in alternativas) + r')(?!\d)'))
+
+    Gajuste_texto_regexes = regexes
+    Gajuste_texto_substituicoes = substituicoes
+    Gajuste_texto_chave = (id(Gdic_storage), len(Gdic_storage))
+
+
+# Efetua ajustes no texto, para ficar adequado a log e registro de status
+def ajusta_texto_saida(s):
+
+    if modo_debug():
+        # Como está em modo debug, não faz nenhuma alteração
+        return s
+
+    # Recompila se Gdic_storage foi alterado
+    if Gajuste_texto_chave != (id(Gdic_storage), len(Gdic_storage)):
+        _compilar_ajuste_texto_saida()
+
+    # IP para nome netbios
+    for regex in Gajuste_texto_regexes:
+        s = regex.sub(_substituir_ajuste_texto_saida, s)
+    return s
+
+
+def _substituir_ajuste_texto_saida(m):
+    trecho = m.group(0)
+    # O trecho pode terminar com o ponto final da frase (ex: "... 10.41.87.235.")
+    chave = trecho.rstrip(".")
+    substituto = Gajuste_texto_substituicoes.get(chave, None)
+    if substituto is None:
+        # Não registrado em Gdic_storage, mantém
+        return trecho
+    return substituto + trecho[len(chave):]
+
+def print_tela(*arg):
+
+    linha = concatena_args(*arg)
+    linha=ajusta_texto_saida(linha)
+
+    #print(linha)
+    print_console(linha)
+
+
+
+# Exibe na tela, centralizado
+def print_centralizado(texto='', tamanho=None, preenchimento='-'):
+
+    if tamanho is None:
+        tamanho=Glargura_tela
+
+    direita = (tamanho - len(texto)) // 2
+    esquerda = tamanho - len(texto) - direita
+    print(preenchimento * direita + texto + preenchimento * esquerda)
+
+
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Gravação do log em lote
+# ----------------------------------------------------------------------------------------------------------------------
+# As linhas de log não são gravadas uma a uma (abrindo e fechando o arquivo a cada linha, o que é lento,
+# principalmente em unidades de rede). São acumuladas e gravadas em lote por uma thread,
+# a cada Glog_intervalo_gravacao segundos ou quando forem acumuladas Glog_tamanho_lote linhas.
+# Os processos filhos (que recebem os dados via obter_dados_para_processo_filho) não gravam no arquivo:
+# enviam as linhas para o processo pai através de uma fila (multiprocessing), e o pai efetua a gravação.
+#
+# Antes de ler o arquivo de log, ou de encerrar o processo com os._exit, invocar log_descarregar()
+# (e, no processo filho, publicar_metricas_sapisrv(), para enviar as métricas pendentes ao pai)
+#
+# Formato do log (parini 'log_formato', ver definir_formato_log):
+# - 'texto' (default): [pid] : AAAA-MM-DD HH:MM : [label_log] mensagem
+# - 'jsonl': Um objeto JSON por linha, com os campos pid, hora, label_log, codigo_tarefa, nivel e mensagem
+# Cada linha é independente, de modo que a leitura (ler_linhas_log) aceita arquivos com os dois formatos misturados.
+#
+# Índice do log: Junto com o arquivo de log é mantido um arquivo auxiliar (arquivo_log + Gsufixo_indice_log),
+# com uma linha para cada trecho contínuo de registros de uma mesma tarefa/label:
+#   inicio<tab>fim<tab>codigo_tarefa<tab>label_log
+# onde inicio/fim são as posições (bytes) do trecho no arquivo de log.
+# Desta forma, a exibição do log de uma tarefa lê apenas os trechos da tarefa, sem varrer o arquivo inteiro.
+#
+# Rotação do log: Quando o arquivo de log atinge Glog_tamanho_maximo_segmento bytes ou Glog_idade_maxima_segmento
+# segundos, é renomeado para um segmento numerado (log_xxx.txt => log_xxx.001.txt, log_xxx.002.txt, ...),
+# e a gravação prossegue em um novo arquivo com o nome original.
+# Os segmentos fechados são compactados (gzip) em background: log_xxx.001.txt.gz
+# O índice de cada segmento acompanha o segmento (log_xxx.001.txt.sapi_idx), com posições do conteúdo descompactado.
+# A leitura (listar_arquivos_log, ler_linhas_log) percorre todos os segmentos, em ordem.
+
+# Intervalo máximo (segundos) entre gravações
+Glog_intervalo_gravacao = 1
+# Quantidade de linhas acumuladas que força a gravação imediata
+Glog_tamanho_lote = 500
+# Linhas pendentes: (arquivo_log, linha)
+Glog_buffer = list()
+Glog_condicao = threading.Condition()
+# Serializa as gravações, para preservar a ordem das linhas
+Glog_lock_gravacao = threading.Lock()
+Glog_thread = None
+Glog_pid = None
+# No processo pai: Fila para recebimento das linhas dos processos filhos
+Glog_fila_filhos = None
+# No processo filho: Fila para envio das linhas para o pai
+Glog_fila_pai = None
+# Índice do log
+Gsufixo_indice_log = ".sapi_idx"
+Glog_indice = True
+# Formatos de log suportados
+Glista_formatos_log = ['texto', 'jsonl']
+# Rotação do log
+Glog_tamanho_maximo_segmento = 50 * 1024 * 1024
+Glog_idade_maxima_segmento = 24 * 3600
+# Quantidade máxima de segmentos mantidos (None: mantém todos)
+Glog_quantidade_maxima_segmentos = None
+# Momento de criação do segmento corrente, por arquivo de log
+Glog_inicio_segmento = dict()
+# Serializa a movimentação dos segmentos
+# A compactação é efetuada fora do lock (para não bloquear a gravação do log); os segmentos em compactação
+# ficam registrados em Glog_segmentos_em_compactacao e não são movimentados nem excluídos
+Glog_lock_segmentos = threading.Condition()
+Glog_segmentos_em_compactacao = set()
+# Arquivos de log renomeados (renomear_arquivo_log_default): nome anterior => nome novo
+# Linhas enfileiradas com o nome anterior são gravadas no arquivo novo
+Glog_renomeados = dict()
+
+
+# Reinicializa o estado se estiver em um novo processo (fork)
+def _log_verificar_processo():
+    global Glog_buffer
+    global Glog_condicao
+    global Glog_lock_gravacao
+    global Glog_thread
+    global Glog_pid
+    global Glog_fila_filhos
+    global Glog_lock_segmentos
+
+    if Glog_pid == os.getpid():
+        return
+
+    Glog_buffer = list()
+    Glog_condicao = threading.Condition()
+    Glog_lock_gravacao = threading.Lock()
+    Glog_lock_segmentos = threading.Condition()
+    Glog_segmentos_em_compactacao.clear()
+    Glog_thread = None
+    Glog_fila_filhos = None
+    Glog_pid = os.getpid()
+
+
+# Coloca linha na fila de gravação do log
+# linha: Linha já no formato do log (texto ou jsonl)
+# registro: Dicionário com os campos do registro estruturado (ver _print_log_apenas)
+def _log_enfileirar(arquivo_log, linha, registro):
+    global Glog_thread
+
+    global Glog_fila_pai
+
+    # Processo filho: Envia para o pai
+    if Glog_fila_pai is not None:
+        try:
+            Glog_fila_pai.put((arquivo_log, linha, registro))
+            return
+        except BaseException:
+            # Processo pai não está mais recebendo (encerrado?). Passa a gravar diretamente
+            Glog_fila_pai = None
+
+    _log_verificar_processo()
+
+    with Glog_condicao:
+        Glog_buffer.append((arquivo_log, linha, registro))
+        if len(Glog_buffer) >= Glog_tamanho_lote:
+            Glog_condicao.notify()
+
+        # Inicia a thread de gravação
+        if Glog_thread is None:
+            Glog_thread = threading.Thread(target=_log_gravar_periodicamente, name="sapi_log")
+            Glog_thread.daemon = True
+            Glog_thread.start()
+
+
+# Thread de gravação
+def _log_gravar_periodicamente():
+    while True:
+        with Glog_condicao:
+            if len(Glog_buffer) < Glog_tamanho_lote:
+                Glog_condicao.wait(Glog_intervalo_gravacao)
+        log_descarregar()
+
+
+# Grava imediatamente as linhas de log pendentes
+def log_descarregar():
+    global Glog_buffer
+
+    if Glog_pid != os.getpid():
+        # Nada foi enfileirado neste processo
+        return
+
+    with Glog_lock_gravacao:
+        _log_descarregar_lote()
+
+
+# Grava as linhas pendentes (Glog_lock_gravacao deve estar adquirido)
+def _log_descarregar_lote():
+    global Glog_buffer
+
+    with Glog_condicao:
+        lote = Glog_buffer
+        Glog_buffer = list()
+
+    if len(lote) == 0:
+        return
+
+    # Agrupa por arquivo, mantendo a ordem das linhas
+    itens_arquivo = dict()
+    for (arquivo_log, linha, registro) in lote:
+        arquivo_log = Glog_renomeados.get(arquivo_log, arquivo_log)
+        itens_arquivo.setdefault(arquivo_log, list()).append((linha, registro))
+
+    for arquivo_log in itens_arquivo:
+        try:
+            _log_gravar_arquivo(arquivo_log, itens_arquivo[arquivo_log])
+        except BaseException as e:
+            # Não tem como registrar no log...
+            sys.stderr.write("Gravação no arquivo de log " + str(arquivo_log) + " falhou: " + str(e) + "\n")
 
-        if (nome_atual==nome_novo):
-            debug("renomear_arquivo_log_default: Nome de arquivo de log igual ao atual, logo nada a fazer. ")
-            return
 
-        # Troca nome de log para nome_novo
-        set_parini('log', nome_novo)
+# Grava um lote de linhas no arquivo de log, e atualiza o índice
+def _log_gravar_arquivo(arquivo_log, itens):
 
-        # Se não tem nome atual, nada a fazer, pois arquivo de log ainda não tinha sido criado
-        if nome_atual is None:
-            return False
+    partes = list()
+    # Trechos contínuos de uma mesma tarefa/label: [tamanho, codigo_tarefa, label_log]
+    trechos = list()
+    for (linha, registro) in itens:
+        dados = (linha + "\r\n").encode("utf-8")
+        partes.append(dados)
 
-        # Se o arquivo atual ainda não existe, não tem nada a fazer, pelo mesmo motivo
-        if not os.path.isfile(nome_atual):
-            return True
+        chave = (registro['codigo_tarefa'], registro['label_log'])
+        if len(trechos) > 0 and (trechos[-1][1], trechos[-1][2]) == chave:
+            trechos[-1][0] += len(dados)
+        else:
+            trechos.append([len(dados), registro['codigo_tarefa'], registro['label_log']])
+
+    dados = b"".join(partes)
+    arquivo_novo = not os.path.isfile(arquivo_log)
+    if arquivo_novo:
+        Glog_inicio_segmento[arquivo_log] = time.time()
+    elif arquivo_log not in Glog_inicio_segmento:
+        # No windows, st_ctime é a data de criação do arquivo
+        Glog_inicio_segmento[arquivo_log] = os.stat(arquivo_log).st_ctime
+
+    with open(arquivo_log, 'ab') as sapi_log:
+        sapi_log.write(dados)
+        # Em modo append, a posição após a gravação é o final do arquivo
+        fim = sapi_log.tell()
+
+    if Glog_indice:
+        _log_gravar_indice(arquivo_log, arquivo_novo, fim - len(dados), trechos)
+
+    # Rotação do log
+    if fim >= Glog_tamanho_maximo_segmento or \
+            time.time() - Glog_inicio_segmento[arquivo_log] >= Glog_idade_maxima_segmento:
+        try:
+            _log_rotacionar(arquivo_log)
+        except OSError as e:
+            # Arquivo em uso, por exemplo. Tenta novamente na próxima gravação
+            sys.stderr.write("Rotação do arquivo de log " + str(arquivo_log) + " falhou: " + str(e) + "\n")
 
-        # Ok, arquivo atual existe
-        debug("nome nome de arquivo de log atual", nome_atual)
 
-        # Verifica se o arquivo novo existe
-        novo_existe=os.path.isfile(nome_novo)
+# Acrescenta os trechos gravados ao índice do log
+def _log_gravar_indice(arquivo_log, arquivo_novo, inicio, trechos):
 
-        # Se o arquivo novo ainda não existe, simplesmente renomeia o atual para o novo
-        if not novo_existe:
-            os.rename(nome_atual, nome_novo)
-            debug("Arquivo de log renomeado de",nome_atual, "para", nome_novo)
-            return True
+    if inicio == 0:
+        arquivo_novo = True
 
-        # Se o arquivo existe, temos que ler o conteúdo do arquivo atual,
-        # transferir para o final do novo arquivo
-        # e por último excluir o arquivo antigo
-        with codecs.open(nome_novo, 'a', "utf-8") as arquivo_novo:
-            with codecs.open(nome_atual, 'r', "utf-8") as arquivo_atual:
-                for linha in arquivo_atual:
-                    arquivo_novo.write(linha)
+    linhas_indice = list()
+    for (tamanho, codigo_tarefa, label_log) in trechos:
+        linhas_indice.append(str(inicio) + "\t" + str(inicio + tamanho) + "\t" + codigo_tarefa + "\t" + label_log + "\n")
+        inicio += tamanho
 
-        debug("Conteúdo do arquivo", nome_atual, "transferido para", nome_novo)
+    # Se o arquivo de log foi criado agora, um índice remanescente (de um arquivo anterior) é descartado
+    modo = 'w' if arquivo_novo else 'a'
+    with codecs.open(arquivo_log + Gsufixo_indice_log, modo, "utf-8") as indice:
+        indice.write("".join(linhas_indice))
 
-        # Exclui arquivo atual
-        os.remove(nome_atual)
-        debug("Arquivo", nome_atual, "excluído")
 
-    except BaseException as e:
-        print_log("Erro durante ajuste do nome do arquivo de log para",nome_novo, "erro: ",e)
+# Caminho do segmento 'numero' do arquivo de log: log_xxx.txt => log_xxx.001.txt
+def _caminho_segmento_log(arquivo_log, numero):
+    (base, extensao) = os.path.splitext(arquivo_log)
+    return base + "." + format(numero, '03d') + extensao
 
 
-# Definir label que será utilizando no arquivo de log
-# ----------------------------------------------------------------------
-def definir_label_log(label_log):
+# Caminho do índice de um arquivo de log ou segmento (compactado ou não)
+def _caminho_indice_log(caminho):
+    if caminho.endswith(".gz"):
+        caminho = caminho[:-3]
+    return caminho + Gsufixo_indice_log
 
-    set_parini('label_log', label_log)
-    debug("label_log alterado para ", label_log)
 
+# Lista os segmentos fechados do arquivo de log, do mais antigo para o mais recente
+# Retorna lista de (numero, caminho). Se um segmento estiver em compactação, retorna o arquivo não compactado
+def _listar_segmentos_log(arquivo_log):
+    (base, extensao) = os.path.splitext(arquivo_log)
+    pasta = os.path.dirname(arquivo_log)
+    regex = re.compile(re.escape(os.path.basename(base)) + r'\.(\d+)' + re.escape(extensao) + r'(\.gz)?$')
 
-# Efetua ajustes no texto, para ficar adequado a log e registro de status
-def ajusta_texto_saida(s):
+    segmentos = dict()
+    try:
+        nomes = os.listdir(pasta if pasta != "" else ".")
+    except OSError:
+        return list()
 
-    if modo_debug():
-        # Como está em modo debug, não faz nenhuma alteração
-        return s
+    for nome in nomes:
+        m = regex.match(nome)
+        if m is None:
+            continue
+        numero = int(m.group(1))
+        # Se existirem as duas versões, a não compactada prevalece (compactação ainda não concluída)
+        if m.group(2) is not None and numero in segmentos:
+            continue
+        segmentos[numero] = os.path.join(pasta, nome)
 
-    # IP para nome netbios
-    for caminho_storage in Gdic_storage:
-        nome_storage=Gdic_storage[caminho_storage]
-        sant=s[:]
-        s=s.replace(caminho_storage, nome_storage)
-        # Troca completa de caminho com ip por caminho com nome netbios
-        s=s.replace(caminho_storage.strip("\\"), nome_storage.strip("\\"))
+    return sorted(segmentos.items())
 
-        # No dicionário tem entrada por IP e correspondente netbios
-        # '\\\\10.41.87.235\\storage': '\\\\gtpi-sto-03\\storage'}
-        # Nem sempre o caminho vem certo, da forma como está acima
-        # Logo, tem que tratar também os casos em que vem o IP junto
-        # com outras coisas
-        # Isola IP
-        ip=caminho_storage
-        ip=ip.replace("\\storage","")
-        ip=ip.replace("\\","")
-        ip=ip.replace("/","")
-        # Isola nome netbios
-        netbios=nome_storage
-        netbios=netbios.replace("\\storage","")
-        netbios=netbios.replace("\\","")
-        netbios=netbios.replace("/","")
-        # Substitui ip por nome netbios
-        s=s.replace(ip, netbios)
-
-        # Troca ip por nome netbios
-        if (s!=sant and modo_debug()):
-            # Insere marcador que houve alteração
-            s=s + " #"
 
-    return s
+# Lista os arquivos que compõem o log (segmentos fechados e arquivo corrente), em ordem cronológica
+# ----------------------------------------------------------------------
+def listar_arquivos_log(arquivo_log):
+    lista = [caminho for (numero, caminho) in _listar_segmentos_log(arquivo_log)]
+    if os.path.isfile(arquivo_log):
+        lista.append(arquivo_log)
+    return lista
+
+
+# Renomeia um segmento do log (ou o arquivo corrente), juntamente com o seu índice
+def _renomear_segmento_log(origem, destino):
+    if origem.endswith(".gz") and not destino.endswith(".gz"):
+        destino = destino + ".gz"
+    os.rename(origem, destino)
+
+    indice_origem = _caminho_indice_log(origem)
+    indice_destino = _caminho_indice_log(destino)
+    if os.path.isfile(indice_destino):
+        os.remove(indice_destino)
+    if os.path.isfile(indice_origem):
+        os.rename(indice_origem, indice_destino)
+
+
+# Fecha o segmento corrente do log, transformando-o no próximo segmento numerado
+def _log_rotacionar(arquivo_log):
+
+    with Glog_lock_segmentos:
+        segmentos = _listar_segmentos_log(arquivo_log)
+        numero = 1
+        if len(segmentos) > 0:
+            numero = segmentos[-1][0] + 1
+        _renomear_segmento_log(arquivo_log, _caminho_segmento_log(arquivo_log, numero))
+        Glog_inicio_segmento.pop(arquivo_log, None)
+
+        # Descarta os segmentos mais antigos
+        if Glog_quantidade_maxima_segmentos is not None:
+            segmentos = _listar_segmentos_log(arquivo_log)
+            for (numero, caminho) in segmentos[:-Glog_quantidade_maxima_segmentos]:
+                # Segmento em compactação será excluído na próxima rotação
+                if caminho in Glog_segmentos_em_compactacao:
+                    continue
+                os.remove(caminho)
+                if os.path.isfile(_caminho_indice_log(caminho)):
+                    os.remove(_caminho_indice_log(caminho))
 
-def print_tela(*arg):
+    _log_compactar_segmentos_background(arquivo_log)
 
-    linha = concatena_args(*arg)
-    linha=ajusta_texto_saida(linha)
 
-    #print(linha)
-    print_console(linha)
+# Compacta em background os segmentos fechados do log
+def _log_compactar_segmentos_background(arquivo_log):
+    t = threading.Thread(target=_log_compactar_segmentos, args=(arquivo_log,), name="sapi_log_gzip")
+    t.daemon = True
+    t.start()
 
 
+# Compacta (gzip) os segmentos fechados do log que ainda não foram compactados
+# A lista de segmentos é obtida com o lock, mas a compactação é efetuada sem o lock, para não bloquear
+# a rotação (e consequentemente a gravação do log)
+def _log_compactar_segmentos(arquivo_log):
 
-# Exibe na tela, centralizado
-def print_centralizado(texto='', tamanho=None, preenchimento='-'):
+    with Glog_lock_segmentos:
+        pendentes = [caminho for (numero, caminho) in _listar_segmentos_log(arquivo_log)
+                     if not caminho.endswith(".gz") and caminho not in Glog_segmentos_em_compactacao]
+        Glog_segmentos_em_compactacao.update(pendentes)
 
-    if tamanho is None:
-        tamanho=Glargura_tela
+    for caminho in pendentes:
+        try:
+            # Compactação de tentativa anterior pode já ter sido concluída
+            if not os.path.isfile(caminho + ".gz"):
+                temporario = caminho + ".gz.tmp"
+                with open(caminho, 'rb') as origem:
+                    with gzip.open(temporario, 'wb') as destino:
+                        shutil.copyfileobj(origem, destino, 1024 * 1024)
+                os.replace(temporario, caminho + ".gz")
+            os.remove(caminho)
+        except OSError as e:
+            # Segmento em uso (leitura, por exemplo). Será compactado na próxima rotação
+            sys.stderr.write("Compactação do segmento de log " + str(caminho) + " falhou: " + str(e) + "\n")
+        finally:
+            with Glog_lock_segmentos:
+                Glog_segmentos_em_compactacao.discard(caminho)
+                Glog_lock_segmentos.notify_all()
+
+
+# Fila para recebimento das linhas de log dos processos filhos
+# É criada (juntamente com a thread de recebimento) apenas quando o primeiro processo filho é criado
+def _log_obter_fila_filhos():
+    global Glog_fila_filhos
+
+    # Se este processo já é um filho, os netos enviam diretamente para o mesmo destino
+    if Glog_fila_pai is not None:
+        return Glog_fila_pai
+
+    _log_verificar_processo()
+    if Glog_fila_filhos is None:
+        # SimpleQueue: o envio é síncrono (não há thread de envio no filho),
+        # de modo que nada se perde quando o filho encerra com os._exit
+        Glog_fila_filhos = multiprocessing.SimpleQueue()
+        t = threading.Thread(target=_log_receber_dos_filhos, args=(Glog_fila_filhos,), name="sapi_log_filhos")
+        t.daemon = True
+        t.start()
+
+    return Glog_fila_filhos
+
+
+# Uma mensagem inválida (pickle truncado por um filho encerrado durante o envio, por exemplo)
+# é descartada, sem interromper a recepção das mensagens seguintes
+def _log_receber_dos_filhos(fila):
+    while True:
+        try:
+            (arquivo_log, linha, registro) = fila.get()
+            # Métricas das chamadas ao servidor efetuadas pelo filho (ver _metricas_publicar)
+            if arquivo_log is None:
+                _metricas_receber_filho(registro)
+                continue
+            _log_enfileirar(arquivo_log, linha, registro)
+        except Exception as e:
+            # Não tem como registrar no log...
+            sys.stderr.write("Recepção de log de processo filho falhou: " + str(e) + "\n")
 
-    direita = (tamanho - len(texto)) // 2
-    esquerda = tamanho - len(texto) - direita
-    print(preenchimento * direita + texto + preenchimento * esquerda)
 
+# No encerramento normal do programa, envia status pendentes e grava o log pendente
+def _encerrar_sapilib():
+    sapisrv_descarregar_fila_status()
+    _metricas_publicar(forcar_envio=True)
+    if Gmetricas_thread is not None and Gmetricas_pid == os.getpid():
+        try:
+            gravar_metricas_sapisrv()
+        except BaseException as e:
+            print_log("Gravação do arquivo de métricas falhou: ", str(e))
+    log_descarregar()
 
+atexit.register(_encerrar_sapilib)
 
 
 # Grava apenas em arquivo de log
@@ -2543,6 +4277,11 @@ def _print_log_apenas(*arg):
     if label_log is not None:
         rotulo_log="["+label_log+ "] "
 
+    # Nível da mensagem (debug() prefixa com "DEBUG:")
+    nivel = "INFO"
+    if len(arg) > 0 and arg[0] == "DEBUG:":
+        nivel = "DEBUG"
+
     linha = concatena_args(*arg)
 
     # Remove quebra de linhas
@@ -2555,22 +4294,58 @@ def _print_log_apenas(*arg):
     linha=linha.strip("-")
     linha=linha.strip(" ")
 
+    # Efetua ajustes na linha, para simplificar a leitura (ex: IP para netbios)
+    mensagem=ajusta_texto_saida(linha)
+
+    if nivel == "INFO" and mensagem.lower().startswith("erro"):
+        nivel = "ERRO"
+
     # Adiciona sufixo
-    linha = "[" + str(pid) + "] : " + hora + " : " + rotulo_log + linha
+    linha = "[" + str(pid) + "] : " + hora + " : " + rotulo_log + mensagem
+
+    # Registro estruturado, utilizado no formato jsonl e no índice do log
+    registro = {
+        'pid': pid,
+        'hora': hora,
+        'label_log': label_log if label_log is not None else "",
+        'codigo_tarefa': _obter_codigo_tarefa_label(label_log),
+        'nivel': nivel,
+        'mensagem': mensagem
+    }
 
-    # Efetua ajustes na linha, para simplificar a leitura (ex: IP para netbios)
-    linha=ajusta_texto_saida(linha)
+    linha_log = linha
+    if get_parini('log_formato') == 'jsonl':
+        linha_log = json.dumps(registro, ensure_ascii=False, sort_keys=True)
 
     arquivo_log=obter_nome_arquivo_log()
 
-    with codecs.open(arquivo_log, 'a', "utf-8") as sapi_log:
-        sapi_log.write(linha + "\r\n")
-
-    sapi_log.close()
+    # Gravação em lote (ver _log_enfileirar)
+    _log_enfileirar(arquivo_log, linha_log, registro)
 
     return linha
 
 
+# Extrai o código da tarefa do label de log
+# Os labels de tarefa tem o formato xxxx:codigo_tarefa (ex: acompanhar:1234, *ex:1234)
+# Retorna "" se o label não se refere a uma tarefa
+def _obter_codigo_tarefa_label(label_log):
+    if label_log is None or ':' not in label_log:
+        return ""
+    codigo_tarefa = label_log.rsplit(':', 1)[1].strip()
+    if not codigo_tarefa.isdigit():
+        return ""
+    return codigo_tarefa
+
+
+# Define o formato de gravação do log: 'texto' (default) ou 'jsonl'
+# ----------------------------------------------------------------------
+def definir_formato_log(formato):
+    if formato not in Glista_formatos_log:
+        erro_fatal("Formato de log inválido: ", formato, " Formatos válidos: ", Glista_formatos_log)
+    set_parini('log_formato', formato)
+    debug("Formato de log alterado para ", formato)
+
+
 # Grava em arquivo de log
 # ----------------------------------------------------------------------
 def print_log(*arg):
@@ -2632,6 +4407,8 @@ def if_print(exibir, *arg):
     if type(exibir) != bool:
         print("Chamada inválida para if_print_ok, sem parâmetro de condição")
         print("Argumento: ", exibir, *arg)
+        publicar_metricas_sapisrv()
+        log_descarregar()
         os._exit(1)
 
     # O primeiro elemento deve ser um booleano
@@ -2727,6 +4504,8 @@ def esta_rodando_linux():
     # posix)
     # Por enquanto vamos abortar aqui, e ir refinando o código
     print("Sistema operacional desconhecido : ", os.name)
+    publicar_metricas_sapisrv()
+    log_descarregar()
     os._exit(1)
 
 
@@ -3051,6 +4830,118 @@ def obter_caracteristicas_pasta_python_ok(start_path):
 
 
 
+# Características de pasta via os.scandir (rápido)
+# - Utiliza os dados de stat que já vêm na listagem da pasta (DirEntry), evitando uma chamada adicional
+#   por arquivo (no Windows/SMB, a listagem já traz tamanho e datas)
+# - As subpastas são percorridas em paralelo, por várias threads
+# - Suporta caminhos longos (\\?\ e \\?\UNC\)
+# Retorna dicionário com quantidade_arquivos, quantidade_pastas (inclusive a própria pasta) e tamanho_total
+# Se histograma_extensoes=True, retorna também 'histograma_extensoes':
+#   extensão (minúscula, '' se não tiver) => {'quantidade_arquivos', 'tamanho_total'}
+# Em caso de erro (pasta inexistente, falha de acesso em alguma subpasta), gera exceção
+Gcaracteristicas_pasta_maximo_threads = 16
+
+
+def _caminho_longo_scandir(pasta):
+    if os.name != 'nt':
+        return pasta
+    pasta = os.path.abspath(pasta)
+    if pasta.startswith('\\\\?\\'):
+        return pasta
+    if pasta.startswith('\\\\'):
+        return '\\\\?\\UNC\\' + pasta[2:]
+    return '\\\\?\\' + pasta
+
+
+def obter_caracteristicas_pasta_scandir(pasta, histograma_extensoes=False, maximo_threads=None):
+
+    if maximo_threads is None:
+        maximo_threads = Gcaracteristicas_pasta_maximo_threads
+
+    pasta = _caminho_longo_scandir(pasta)
+    if not os.path.isdir(pasta):
+        raise Exception(texto('[3863] Pasta não encontrada: ', pasta))
+
+    # Fila de pastas a serem processadas
+    fila = queue.Queue()
+    fila.put(pasta)
+    erros = list()
+    # Totais de cada thread, somados no final (evita sincronização a cada arquivo)
+    totais_threads = list()
+
+    def processar():
+        totais = {'quantidade_arquivos': 0, 'quantidade_pastas': 0, 'tamanho_total': 0, 'histograma': dict()}
+        totais_threads.append(totais)
+        while True:
+            caminho = fila.get()
+            if caminho is None:
+                fila.task_done()
+                return
+            try:
+                totais['quantidade_pastas'] += 1
+                for entrada in os.scandir(caminho):
+                    if entrada.is_dir():
+                        # Link para pasta não é percorrido (mesmo comportamento do os.walk)
+                        if not entrada.is_symlink():
+                            fila.put(entrada.path)
+                        continue
+                    tamanho = entrada.stat(follow_symlinks=False).st_size
+                    totais['quantidade_arquivos'] += 1
+                    totais['tamanho_total'] += tamanho
+                    if histograma_extensoes:
+                        extensao = os.path.splitext(entrada.name)[1].lower()
+                        h = totais['histograma'].setdefault(extensao, [0, 0])
+                        h[0] += 1
+                        h[1] += tamanho
+            except OSError as e:
+                erros.append(e)
+            finally:
+                fila.task_done()
+
+    threads = [threading.Thread(target=processar, name="sapi_scandir_" + str(i)) for i in range(maximo_threads)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    # Aguarda até que todas as pastas tenham sido processadas, e encerra as threads
+    fila.join()
+    for t in threads:
+        fila.put(None)
+    for t in threads:
+        t.join()
+
+    if len(erros) > 0:
+        raise Exception(texto('[3864] Falha na leitura de', len(erros), 'pasta(s). Primeiro erro:', str(erros[0])))
+
+    # Dicionários de retorno
+    ret = dict()
+    ret["quantidade_arquivos"] = sum(t['quantidade_arquivos'] for t in totais_threads)
+    ret["quantidade_pastas"] = sum(t['quantidade_pastas'] for t in totais_threads)
+    ret["tamanho_total"] = sum(t['tamanho_total'] for t in totais_threads)
+
+    if histograma_extensoes:
+        histograma = dict()
+        for t in totais_threads:
+            for extensao, (quantidade, tamanho) in t['histograma'].items():
+                h = histograma.setdefault(extensao, {'quantidade_arquivos': 0, 'tamanho_total': 0})
+                h['quantidade_arquivos'] += quantidade
+                h['tamanho_total'] += tamanho
+        ret["histograma_extensoes"] = histograma
+
+    return ret
+
+
+def obter_caracteristicas_pasta_scandir_ok(pasta, histograma_extensoes=False):
+    try:
+        carac = obter_caracteristicas_pasta_scandir(pasta, histograma_extensoes=histograma_extensoes)
+    except BaseException as e:
+        print_log("[3865] obter_caracteristicas_pasta_scandir falhou para pasta", pasta, " erro: ", str(e))
+        return None
+
+    # Tudo certo
+    return carac
+
+
 # Retorna tamanho da pasta calculada através do Dir do prompt do Windows, e se ocorrer erro retorna None
 def obter_caracteristicas_pasta_via_dirdos_ok(caminho_origem):
 
@@ -3373,7 +5264,10 @@ def obter_caracteristicas_pasta(pasta):
     #caracteristicas = obter_caracteristicas_pasta_python(pasta)
 
     # Utiliza o velho comando 'dir' para calcular o tamanho da pasta
-    caracteristicas = obter_caracteristicas_pasta_via_dirdos(pasta)
+    #caracteristicas = obter_caracteristicas_pasta_via_dirdos(pasta)
+
+    # Percorre a pasta via scandir, em paralelo e com suporte a caminho longo
+    caracteristicas = obter_caracteristicas_pasta_scandir(pasta)
 
     return caracteristicas
 
@@ -3382,7 +5276,7 @@ def obter_caracteristicas_pasta(pasta):
 #  quantidade_pastas: Total de pasta
 #  tamanho_total: Tamanho em bytes
 def obter_caracteristicas_pasta_ok(pasta):
-    return obter_caracteristicas_pasta_python_ok(pasta)
+    return obter_caracteristicas_pasta_scandir_ok(pasta)
 
 # Retorna apenas o tamanho da pasta
 def obter_tamanho_pasta_ok(path):
@@ -3411,6 +5305,879 @@ def converte_bytes_humano(size, precision=1, utilizar_base_mil=False):
         size /= base  # apply the division
     return "%.*f%s" % (precision, size, suffixes[suffix_index])
 
+# ===================================================================================
+# Cálculo de hash
+# ===================================================================================
+# O arquivo é lido uma única vez, calculando simultaneamente todos os algoritmos solicitados (md5, sha1, sha256...).
+# - Uma thread de leitura preenche um conjunto fixo de buffers (readinto, sem alocação de memória a cada bloco)
+# - Cada algoritmo é calculado em uma thread própria
+# Como o hashlib libera o GIL durante o cálculo, leitura e cálculos ocorrem em paralelo.
+# Para diversos arquivos (calcular_hash_arquivos), vários arquivos são processados simultaneamente,
+# limitado a Ghash_maximo_arquivos_simultaneos.
+
+# Tamanho de cada bloco de leitura
+Ghash_tamanho_bloco = 4 * 1024 * 1024
+# Quantidade de buffers por arquivo (enquanto um está sendo calculado, os outros estão sendo lidos)
+Ghash_quantidade_buffers = 4
+# Quantidade máxima de arquivos processados simultaneamente
+Ghash_maximo_arquivos_simultaneos = 4
+
+
+# Calcula o hash de um arquivo para todos os algoritmos da lista
+# Retorna dicionário: algoritmo => valor do hash (hexadecimal)
+# Exemplo: calcular_hash_arquivo(caminho, ['md5', 'sha256']) => {'md5': '...', 'sha256': '...'}
+# Em caso de erro (leitura, por exemplo), gera exceção
+def calcular_hash_arquivo(caminho_arquivo, algoritmos=('sha256',), tamanho_bloco=None):
+
+    if tamanho_bloco is None:
+        tamanho_bloco = Ghash_tamanho_bloco
+
+    if len(algoritmos) == 0:
+        raise Exception("Nenhum algoritmo de hash informado")
+
+    # Algoritmo repetido é calculado uma única vez (cada buffer é liberado quando todos os algoritmos o processaram)
+    unicos = list()
+    for algoritmo in algoritmos:
+        if algoritmo not in unicos:
+            unicos.append(algoritmo)
+    algoritmos = unicos
+
+    # Valida os algoritmos antes de iniciar (gera exceção se algum não existir)
+    calculadores = dict()
+    for algoritmo in algoritmos:
+        calculadores[algoritmo] = hashlib.new(algoritmo)
+
+    # Buffers reaproveitados durante toda a leitura
+    buffers = [bytearray(tamanho_bloco) for i in range(Ghash_quantidade_buffers)]
+    buffers_livres = queue.Queue()
+    for i in range(len(buffers)):
+        buffers_livres.put(i)
+    # Quantidade de algoritmos que ainda não processaram cada buffer
+    pendencias = [0] * len(buffers)
+    pendencias_lock = threading.Lock()
+
+    # Cada algoritmo tem sua fila de blocos lidos: (indice do buffer, quantidade de bytes)
+    # O final do arquivo é sinalizado com None
+    filas = dict()
+    for algoritmo in algoritmos:
+        filas[algoritmo] = queue.Queue()
+
+    # Erros da leitura ou do cálculo. Após um erro, os calculadores apenas liberam os buffers recebidos
+    # (sem calcular), para que a leitura não fique aguardando buffer livre, e a leitura é interrompida
+    erros = list()
+
+    def liberar_buffer(ix):
+        with pendencias_lock:
+            pendencias[ix] -= 1
+            if pendencias[ix] == 0:
+                buffers_livres.put(ix)
+
+    def calcular(algoritmo):
+        m = calculadores[algoritmo]
+        fila = filas[algoritmo]
+        while True:
+            item = fila.get()
+            if item is None:
+                return
+            (ix, n) = item
+            try:
+                if len(erros) == 0:
+                    m.update(memoryview(buffers[ix])[:n])
+            except BaseException as e:
+                erros.append(e)
+            finally:
+                liberar_buffer(ix)
+
+    def ler():
+        try:
+            with open(caminho_arquivo, "rb") as f:
+                while True:
+                    ix = buffers_livres.get()
+                    if len(erros) > 0:
+                        # Falha em algum calculador
+                        break
+                    n = f.readinto(buffers[ix])
+                    if not n:
+                        break
+                    pendencias[ix] = len(algoritmos)
+                    for fila in filas.values():
+                        fila.put((ix, n))
+        except BaseException as e:
+            erros.append(e)
+        finally:
+            # Sinaliza o final para os calculadores
+            for fila in filas.values():
+                fila.put(None)
+
+    threads = [threading.Thread(target=calcular, args=(algoritmo,), name="sapi_hash_" + algoritmo)
+               for algoritmo in algoritmos]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    # A leitura é efetuada na thread corrente
+    ler()
+
+    for t in threads:
+        t.join()
+
+    if len(erros) > 0:
+        raise erros[0]
+
+    resultado = dict()
+    for algoritmo in algoritmos:
+        resultado[algoritmo] = calculadores[algoritmo].hexdigest()
+
+    return resultado
+
+
+# Calcula o hash de diversos arquivos, processando vários arquivos simultaneamente
+# Retorna dicionário: caminho do arquivo => dicionário (algoritmo => valor do hash)
+# Se ocorrer erro em algum arquivo, gera exceção
+def calcular_hash_arquivos(lista_arquivos, algoritmos=('sha256',), maximo_simultaneos=None):
+
+    if maximo_simultaneos is None:
+        maximo_simultaneos = Ghash_maximo_arquivos_simultaneos
+
+    resultado = dict()
+    if len(lista_arquivos) == 0:
+        return resultado
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maximo_simultaneos) as executor:
+        futuros = dict()
+        for caminho_arquivo in lista_arquivos:
+            futuro = executor.submit(calcular_hash_arquivo, caminho_arquivo, algoritmos)
+            futuros[futuro] = caminho_arquivo
+
+        for futuro in concurrent.futures.as_completed(futuros):
+            resultado[futuros[futuro]] = futuro.result()
+
+    return resultado
+
+
+# -----------------------------------------------------------------------------------
+# Manifesto de hash de pasta
+# -----------------------------------------------------------------------------------
+# O manifesto contém o hash de cada arquivo da pasta (e subpastas) e um hash raiz, que representa a pasta inteira.
+# É gravado na própria pasta (Gnome_arquivo_manifesto_hash), de modo que acompanha a pasta quando esta for copiada.
+# Formato (texto utf-8):
+#   # linhas de cabeçalho (versão, algoritmo, raiz)
+#   hash <tab> tamanho <tab> data_modificacao <tab> caminho relativo (separador '/')
+# O hash raiz é o hash (mesmo algoritmo) da concatenação das linhas "hash  caminho_relativo\n",
+# em ordem de caminho relativo (equivale à saída do sha256sum ordenada por caminho).
+Gnome_arquivo_manifesto_hash = "sapi_manifesto_hash.txt"
+Gversao_manifesto_hash = 1
+
+
+# Lista os arquivos da pasta (recursivo), exceto o próprio manifesto
+# Retorna dicionário: caminho relativo => {caminho, tamanho, data_modificacao}
+def _listar_arquivos_manifesto_hash(pasta):
+    arquivos = dict()
+    for raiz, subpastas, nomes_arquivos in os.walk(pasta):
+        relativo_raiz = os.path.relpath(raiz, pasta)
+        for nome in nomes_arquivos:
+            if relativo_raiz == "." and nome == Gnome_arquivo_manifesto_hash:
+                continue
+            caminho = os.path.join(raiz, nome)
+            if relativo_raiz == ".":
+                relativo = nome
+            else:
+                relativo = os.path.join(relativo_raiz, nome)
+            relativo = relativo.replace("\\", "/")
+            st = os.stat(caminho)
+            arquivos[relativo] = {
+                'caminho': caminho,
+                'tamanho': st.st_size,
+                'data_modificacao': int(st.st_mtime)
+            }
+    return arquivos
+
+
+# Calcula o hash raiz, a partir do hash de cada arquivo
+def _calcular_raiz_manifesto_hash(arquivos, algoritmo):
+    m = hashlib.new(algoritmo)
+    for relativo in sorted(arquivos):
+        m.update((arquivos[relativo]['hash'] + "  " + relativo + "\n").encode('utf-8'))
+    return m.hexdigest()
+
+
+def gravar_manifesto_hash(pasta, manifesto):
+    caminho_manifesto = os.path.join(pasta, Gnome_arquivo_manifesto_hash)
+    with open(caminho_manifesto, "w", encoding="utf-8", newline="\n") as f:
+        f.write("# SAPI - Manifesto de hash\n")
+        f.write("# versao: " + str(Gversao_manifesto_hash) + "\n")
+        f.write("# algoritmo: " + manifesto['algoritmo'] + "\n")
+        f.write("# raiz: " + manifesto['raiz'] + "\n")
+        f.write("# hash<tab>tamanho<tab>data_modificacao<tab>caminho\n")
+        for relativo in sorted(manifesto['arquivos']):
+            a = manifesto['arquivos'][relativo]
+            f.write("\t".join([a['hash'], str(a['tamanho']), str(a['data_modificacao']), relativo]) + "\n")
+    return caminho_manifesto
+
+
+# Carrega o manifesto gravado na pasta
+# Retorna None se a pasta não possuir manifesto
+def carregar_manifesto_hash(pasta):
+    caminho_manifesto = os.path.join(pasta, Gnome_arquivo_manifesto_hash)
+    if not os.path.isfile(caminho_manifesto):
+        return None
+
+    manifesto = {'algoritmo': None, 'raiz': None, 'arquivos': dict()}
+    with open(caminho_manifesto, "r", encoding="utf-8") as f:
+        for linha in f:
+            linha = linha.rstrip("\n")
+            if linha.startswith("#"):
+                for chave in ['algoritmo', 'raiz']:
+                    prefixo = "# " + chave + ": "
+                    if linha.startswith(prefixo):
+                        manifesto[chave] = linha[len(prefixo):].strip()
+                continue
+            if linha == "":
+                continue
+            (valor_hash, tamanho, data_modificacao, relativo) = linha.split("\t", 3)
+            manifesto['arquivos'][relativo] = {
+                'hash': valor_hash,
+                'tamanho': int(tamanho),
+                'data_modificacao': int(data_modificacao)
+            }
+
+    if manifesto['algoritmo'] is None:
+        raise Exception("Manifesto de hash sem algoritmo: " + caminho_manifesto)
+
+    _completar_manifesto_hash(manifesto)
+    return manifesto
+
+
+def _completar_manifesto_hash(manifesto):
+    manifesto['quantidade_arquivos'] = len(manifesto['arquivos'])
+    manifesto['tamanho_total'] = sum(a['tamanho'] for a in manifesto['arquivos'].values())
+
+
+# Gera (e grava na pasta) o manifesto de hash da pasta
+# Todos os arquivos são lidos, em paralelo (calcular_hash_arquivos)
+# Retorna o manifesto (dicionário), contendo algoritmo, raiz, arquivos, quantidade_arquivos e tamanho_total
+def gerar_manifesto_hash(pasta, algoritmo='sha256', gravar=True):
+
+    arquivos = _listar_arquivos_manifesto_hash(pasta)
+    print_log("Gerando manifesto de hash para", pasta, "com", len(arquivos), "arquivos")
+
+    caminhos = [a['caminho'] for a in arquivos.values()]
+    hashes = calcular_hash_arquivos(caminhos, [algoritmo])
+    for relativo in arquivos:
+        a = arquivos[relativo]
+        a['hash'] = hashes[a.pop('caminho')][algoritmo]
+
+    manifesto = dict()
+    manifesto['algoritmo'] = algoritmo
+    manifesto['arquivos'] = arquivos
+    manifesto['raiz'] = _calcular_raiz_manifesto_hash(arquivos, algoritmo)
+    _completar_manifesto_hash(manifesto)
+
+    if gravar:
+        caminho_manifesto = gravar_manifesto_hash(pasta, manifesto)
+        print_log("Manifesto de hash gravado em", caminho_manifesto, "- raiz:", manifesto['raiz'])
+
+    return manifesto
+
+
+# Confere a pasta contra o manifesto de hash
+# - apenas_alterados=True: Recalcula o hash apenas dos arquivos com tamanho ou data de modificação diferente
+#   do manifesto (conferência rápida, por exemplo, para detectar alterações na pasta de origem)
+# - apenas_alterados=False: Recalcula o hash de todos os arquivos (por exemplo, conferência de cópia,
+#   na qual o manifesto veio da origem e apenas o destino é lido)
+# - recalcular: Lista de caminhos relativos cujo hash é sempre recalculado, mesmo com apenas_alterados=True
+#   (por exemplo, os arquivos copiados em uma sincronização)
+# Se o manifesto não for informado, utiliza o manifesto gravado na pasta
+# Retorna dicionário com:
+#  - sucesso: True se a pasta confere integralmente com o manifesto
+#  - faltando: Arquivos do manifesto que não existem na pasta
+#  - extras: Arquivos da pasta que não constam no manifesto
+#  - divergentes: Arquivos com hash diferente do manifesto
+#  - quantidade_recalculados: Quantidade de arquivos que tiveram o hash recalculado
+#  - raiz: Hash raiz calculado para a situação atual da pasta
+#  - manifesto: Manifesto correspondente à situação atual da pasta
+def verificar_manifesto_hash(pasta, manifesto=None, apenas_alterados=True, recalcular=None):
+
+    if manifesto is None:
+        manifesto = carregar_manifesto_hash(pasta)
+        if manifesto is None:
+            raise Exception("Pasta não possui manifesto de hash: " + pasta)
+    algoritmo = manifesto['algoritmo']
+
+    atuais = _listar_arquivos_manifesto_hash(pasta)
+
+    faltando = sorted(set(manifesto['arquivos']) - set(atuais))
+    extras = sorted(set(atuais) - set(manifesto['arquivos']))
+
+    # Seleciona os arquivos que precisam ter o hash recalculado
+    sempre_recalcular = set(recalcular or [])
+    recalcular = dict()
+    for relativo in atuais:
+        a = atuais[relativo]
+        m = manifesto['arquivos'].get(relativo, None)
+        if m is not None \
+                and apenas_alterados \
+                and relativo not in sempre_recalcular \
+                and a['tamanho'] == m['tamanho'] \
+                and a['data_modificacao'] == m['data_modificacao']:
+            # Inalterado, considera o hash do manifesto
+            a['hash'] = m['hash']
+            continue
+        recalcular[a['caminho']] = relativo
+
+    print_log("Conferindo manifesto de hash de", pasta, ":", len(recalcular), "arquivos serão recalculados")
+    hashes = calcular_hash_arquivos(list(recalcular.keys()), [algoritmo])
+    for caminho in recalcular:
+        atuais[recalcular[caminho]]['hash'] = hashes[caminho][algoritmo]
+
+    divergentes = list()
+    for relativo in sorted(atuais):
+        m = manifesto['arquivos'].get(relativo, None)
+        if m is not None and m['hash'] != atuais[relativo]['hash']:
+            divergentes.append(relativo)
+
+    res = dict()
+    res['faltando'] = faltando
+    res['extras'] = extras
+    res['divergentes'] = divergentes
+    res['quantidade_recalculados'] = len(recalcular)
+    res['raiz'] = _calcular_raiz_manifesto_hash(atuais, algoritmo)
+    res['sucesso'] = (len(faltando) == 0 and len(extras) == 0 and len(divergentes) == 0)
+
+    for a in atuais.values():
+        a.pop('caminho')
+    res['manifesto'] = {'algoritmo': algoritmo, 'arquivos': atuais, 'raiz': res['raiz']}
+    _completar_manifesto_hash(res['manifesto'])
+
+    return res
+
+
+# Confere a pasta contra o manifesto (ver verificar_manifesto_hash), lendo todos os arquivos da pasta
+# Utilizado para conferir uma cópia: o manifesto foi gerado a partir da origem (ou durante a própria cópia),
+# e apenas o destino é lido.
+# recalcular: Se informado (lista de caminhos relativos), lê apenas estes arquivos e os arquivos com tamanho ou
+#   data de modificação diferente do manifesto (por exemplo, conferência após uma sincronização)
+# Em caso de divergência, registra os arquivos divergentes no log e gera exceção
+# Retorna o resultado de verificar_manifesto_hash
+def conferir_pasta_manifesto_hash(pasta, manifesto=None, recalcular=None):
+    res = verificar_manifesto_hash(pasta, manifesto=manifesto, apenas_alterados=(recalcular is not None),
+                                   recalcular=recalcular)
+    if not res['sucesso']:
+        for chave in ['divergentes', 'faltando', 'extras']:
+            for relativo in res[chave]:
+                print_log("Divergência de hash na cópia (", chave, "):", relativo)
+        raise Exception(texto("[3873] Divergência de hash na cópia da pasta", pasta, ":",
+                              len(res['divergentes']), "divergentes,", len(res['faltando']), "faltando,",
+                              len(res['extras']), "extras"))
+    print_log("Hash confere para", res['manifesto']['quantidade_arquivos'], "arquivos de", pasta,
+              "- raiz:", res['raiz'])
+    return res
+
+
+# ===================================================================================
+# Cópia de pasta (paralela)
+# ===================================================================================
+# Copia a pasta (e subpastas) copiando vários arquivos simultaneamente (Gcopia_maximo_threads), com blocos grandes.
+# - No Linux, o conteúdo é copiado pelo kernel (os.copy_file_range ou os.sendfile), sem passar pelo python.
+#   Nos demais casos (Windows, ou sistema de arquivos sem suporte), é copiado via buffer (readinto),
+#   reaproveitando um buffer por thread.
+# - As datas (e permissões) dos arquivos e pastas são preservadas (shutil.copystat)
+# - O tamanho de cada arquivo copiado é conferido logo após a cópia, de modo que o resumo retornado
+#   já serve como conferência (não é necessário percorrer a pasta de destino novamente)
+# - Opcionalmente (algoritmo_hash), calcula o hash de cada arquivo durante a própria cópia (sobre os mesmos
+#   blocos lidos da origem) e grava o manifesto de hash (Gnome_arquivo_manifesto_hash) na pasta de destino.
+#   Deste modo, a conferência do conteúdo (conferir_pasta_manifesto_hash) precisa ler apenas o destino.
+#   Neste modo, a cópia é sempre efetuada via buffer (o conteúdo precisa passar pelo python).
+# - Opcionalmente (retomavel), mantém na pasta de destino um diário da cópia (Gnome_arquivo_diario_copia),
+#   com os arquivos iniciados e concluídos. Se a cópia for interrompida (ex: queda da conexão com o storage),
+#   uma nova cópia para o mesmo destino aproveita os arquivos concluídos e continua os arquivos parciais
+#   a partir do ponto em que pararam. Ao final da cópia, o diário é excluído.
+# - Opcionalmente (sincronizar), atualiza uma pasta de destino existente, copiando apenas os arquivos novos ou
+#   alterados (tamanho ou data de modificação) e excluindo do destino o que não existe mais na origem.
+# - Suporta caminhos longos (\\?\ e \\?\UNC\)
+# - Links para pastas não são percorridos (mesmo comportamento do obter_caracteristicas_pasta)
+
+# Quantidade de arquivos copiados simultaneamente
+Gcopia_maximo_threads = 8
+# Tamanho do bloco de cópia
+Gcopia_tamanho_bloco = 8 * 1024 * 1024
+# Intervalo mínimo (segundos) entre chamadas da função de progresso
+Gcopia_intervalo_progresso = 30
+
+# Diário da cópia retomável
+# Formato (texto utf-8), uma linha por evento, na ordem em que ocorreram:
+#   tipo <tab> tamanho <tab> data_modificacao <tab> hash <tab> caminho relativo (separador '/')
+# tipo: I (cópia do arquivo iniciada) ou C (cópia do arquivo concluída)
+# tamanho e data_modificacao: Do arquivo de origem
+# hash: Hash do conteúdo (apenas tipo C, quando calculado) ou '-'
+Gnome_arquivo_diario_copia = "sapi_diario_copia.txt"
+
+
+def _copia_kernel_copy_file_range(fd_origem, fd_destino, posicao, quantidade):
+    return os.copy_file_range(fd_origem, fd_destino, quantidade, posicao, posicao)
+
+
+def _copia_kernel_sendfile(fd_origem, fd_destino, posicao, quantidade):
+    os.lseek(fd_destino, posicao, os.SEEK_SET)
+    return os.sendfile(fd_destino, fd_origem, posicao, quantidade)
+
+
+# Métodos de cópia pelo kernel disponíveis, em ordem de preferência
+Gcopia_metodos_kernel = list()
+if hasattr(os, 'copy_file_range'):
+    Gcopia_metodos_kernel.append(_copia_kernel_copy_file_range)
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+    Gcopia_metodos_kernel.append(_copia_kernel_sendfile)
+
+# Erros que indicam que o método de cópia pelo kernel não se aplica (passa para o próximo método)
+Gcopia_erros_kernel_sem_suporte = set()
+for _nome_erro in ['EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'EBADF', 'ETXTBSY']:
+    if hasattr(errno, _nome_erro):
+        Gcopia_erros_kernel_sem_suporte.add(getattr(errno, _nome_erro))
+
+
+# Lista o conteúdo da pasta de origem
+# Retorna (lista de subpastas relativas, lista de arquivos (relativo, tamanho, data_modificacao))
+# seguir_links: Links simbólicos para pastas são percorridos, e o conteúdo é copiado como pasta comum
+#   (da mesma forma que shutil.copytree com symlinks=False). Cada link é registrado no log.
+#   Link que aponta para a própria pasta ou para uma pasta acima (ciclo) gera exceção.
+#   Sem seguir_links (listagem do destino, na sincronização), links para pastas são ignorados,
+#   para que a exclusão nunca alcance conteúdo fora da pasta
+def _listar_pasta_copia(pasta, seguir_links=True):
+    subpastas = list()
+    arquivos = list()
+    pendentes = [""]
+    while len(pendentes) > 0:
+        relativo_pasta = pendentes.pop()
+        for entrada in os.scandir(os.path.join(pasta, relativo_pasta)):
+            relativo = os.path.join(relativo_pasta, entrada.name)
+            if entrada.is_dir():
+                if entrada.is_symlink():
+                    if not seguir_links:
+                        continue
+                    alvo = os.path.realpath(entrada.path)
+                    atual = os.path.realpath(os.path.join(pasta, relativo_pasta))
+                    if atual == alvo or atual.startswith(alvo.rstrip(os.sep) + os.sep):
+                        raise Exception("Link simbólico " + entrada.path + " aponta para pasta acima (" + alvo +
+                                        "). Cópia não pode ser efetuada")
+                    print_log("Link simbólico", entrada.path, "aponta para", alvo, ". Conteúdo será copiado")
+                subpastas.append(relativo)
+                pendentes.append(relativo)
+                continue
+            st = entrada.stat()
+            arquivos.append((relativo, st.st_size, int(st.st_mtime)))
+    return (subpastas, arquivos)
+
+
+# Limite de banda: Retorna o tempo (segundos) que a cópia deve aguardar após copiar n bytes,
+# para que a taxa de cópia não ultrapasse o limite (bytes por segundo, número ou multiprocessing.Value)
+# Balde de fichas: controle['proximo'] é o instante a partir do qual a cópia pode prosseguir.
+# Cada bloco copiado empurra este instante em n/limite segundos, de modo que o débito acumulado
+# é preservado entre chamadas (e entre threads, que compartilham o mesmo controle).
+# O tempo ocioso não gera crédito, logo não há rajadas acima do limite.
+# Deve ser invocada com o lock que protege controle adquirido
+def _calcular_espera_banda(controle, n, limite_banda):
+    if limite_banda is not None and hasattr(limite_banda, 'value'):
+        limite_banda = limite_banda.value
+    if not limite_banda or limite_banda <= 0:
+        return 0
+    agora = time.monotonic()
+    controle['proximo'] = max(agora, controle['proximo']) + n / float(limite_banda)
+    return controle['proximo'] - agora
+
+
+# Carrega o diário de uma cópia retomável (ver Gnome_arquivo_diario_copia)
+# Retorna dicionário com:
+#  - iniciados: Arquivos com cópia iniciada e não concluída
+#  - concluidos: Arquivos com cópia concluída
+# Cada um é um dicionário: caminho relativo => {tamanho, data_modificacao, hash}
+def _carregar_diario_copia(caminho_diario):
+    diario = {'iniciados': dict(), 'concluidos': dict()}
+    if not os.path.isfile(caminho_diario):
+        return diario
+    with open(caminho_diario, "r", encoding="utf-8") as f:
+        for linha in f:
+            # Linha incompleta (interrupção durante a gravação) é desprezada
+            if not linha.endswith("\n"):
+                break
+            try:
+                (tipo, tamanho, data_modificacao, valor_hash, relativo) = linha.rstrip("\n").split("\t", 4)
+                registro = {'tamanho': int(tamanho), 'data_modificacao': int(data_modificacao), 'hash': valor_hash}
+            except ValueError:
+                continue
+            if tipo == "I":
+                diario['concluidos'].pop(relativo, None)
+                diario['iniciados'][relativo] = registro
+            elif tipo == "C":
+                diario['iniciados'].pop(relativo, None)
+                diario['concluidos'][relativo] = registro
+    return diario
+
+
+# Lê os primeiros bytes do arquivo (posição atual até quantidade), atualizando o hash
+# Utilizado na retomada de um arquivo parcial, para que o hash corresponda ao conteúdo integral da origem
+def _atualizar_hash_arquivo(f, quantidade, buffer, objeto_hash):
+    visao = memoryview(buffer)
+    lido = 0
+    while lido < quantidade:
+        n = f.readinto(visao[:min(len(buffer), quantidade - lido)])
+        if not n:
+            break
+        objeto_hash.update(visao[:n])
+        lido += n
+    return lido
+
+
+# Copia o conteúdo de um arquivo aberto (sem buffer do python) para outro
+# progresso: Função chamada com a quantidade de bytes de cada bloco copiado
+# objeto_hash: Se informado (hashlib), é atualizado com o conteúdo copiado
+# inicio: Posição a partir da qual a cópia é efetuada (retomada); o conteúdo anterior já está no destino
+# Retorna a quantidade de bytes do arquivo de destino (inclusive o conteúdo anterior ao inicio)
+def _copiar_conteudo_arquivo(f_origem, f_destino, tamanho, buffer, progresso, objeto_hash=None, inicio=0):
+    fd_origem = f_origem.fileno()
+    fd_destino = f_destino.fileno()
+    copiado = inicio
+
+    # Cópia pelo kernel (o conteúdo não passa pelo python, logo não se aplica quando é necessário o hash)
+    metodos_kernel = Gcopia_metodos_kernel
+    if objeto_hash is not None:
+        metodos_kernel = list()
+    for metodo in metodos_kernel:
+        try:
+            while copiado < tamanho:
+                n = metodo(fd_origem, fd_destino, copiado, min(len(buffer), tamanho - copiado))
+                if n == 0:
+                    break
+                copiado += n
+                progresso(n)
+            break
+        except OSError as e:
+            if e.errno not in Gcopia_erros_kernel_sem_suporte:
+                raise
+
+    # Via buffer, continuando de onde parou (ou o restante, se o arquivo cresceu durante a cópia)
+    f_origem.seek(copiado)
+    f_destino.seek(copiado)
+    visao = memoryview(buffer)
+    while True:
+        n = f_origem.readinto(buffer)
+        if not n:
+            break
+        f_destino.write(visao[:n])
+        if objeto_hash is not None:
+            objeto_hash.update(visao[:n])
+        copiado += n
+        progresso(n)
+
+    return copiado
+
+
+# Copia a pasta_origem para pasta_destino
+# A pasta de destino é criada, se não existir. Arquivos já existentes no destino são sobrepostos.
+# progresso: Função opcional, chamada periodicamente (Gcopia_intervalo_progresso) e ao final com um dicionário:
+#   {'bytes_copiados', 'tamanho_total', 'arquivos_copiados', 'quantidade_arquivos'}
+# algoritmo_hash: Se informado (ex: 'sha256'), calcula o hash dos arquivos durante a cópia e grava o manifesto
+#   de hash na pasta de destino. Um manifesto existente na raiz da origem é substituído pelo novo.
+# retomavel: Mantém o diário da cópia no destino, e retoma a cópia anterior, se houver diário.
+#   Arquivos concluídos são aproveitados se a origem não foi alterada (tamanho e data de modificação) e o
+#   arquivo de destino tem o tamanho esperado. Arquivos parciais são continuados (a partir do penúltimo bloco
+#   gravado). Arquivos que constam no diário mas não existem mais na origem são excluídos do destino.
+# sincronizar: Compara origem e destino (tamanho e data de modificação), e copia apenas os arquivos novos ou
+#   alterados. Arquivos e pastas do destino que não existem na origem são excluídos.
+#   Com algoritmo_hash, o hash dos arquivos inalterados é obtido do manifesto de hash existente no destino
+#   (se não constar no manifesto, o arquivo é copiado novamente).
+# sincronizar_hash: Na sincronização, arquivos com mesmo tamanho mas data de modificação diferente têm o hash
+#   da origem calculado e comparado com o manifesto do destino. Se for igual, apenas as datas são ajustadas
+#   (evita regravar no destino arquivos que foram apenas "tocados" na origem). Requer algoritmo_hash.
+# limite_banda: Taxa máxima de cópia (bytes por segundo). Pode ser um número ou um multiprocessing.Value,
+#   que pode ser alterado durante a cópia (ver fila de cópias). Zero ou None: sem limite
+# Retorna dicionário com o resumo da cópia:
+#  - quantidade_arquivos, quantidade_pastas (inclusive a própria pasta), tamanho_total: Da origem
+#  - bytes_copiados: Total gravado no destino (inclusive o conteúdo aproveitado de cópia anterior)
+#  - bytes_aproveitados, arquivos_aproveitados: Conteúdo aproveitado de cópia anterior (retomavel ou sincronizar)
+#  - copiados: Lista dos arquivos (caminho relativo, separador '/') efetivamente copiados nesta execução
+#  - excluidos: Lista dos arquivos e pastas excluídos do destino (sincronizar)
+#  - assinatura: Assinatura da listagem: sha256 da lista de arquivos (caminho relativo e tamanho).
+#    Não é hash do conteúdo (ver manifesto)
+#  - manifesto: Manifesto de hash da cópia (apenas se algoritmo_hash foi informado)
+#  - tempo (segundos)
+# Em caso de erro (ou divergência de tamanho de algum arquivo), gera exceção
+def copiar_pasta_paralelo(pasta_origem, pasta_destino, progresso=None, maximo_threads=None, tamanho_bloco=None,
+                          algoritmo_hash=None, retomavel=False, sincronizar=False, sincronizar_hash=False,
+                          limite_banda=None):
+
+    if maximo_threads is None:
+        maximo_threads = Gcopia_maximo_threads
+    if tamanho_bloco is None:
+        tamanho_bloco = Gcopia_tamanho_bloco
+
+    inicio = time.time()
+    origem = _caminho_longo_scandir(pasta_origem)
+    destino = _caminho_longo_scandir(pasta_destino)
+    if not os.path.isdir(origem):
+        raise Exception(texto('[3870] Pasta de origem não encontrada: ', pasta_origem))
+
+    (subpastas, arquivos) = _listar_pasta_copia(origem)
+    tamanho_total = sum(tamanho for (relativo, tamanho, data_modificacao) in arquivos)
+
+    # Estrutura de pastas
+    os.makedirs(destino, exist_ok=True)
+    for relativo in subpastas:
+        os.makedirs(os.path.join(destino, relativo), exist_ok=True)
+
+    # Diário da cópia anterior (retomada)
+    caminho_diario = os.path.join(destino, Gnome_arquivo_diario_copia)
+    diario = {'iniciados': dict(), 'concluidos': dict()}
+    f_diario = None
+    if retomavel:
+        diario = _carregar_diario_copia(caminho_diario)
+        if len(diario['iniciados']) + len(diario['concluidos']) > 0:
+            print_log("Retomando cópia para", pasta_destino, ":", len(diario['concluidos']), "arquivos concluídos e",
+                      len(diario['iniciados']), "parciais na cópia anterior")
+        # Arquivos copiados anteriormente que não existem mais na origem
+        relativos_origem = set(relativo.replace("\\", "/") for (relativo, tamanho, data_modificacao) in arquivos)
+        for relativo in set(diario['iniciados']) | set(diario['concluidos']):
+            if relativo not in relativos_origem:
+                caminho_excluir = os.path.join(destino, relativo.replace("/", os.sep))
+                if os.path.isfile(caminho_excluir):
+                    print_log("Excluindo do destino arquivo que não existe mais na origem:", relativo)
+                    os.remove(caminho_excluir)
+        f_diario = open(caminho_diario, "a", encoding="utf-8", newline="\n")
+
+    # Situação atual do destino (sincronização)
+    # Arquivos do destino: caminho relativo (separador '/') => (tamanho, data_modificacao)
+    atuais_destino = dict()
+    hashes_destino = dict()
+    excluidos = list()
+    if sincronizar:
+        (subpastas_destino, arquivos_destino) = _listar_pasta_copia(destino, seguir_links=False)
+        # Exclui pastas e arquivos que não existem na origem
+        conjunto_subpastas = set(subpastas)
+        for relativo in sorted(subpastas_destino):
+            if relativo in conjunto_subpastas or not os.path.isdir(os.path.join(destino, relativo)):
+                continue
+            print_log("Sincronização: Excluindo pasta do destino que não existe na origem:", relativo)
+            shutil.rmtree(os.path.join(destino, relativo))
+            excluidos.append(relativo.replace("\\", "/") + "/")
+        conjunto_arquivos = set(relativo for (relativo, tamanho, data_modificacao) in arquivos)
+        for (relativo, tamanho, data_modificacao) in arquivos_destino:
+            caminho_destino = os.path.join(destino, relativo)
+            if relativo in conjunto_arquivos:
+                atuais_destino[relativo.replace("\\", "/")] = (tamanho, data_modificacao)
+                continue
+            if relativo in [Gnome_arquivo_manifesto_hash, Gnome_arquivo_diario_copia] \
+                    or not os.path.isfile(caminho_destino):
+                continue
+            print_log("Sincronização: Excluindo arquivo do destino que não existe na origem:", relativo)
+            os.remove(caminho_destino)
+            excluidos.append(relativo.replace("\\", "/"))
+        # Hash dos arquivos inalterados, a partir do manifesto de hash do destino
+        if algoritmo_hash is not None:
+            manifesto_destino = carregar_manifesto_hash(destino)
+            if manifesto_destino is not None and manifesto_destino['algoritmo'] == algoritmo_hash:
+                hashes_destino = manifesto_destino['arquivos']
+
+    situacao = {'bytes_copiados': 0,
+                'tamanho_total': tamanho_total,
+                'arquivos_copiados': 0,
+                'quantidade_arquivos': len(arquivos)}
+    aproveitado = {'bytes': 0, 'arquivos': 0}
+    copiados = list()
+    situacao_lock = threading.Lock()
+    ultimo_progresso = [time.time()]
+    erros = list()
+    buffers = threading.local()
+    # Arquivos do manifesto de hash: caminho relativo => {hash, tamanho, data_modificacao}
+    arquivos_manifesto = dict()
+
+    controle_banda = {'proximo': 0}
+
+    def acumular(n):
+        copia_situacao = None
+        with situacao_lock:
+            situacao['bytes_copiados'] += n
+            espera = _calcular_espera_banda(controle_banda, n, limite_banda)
+            if progresso is not None and time.time() - ultimo_progresso[0] >= Gcopia_intervalo_progresso:
+                ultimo_progresso[0] = time.time()
+                copia_situacao = dict(situacao)
+        if copia_situacao is not None:
+            progresso(copia_situacao)
+        if espera > 0:
+            time.sleep(espera)
+
+    def registrar_diario(tipo, relativo_diario, tamanho, data_modificacao, valor_hash):
+        if f_diario is None:
+            return
+        with situacao_lock:
+            f_diario.write("\t".join([tipo, str(tamanho), str(data_modificacao), valor_hash, relativo_diario]) + "\n")
+            f_diario.flush()
+
+    def concluir(relativo_diario, tamanho, data_modificacao, valor_hash, copiado=True):
+        registrar_diario("C", relativo_diario, tamanho, data_modificacao, valor_hash)
+        with situacao_lock:
+            situacao['arquivos_copiados'] += 1
+            if copiado:
+                copiados.append(relativo_diario)
+            else:
+                aproveitado['bytes'] += tamanho
+                aproveitado['arquivos'] += 1
+            if valor_hash != "-":
+                arquivos_manifesto[relativo_diario] = {
+                    'hash': valor_hash,
+                    'tamanho': tamanho,
+                    'data_modificacao': data_modificacao
+                }
+
+    def copiar(relativo, tamanho, data_modificacao):
+        # Após um erro, não inicia a cópia dos demais arquivos
+        if len(erros) > 0:
+            return
+        try:
+            if not hasattr(buffers, 'buffer'):
+                buffers.buffer = bytearray(tamanho_bloco)
+            caminho_origem = os.path.join(origem, relativo)
+            caminho_destino = os.path.join(destino, relativo)
+            relativo_diario = relativo.replace("\\", "/")
+
+            # Situação do arquivo na cópia anterior
+            tamanho_anterior = None
+            if retomavel and os.path.isfile(caminho_destino):
+                tamanho_anterior = os.stat(caminho_destino).st_size
+            concluido = diario['concluidos'].get(relativo_diario, None)
+            iniciado = diario['iniciados'].get(relativo_diario, None)
+
+            # Arquivo concluído na cópia anterior: Aproveita
+            if concluido is not None \
+                    and concluido['tamanho'] == tamanho \
+                    and concluido['data_modificacao'] == data_modificacao \
+                    and tamanho_anterior == tamanho \
+                    and (algoritmo_hash is None or concluido['hash'] != "-"):
+                acumular(tamanho)
+                concluir(relativo_diario, tamanho, data_modificacao, concluido['hash'], copiado=False)
+                return
+
+            # Sincronização: Arquivo inalterado no destino é aproveitado
+            atual = atuais_destino.get(relativo_diario, None)
+            anterior_hash = hashes_destino.get(relativo_diario, None)
+            if atual is not None and atual[0] == tamanho \
+                    and (algoritmo_hash is None or
+                         (anterior_hash is not None and anterior_hash['tamanho'] == tamanho)):
+                valor_hash = "-"
+                if anterior_hash is not None:
+                    valor_hash = anterior_hash['hash']
+                aproveitar = False
+                if atual[1] == data_modificacao \
+                        and (anterior_hash is None or anterior_hash['data_modificacao'] == data_modificacao):
+                    aproveitar = True
+                elif sincronizar_hash and algoritmo_hash is not None:
+                    # Data alterada: Compara o hash da origem com o manifesto do destino
+                    objeto_hash = hashlib.new(algoritmo_hash)
+                    with open(caminho_origem, 'rb', buffering=0) as f_origem:
+                        _atualizar_hash_arquivo(f_origem, tamanho, buffers.buffer, objeto_hash)
+                    if objeto_hash.hexdigest() == valor_hash:
+                        shutil.copystat(caminho_origem, caminho_destino)
+                        aproveitar = True
+                if aproveitar:
+                    acumular(tamanho)
+                    concluir(relativo_diario, tamanho, data_modificacao, valor_hash, copiado=False)
+                    return
+
+            # Arquivo parcial na cópia anterior: Continua a partir do penúltimo bloco gravado
+            # (o último pode ter sido gravado apenas parcialmente)
+            inicio = 0
+            if iniciado is not None \
+                    and iniciado['tamanho'] == tamanho \
+                    and iniciado['data_modificacao'] == data_modificacao \
+                    and tamanho_anterior is not None:
+                inicio = max(0, (min(tamanho_anterior, tamanho) // tamanho_bloco - 1) * tamanho_bloco)
+
+            registrar_diario("I", relativo_diario, tamanho, data_modificacao, "-")
+            objeto_hash = None
+            if algoritmo_hash is not None:
+                objeto_hash = hashlib.new(algoritmo_hash)
+            modo_destino = 'wb'
+            if inicio > 0:
+                modo_destino = 'r+b'
+            with open(caminho_origem, 'rb', buffering=0) as f_origem, \
+                    open(caminho_destino, modo_destino, buffering=0) as f_destino:
+                if inicio > 0:
+                    # O hash é calculado sobre o conteúdo da origem
+                    if objeto_hash is not None:
+                        inicio = _atualizar_hash_arquivo(f_origem, inicio, buffers.buffer, objeto_hash)
+                    acumular(inicio)
+                    with situacao_lock:
+                        aproveitado['bytes'] += inicio
+                copiado = _copiar_conteudo_arquivo(f_origem, f_destino, tamanho, buffers.buffer, acumular,
+                                                   objeto_hash, inicio)
+                f_destino.truncate(copiado)
+                tamanho_destino = os.fstat(f_destino.fileno()).st_size
+            if copiado != tamanho or tamanho_destino != tamanho:
+                raise Exception(texto('[3871] Divergência de tamanho na cópia de', relativo, ': origem', tamanho,
+                                      'bytes, copiados', copiado, 'bytes, destino', tamanho_destino, 'bytes'))
+            shutil.copystat(caminho_origem, caminho_destino)
+            valor_hash = "-"
+            if objeto_hash is not None:
+                valor_hash = objeto_hash.hexdigest()
+            concluir(relativo_diario, tamanho, data_modificacao, valor_hash)
+        except BaseException as e:
+            erros.append(e)
+
+    # Os maiores primeiro, para equilibrar a carga entre as threads
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maximo_threads) as executor:
+            for (relativo, tamanho, data_modificacao) in sorted(arquivos, key=lambda a: a[1], reverse=True):
+                executor.submit(copiar, relativo, tamanho, data_modificacao)
+    finally:
+        if f_diario is not None:
+            f_diario.close()
+
+    if len(erros) > 0:
+        raise Exception(texto('[3872] Cópia de', pasta_origem, 'falhou em', len(erros), 'arquivo(s). Primeiro erro:',
+                              str(erros[0])))
+
+    # Manifesto de hash, gravado antes de ajustar as datas das pastas
+    manifesto = None
+    if algoritmo_hash is not None:
+        arquivos_manifesto.pop(Gnome_arquivo_manifesto_hash, None)
+        manifesto = dict()
+        manifesto['algoritmo'] = algoritmo_hash
+        manifesto['arquivos'] = arquivos_manifesto
+        manifesto['raiz'] = _calcular_raiz_manifesto_hash(arquivos_manifesto, algoritmo_hash)
+        _completar_manifesto_hash(manifesto)
+        caminho_manifesto = gravar_manifesto_hash(destino, manifesto)
+        print_log("Manifesto de hash da cópia gravado em", caminho_manifesto, "- raiz:", manifesto['raiz'])
+
+    # Cópia concluída, o diário não é mais necessário
+    if retomavel:
+        os.remove(caminho_diario)
+
+    # Datas das pastas (após a gravação dos arquivos, que altera a data da pasta)
+    for relativo in sorted(subpastas, reverse=True) + [""]:
+        shutil.copystat(os.path.join(origem, relativo), os.path.join(destino, relativo))
+
+    if progresso is not None:
+        progresso(dict(situacao))
+
+    assinatura = hashlib.sha256()
+    for (relativo, tamanho, data_modificacao) in sorted(arquivos):
+        assinatura.update((relativo.replace("\\", "/") + "\t" + str(tamanho) + "\n").encode('utf-8'))
+
+    resumo = dict()
+    resumo['quantidade_arquivos'] = len(arquivos)
+    resumo['quantidade_pastas'] = len(subpastas) + 1
+    resumo['tamanho_total'] = tamanho_total
+    resumo['bytes_copiados'] = situacao['bytes_copiados']
+    resumo['bytes_aproveitados'] = aproveitado['bytes']
+    resumo['arquivos_aproveitados'] = aproveitado['arquivos']
+    resumo['copiados'] = sorted(copiados)
+    resumo['excluidos'] = excluidos
+    resumo['assinatura'] = assinatura.hexdigest()
+    if manifesto is not None:
+        resumo['manifesto'] = manifesto
+    resumo['tempo'] = time.time() - inicio
+    return resumo
+
+
 # ===================================================================================
 # Cópia via Robocopy
 # ===================================================================================
@@ -3419,7 +6186,10 @@ def converte_bytes_humano(size, precision=1, utilizar_base_mil=False):
 # Retorna:
 #  - sucesso: True/False
 #  - explicacao: Tanto para sucesso como para erro
-def copiar_pasta_via_robocopy(pasta_origem, pasta_destino, caminho_log):
+# limite_banda: Taxa máxima de cópia (bytes por segundo), aproximada via /IPG. None: sem limite
+#   Com limite, a cópia é efetuada em um único fluxo (o robocopy não aceita /MT juntamente com /IPG).
+#   O limite é definido no início da cópia e não é reajustado depois (ao contrário de copiar_pasta_paralelo)
+def copiar_pasta_via_robocopy(pasta_origem, pasta_destino, caminho_log, limite_banda=None):
 
     # Executa comando de disparo do robocopy
     try:
@@ -3427,14 +6197,14 @@ def copiar_pasta_via_robocopy(pasta_origem, pasta_destino, caminho_log):
         print_log("pasta_origem: ", pasta_origem)
         print_log("pasta_destino: ", pasta_destino)
         print_log("Log de execução será gravado em", caminho_log)
-        (sucesso, explicacao) = _copiar_pasta_via_robocopy(pasta_origem, pasta_destino, caminho_log)
+        (sucesso, explicacao) = _copiar_pasta_via_robocopy(pasta_origem, pasta_destino, caminho_log, limite_banda)
         return (sucesso, explicacao)
     except Exception as e:
         trc_string=traceback.format_exc()
         erro = texto("Execução de robocopy falhou :", str(e), trc_string)
         return (False, erro)
 
-def _copiar_pasta_via_robocopy(pasta_origem, pasta_destino, caminho_log):
+def _copiar_pasta_via_robocopy(pasta_origem, pasta_destino, caminho_log, limite_banda=None):
     # Para teste
     #caminho_origem='I:/desenvolvimento/sapi/dados_para_testes/relatorios_cellebrite/00_pequeno_XML_danificado'
     #caminho_destino='\\\\10.41.87.235\\storage\\Memorando_5917-17_XXX_YYY\\item1a\\item1a_extracao'
@@ -3474,10 +6244,18 @@ def _copiar_pasta_via_robocopy(pasta_origem, pasta_destino, caminho_log):
     /NJH     Especifica que não há nenhum cabeçalho no log.
     /r:<N>   Specifies the number of retries on failed copies. The default value of N is 1,000,000 (one million retries).
     /w:<N>   Specifies the wait time between retries, in seconds. The default value of N is 30 (wait time 30 seconds).
+    /ipg:<N> Specifies the inter-packet gap to free bandwidth on slow lines (milliseconds, between 64 KB blocks).
 
     '''
     # Opções gerais
-    opcoes_robocopy="/MT /mir /v /np /bytes /NJH /r:120 /w:60 "
+    opcoes_robocopy="/mir /v /np /bytes /NJH /r:120 /w:60 "
+    if limite_banda:
+        # Limite de banda: Intervalo entre blocos de 64 KB, em fluxo único (/IPG não pode ser combinado com /MT)
+        # Desconsidera o tempo da própria transferência, de modo que a taxa efetiva fica abaixo do limite
+        ipg = int(65536 * 1000 / limite_banda)
+        opcoes_robocopy += " /ipg:" + str(max(1, ipg)) + " "
+    else:
+        opcoes_robocopy += " /MT "
     # Arquivo de log
     opcoes_robocopy+=" /log:" + caminho_log
 
@@ -3557,6 +6335,335 @@ def _copiar_pasta_via_robocopy(pasta_origem, pasta_destino, caminho_log):
         return (sucesso, texto_resultado)
 
 
+# ===================================================================================
+# Fila de cópias
+# ===================================================================================
+# Coordena as cópias em background iniciadas por um programa (ex: várias cópias no sapi_cellebrite),
+# que antes eram disparadas simultaneamente, disputando o mesmo dispositivo de origem e o mesmo storage.
+# - Cada cópia é executada em um processo filho (como antes), mas o processo só é iniciado quando há vaga:
+#   limite de cópias simultâneas por dispositivo de origem, por storage de destino e no total.
+# - Entre as cópias aguardando, é iniciada primeiro a de maior prioridade, e em seguida a de menor tamanho
+#   (as cópias pequenas não ficam esperando atrás das grandes).
+# - A banda total (Gfila_copia_banda_maxima) é dividida igualmente entre as cópias em execução. O limite de cada
+#   cópia é um multiprocessing.Value, passado como último argumento da função do processo filho, e reajustado
+#   sempre que uma cópia inicia ou termina.
+#   A cópia via robocopy utiliza apenas a parcela vigente no seu início (convertida em /IPG, em fluxo único),
+#   que não é reajustada depois.
+# A fila é controlada por uma thread do processo principal (sapi_fila_copia), que existe apenas enquanto
+# houver cópias na fila.
+#
+# Os limites valem para a máquina (e não apenas para o programa): cada cópia em execução ocupa vagas
+# representadas por arquivos travados em uma pasta local (Gfila_copia_pasta_vagas), uma vaga no total,
+# uma no dispositivo de origem e uma no destino. Assim, dois programas (ex: dois sapi_cellebrite, ou um
+# sapi_cellebrite e a *GM do sapi_midia) na mesma máquina não ultrapassam os limites.
+# A trava é liberada pelo sistema operacional se o processo terminar, logo não há vaga "presa".
+# A banda total é dividida pela quantidade de cópias em execução na máquina.
+# A ordem de início (prioridade, tamanho) vale apenas entre as cópias de um mesmo programa.
+# Cópias que não passam pela fila (ex: *GM) obtêm a vaga com obter_vaga_copia.
+
+# Cópias simultâneas (máximo)
+Gfila_copia_maximo_por_origem = 1
+Gfila_copia_maximo_por_destino = 2
+Gfila_copia_maximo_total = 4
+# Banda total para as cópias (bytes por segundo). Zero: sem limite
+Gfila_copia_banda_maxima = 0
+# Intervalo (segundos) entre verificações da fila
+Gfila_copia_intervalo = 2
+
+# Pasta local com os arquivos de vaga (compartilhada por todos os programas da máquina)
+Gfila_copia_pasta_vagas = os.path.join(tempfile.gettempdir(), "sapi_fila_copia")
+
+Gfila_copia = list()
+Gfila_copia_lock = threading.Lock()
+Gfila_copia_thread = None
+Gfila_copia_sequencial = 0
+
+
+# Chave que identifica o dispositivo de um caminho, para limitar as cópias simultâneas
+# - Windows: drive (C:) ou compartilhamento (\\servidor\compartilhamento)
+# - Demais: número do dispositivo (st_dev)
+def _chave_dispositivo_copia(caminho):
+    caminho = caminho.replace("\\\\?\\UNC\\", "\\\\").replace("\\\\?\\", "")
+    (drive, resto) = os.path.splitdrive(caminho)
+    if drive != "":
+        return drive.lower()
+    atual = os.path.abspath(caminho)
+    while not os.path.exists(atual) and os.path.dirname(atual) != atual:
+        atual = os.path.dirname(atual)
+    return "dev:" + str(os.stat(atual).st_dev)
+
+
+# Trava um arquivo de vaga, sem aguardar
+# Retorna o arquivo aberto (que mantém a trava até ser fechado), ou None se a vaga estiver ocupada
+def _travar_vaga_copia(nome):
+    os.makedirs(Gfila_copia_pasta_vagas, exist_ok=True)
+    arquivo = open(os.path.join(Gfila_copia_pasta_vagas, nome), 'a+b')
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            arquivo.seek(0)
+            msvcrt.locking(arquivo.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(arquivo.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        arquivo.close()
+        return None
+    return arquivo
+
+
+# Libera as vagas (desfaz as travas e fecha os arquivos)
+def _liberar_vagas_copia(arquivos):
+    for arquivo in arquivos:
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                arquivo.seek(0)
+                msvcrt.locking(arquivo.fileno(), msvcrt.LK_UNLCK, 1)
+        except OSError:
+            pass
+        try:
+            arquivo.close()
+        except OSError:
+            pass
+
+
+# Obtem as vagas de uma cópia na máquina (total, dispositivo de origem e storage de destino)
+# Retorna a lista de arquivos travados, ou None se não houver vaga (nenhuma vaga fica travada)
+def _obter_vagas_copia(chave_origem, chave_destino):
+    grupos = [("total", Gfila_copia_maximo_total),
+              ("origem_" + hashlib.sha1(chave_origem.encode('utf-8')).hexdigest()[:16], Gfila_copia_maximo_por_origem),
+              ("destino_" + hashlib.sha1(chave_destino.encode('utf-8')).hexdigest()[:16], Gfila_copia_maximo_por_destino)]
+    obtidas = list()
+    for (grupo, maximo) in grupos:
+        arquivo = None
+        for i in range(maximo):
+            arquivo = _travar_vaga_copia(grupo + "_" + str(i) + ".vaga")
+            if arquivo is not None:
+                break
+        if arquivo is None:
+            _liberar_vagas_copia(obtidas)
+            return None
+        obtidas.append(arquivo)
+    return obtidas
+
+
+# Quantidade de cópias em execução na máquina (vagas totais ocupadas, inclusive as deste processo)
+def _contar_copias_maquina():
+    quantidade = 0
+    for i in range(Gfila_copia_maximo_total):
+        arquivo = _travar_vaga_copia("total_" + str(i) + ".vaga")
+        if arquivo is None:
+            quantidade += 1
+        else:
+            _liberar_vagas_copia([arquivo])
+    return quantidade
+
+
+# Banda de cada cópia: Banda total dividida pelas cópias em execução na máquina. Zero: sem limite
+def _calcular_banda_copia(minimo_copias):
+    if not Gfila_copia_banda_maxima:
+        return 0.0
+    return float(Gfila_copia_banda_maxima) / max(1, minimo_copias, _contar_copias_maquina())
+
+
+# Obtem vaga para uma cópia que não passa pela fila (ex: *GM do sapi_midia)
+# Aguarda até que haja vaga na máquina (ver fila de cópias)
+# Retorna a vaga, que deve ser liberada com liberar_vaga_copia ao final da cópia.
+# vaga['banda'] é o limite de banda da cópia (pode ser passado como limite_banda para copiar_pasta_paralelo),
+# reajustado periodicamente enquanto a vaga estiver ocupada
+def obter_vaga_copia(pasta_origem, pasta_destino):
+    chave_origem = _chave_dispositivo_copia(pasta_origem)
+    chave_destino = _chave_dispositivo_copia(pasta_destino)
+    while True:
+        arquivos = _obter_vagas_copia(chave_origem, chave_destino)
+        if arquivos is not None:
+            break
+        dormir(Gfila_copia_intervalo * 5, "Aguardando vaga para cópia (limite de cópias simultâneas na máquina)")
+
+    vaga = {'arquivos': arquivos,
+            'banda': multiprocessing.Value('d', _calcular_banda_copia(1)),
+            'encerrar': threading.Event()}
+
+    def reajustar_banda():
+        while not vaga['encerrar'].wait(Gfila_copia_intervalo):
+            vaga['banda'].value = _calcular_banda_copia(1)
+
+    threading.Thread(target=reajustar_banda, name="sapi_vaga_copia", daemon=True).start()
+    return vaga
+
+
+# Libera a vaga obtida com obter_vaga_copia
+def liberar_vaga_copia(vaga):
+    vaga['encerrar'].set()
+    _liberar_vagas_copia(vaga['arquivos'])
+
+
+# Coloca uma cópia na fila
+# rotulo: Identificação do processo filho (registra_processo_filho), ex: "executar:123"
+# funcao, argumentos: Função executada no processo filho. Recebe como último argumento o limite de banda
+#   (multiprocessing.Value, em bytes por segundo, zero para sem limite)
+# chave_origem, chave_destino: Se não informado, é obtido a partir da pasta (_chave_dispositivo_copia)
+# prioridade: Maior prioridade é iniciada primeiro
+# tamanho: Tamanho da cópia (bytes). Se não informado, é calculado (em background) a partir da pasta de origem
+# Retorna a quantidade de cópias que estão na fila à frente desta (zero: será iniciada imediatamente)
+def agendar_copia(rotulo, funcao, argumentos, pasta_origem, pasta_destino,
+                  chave_origem=None, chave_destino=None, prioridade=0, tamanho=None):
+    global Gfila_copia_thread
+    global Gfila_copia_sequencial
+
+    if chave_origem is None:
+        chave_origem = _chave_dispositivo_copia(pasta_origem)
+    if chave_destino is None:
+        chave_destino = _chave_dispositivo_copia(pasta_destino)
+
+    with Gfila_copia_lock:
+        Gfila_copia_sequencial += 1
+        copia = {
+            'rotulo': rotulo,
+            'funcao': funcao,
+            'argumentos': tuple(argumentos),
+            'pasta_origem': pasta_origem,
+            'chave_origem': chave_origem,
+            'chave_destino': chave_destino,
+            'prioridade': prioridade,
+            'tamanho': tamanho,
+            'sequencial': Gfila_copia_sequencial,
+            'situacao': 'aguardando',
+            'processo': None,
+            'banda': multiprocessing.Value('d', 0.0),
+            'vagas': None,
+            'inicio': None
+        }
+        a_frente = len(Gfila_copia)
+        Gfila_copia.append(copia)
+        print_log("Cópia", rotulo, "colocada na fila. Origem:", chave_origem, "Destino:", chave_destino,
+                  "Prioridade:", prioridade, "Cópias na fila:", a_frente)
+
+        if Gfila_copia_thread is None:
+            Gfila_copia_thread = threading.Thread(target=_executar_fila_copia, name="sapi_fila_copia", daemon=True)
+            Gfila_copia_thread.start()
+
+    # Efetua uma verificação imediata, para que a cópia seja iniciada sem aguardar o intervalo
+    _verificar_fila_copia()
+    return _posicao_fila_copia(rotulo)
+
+
+# Quantidade de cópias (em execução ou aguardando) à frente da cópia indicada. Zero: cópia em execução
+def _posicao_fila_copia(rotulo):
+    with Gfila_copia_lock:
+        for copia in Gfila_copia:
+            if copia['rotulo'] == rotulo and copia['situacao'] == 'executando':
+                return 0
+        for (posicao, copia) in enumerate(_ordenar_fila_copia()):
+            if copia['rotulo'] == rotulo:
+                return posicao + len([c for c in Gfila_copia if c['situacao'] == 'executando'])
+    return 0
+
+
+# Cópias aguardando, na ordem em que devem ser iniciadas
+def _ordenar_fila_copia():
+    aguardando = [c for c in Gfila_copia if c['situacao'] == 'aguardando']
+    return sorted(aguardando,
+                  key=lambda c: (-c['prioridade'],
+                                 c['tamanho'] if c['tamanho'] is not None else float('inf'),
+                                 c['sequencial']))
+
+
+# Thread de controle da fila
+def _executar_fila_copia():
+    global Gfila_copia_thread
+    while True:
+        # Tamanho das cópias aguardando (fora do lock, pois pode demorar)
+        with Gfila_copia_lock:
+            sem_tamanho = [c for c in Gfila_copia if c['situacao'] == 'aguardando' and c['tamanho'] is None]
+        for copia in sem_tamanho:
+            try:
+                copia['tamanho'] = obter_caracteristicas_pasta(copia['pasta_origem']).get('tamanho_total', None)
+            except BaseException as e:
+                print_log("Fila de cópias: Não foi possível obter tamanho da pasta", copia['pasta_origem'], str(e))
+            if copia['tamanho'] is None:
+                copia['tamanho'] = float('inf')
+
+        _verificar_fila_copia()
+        # Fila vazia: Encerra (uma nova thread é iniciada na próxima cópia colocada na fila)
+        with Gfila_copia_lock:
+            if len(Gfila_copia) == 0:
+                Gfila_copia_thread = None
+                return
+        time.sleep(Gfila_copia_intervalo)
+
+
+# Atualiza a fila: Remove as cópias concluídas, inicia as cópias para as quais há vaga e redistribui a banda
+def _verificar_fila_copia():
+    with Gfila_copia_lock:
+        # Cópias concluídas
+        for copia in list(Gfila_copia):
+            if copia['situacao'] == 'executando' and not copia['processo'].is_alive():
+                print_log("Fila de cópias: Cópia", copia['rotulo'], "finalizada após",
+                          int(time.time() - copia['inicio']), "segundos")
+                _liberar_vagas_copia(copia['vagas'])
+                Gfila_copia.remove(copia)
+
+        executando = [c for c in Gfila_copia if c['situacao'] == 'executando']
+        por_origem = dict()
+        por_destino = dict()
+        for c in executando:
+            por_origem[c['chave_origem']] = por_origem.get(c['chave_origem'], 0) + 1
+            por_destino[c['chave_destino']] = por_destino.get(c['chave_destino'], 0) + 1
+
+        iniciar = list()
+        for copia in _ordenar_fila_copia():
+            if len(executando) + len(iniciar) >= Gfila_copia_maximo_total:
+                break
+            # Tamanho ainda não calculado (a thread calcula), exceto se não há nada em execução
+            if copia['tamanho'] is None and len(executando) + len(iniciar) > 0:
+                continue
+            if por_origem.get(copia['chave_origem'], 0) >= Gfila_copia_maximo_por_origem:
+                continue
+            if por_destino.get(copia['chave_destino'], 0) >= Gfila_copia_maximo_por_destino:
+                continue
+            # Vagas na máquina (outros programas podem estar copiando)
+            copia['vagas'] = _obter_vagas_copia(copia['chave_origem'], copia['chave_destino'])
+            if copia['vagas'] is None:
+                continue
+            por_origem[copia['chave_origem']] = por_origem.get(copia['chave_origem'], 0) + 1
+            por_destino[copia['chave_destino']] = por_destino.get(copia['chave_destino'], 0) + 1
+            iniciar.append(copia)
+
+        # Banda de cada cópia
+        banda = _calcular_banda_copia(len(executando) + len(iniciar))
+        for copia in executando + iniciar:
+            copia['banda'].value = banda
+
+        for copia in iniciar:
+            print_log("Fila de cópias: Iniciando cópia", copia['rotulo'])
+            copia['processo'] = multiprocessing.Process(target=copia['funcao'],
+                                                        args=copia['argumentos'] + (copia['banda'],))
+            copia['processo'].start()
+            copia['situacao'] = 'executando'
+            copia['inicio'] = time.time()
+            registra_processo_filho(copia['rotulo'], copia['processo'])
+
+
+# Retira da fila uma cópia que ainda não foi iniciada
+# Retorna True se a cópia estava aguardando na fila
+def cancelar_copia_agendada(rotulo):
+    with Gfila_copia_lock:
+        for copia in Gfila_copia:
+            if copia['rotulo'] == rotulo and copia['situacao'] == 'aguardando':
+                Gfila_copia.remove(copia)
+                print_log("Fila de cópias: Cópia", rotulo, "retirada da fila")
+                return True
+    return False
+
+
+# Lista das cópias que estão aguardando na fila (rótulos), na ordem em que serão iniciadas
+def obter_copias_agendadas():
+    with Gfila_copia_lock:
+        return [c['rotulo'] for c in _ordenar_fila_copia()]
+
+
 # ===================================================================================
 # Ajuste de caminho
 # ===================================================================================
@@ -4101,6 +7208,7 @@ def acesso_storage_windows(conf_storage, utilizar_ip=True, com_letra_drive=False
     if os.path.isfile(arquivo_controle):
         # Registra que está montado, para posteriormente desmontar
         Gdic_storage[caminho_storage]=caminho_storage_netbios
+        _invalidar_ajuste_texto_saida()
         debug("Acesso ao storage confirmado através do acesso ao arquivo: ", arquivo_controle)
         return True, ponto_montagem, ""
     elif ignorar_falta_arquivo_controle:
@@ -4959,7 +8067,7 @@ def obter_lista_storages_unidade(unidade, tipo):
 
     try:
         print_log("Obtendo lista de storages da unidade: ", unidade)
-        (sucesso, msg_erro, lista_storage) = sapisrv_chamar_programa(
+        (sucesso, msg_erro, lista_storage) = sapisrv_chamar_programa_cache(
             "sapisrv_obter_lista_storage.php",
             {'unidade': unidade,
              'tipo': tipo}
@@ -4985,7 +8093,7 @@ def obter_dict_perfil_iped(unidade):
 
     try:
         print_log("Obtendo lista de perfis do sapi_iped da unidade: ", unidade)
-        (sucesso, msg_erro, dict_perfil) = sapisrv_chamar_programa(
+        (sucesso, msg_erro, dict_perfil) = sapisrv_chamar_programa_cache(
             "sapisrv_obter_lista_perfil_iped.php",
             {'unidade': unidade}
         )
@@ -5865,61 +8973,258 @@ def obter_dados_laudo_armazenados():
 
 
 # ----------------------------------------------------------------------------------------------------------------------
-# Exibe conteúdo do arquivo de log
+# Leitura do arquivo de log
 # ----------------------------------------------------------------------------------------------------------------------
-def exibir_log(comando, filtro_base="", filtro_usuario="", limpar_tela=True):
+# Quantidade aproximada de bytes lidos de cada vez na varredura do log
+Glog_tamanho_bloco_leitura = 1024 * 1024
 
-    # Filtros
-    filtro_base     =filtro_base.strip()
-    filtro_usuario  =filtro_usuario.strip()
+Gregex_linha_log = re.compile(r'^\[(\d+)\] : ([^:]+:\d\d) : (?:\[([^\]]*)\] )?(.*)$')
 
-    # Limpa tela e imprime cabeçalho do programa
-    # --------------------------------------------------------------------------------
-    if limpar_tela:
-        cls()
-        print("Arquivo de log: ", obter_nome_arquivo_log())
 
-    print_centralizado()
+# Tamanho do conteúdo de um segmento do log
+# Para arquivo compactado, o tamanho descompactado está nos últimos 4 bytes (módulo 4GB)
+def _tamanho_segmento_log(caminho):
+    if not caminho.endswith(".gz"):
+        return os.path.getsize(caminho)
+    with open(caminho, 'rb') as arquivo:
+        arquivo.seek(-4, os.SEEK_END)
+        return int.from_bytes(arquivo.read(4), 'little')
 
-    if filtro_usuario!= "":
-       print("Contendo termo: ", filtro_usuario)
-       print_centralizado()
+
+# Carrega o índice de um arquivo (ou segmento) de log
+# Retorna lista de trechos (inicio, fim, codigo_tarefa, label_log), ordenada por inicio
+# Se o índice não existir ou for inconsistente com o arquivo de log, retorna None
+def _carregar_indice_log(arquivo_log):
+
+    caminho_indice = _caminho_indice_log(arquivo_log)
+    if not os.path.isfile(caminho_indice):
+        return None
+
+    trechos = list()
+    try:
+        with codecs.open(caminho_indice, 'r', "utf-8") as indice:
+            for linha in indice:
+                partes = linha.rstrip("\r\n").split("\t", 3)
+                if len(partes) != 4:
+                    # Linha incompleta (gravação interrompida)
+                    continue
+                trechos.append((int(partes[0]), int(partes[1]), partes[2], partes[3]))
+    except (OSError, ValueError, UnicodeDecodeError) as e:
+        debug("Índice do log", caminho_indice, "ignorado:", e)
+        return None
+
+    trechos.sort()
+    tamanho_log = _tamanho_segmento_log(arquivo_log)
+    fim_anterior = 0
+    for (inicio, fim, codigo_tarefa, label_log) in trechos:
+        if inicio < fim_anterior or fim < inicio or fim > tamanho_log:
+            debug("Índice do log", caminho_indice, "inconsistente com o arquivo de log. Ignorado")
+            return None
+        fim_anterior = fim
+
+    return trechos
+
+
+# Interpreta uma linha de log (formato texto ou jsonl)
+# Retorna dicionário com pid, hora, label_log, codigo_tarefa, nivel, mensagem e texto (linha para exibição)
+def interpretar_linha_log(linha):
+
+    linha = linha.strip()
+
+    if linha.startswith("{"):
+        try:
+            registro = json.loads(linha)
+            registro['label_log'] = registro.get('label_log', "")
+            rotulo_log = ""
+            if registro['label_log'] != "":
+                rotulo_log = "[" + registro['label_log'] + "] "
+            registro['texto'] = "[" + str(registro.get('pid', "")) + "] : " + registro.get('hora', "") + " : " + \
+                                rotulo_log + registro.get('mensagem', "")
+            return registro
+        except ValueError:
+            # Não é um registro json. Trata como texto
+            pass
+
+    registro = {'pid': "", 'hora': "", 'label_log': "", 'codigo_tarefa': "", 'nivel': "", 'mensagem': linha,
+                'texto': linha}
+    m = Gregex_linha_log.match(linha)
+    if m is not None:
+        registro['pid'] = m.group(1)
+        registro['hora'] = m.group(2)
+        registro['label_log'] = m.group(3) if m.group(3) is not None else ""
+        registro['codigo_tarefa'] = _obter_codigo_tarefa_label(m.group(3))
+        registro['mensagem'] = m.group(4)
+
+    return registro
+
+
+# Lê os blocos (lista de linhas) do trecho [inicio, fim) do arquivo de log
+# fim=None: Até o final do arquivo
+def _ler_blocos_log(arquivo, inicio, fim):
+    arquivo.seek(inicio)
+    posicao = inicio
+    while fim is None or posicao < fim:
+        tamanho = Glog_tamanho_bloco_leitura
+        if fim is not None:
+            tamanho = min(tamanho, fim - posicao)
+        dados = arquivo.read(tamanho)
+        if len(dados) == 0:
+            break
+        # Completa a última linha
+        if not dados.endswith(b"\n") and (fim is None or posicao + len(dados) < fim):
+            dados += arquivo.readline()
+        posicao += len(dados)
+        yield dados.decode("utf-8", errors="replace").splitlines()
+
+
+# Lê as linhas do arquivo de log (todos os segmentos, em ordem), retornando os registros
+# (ver interpretar_linha_log) que atendem aos filtros.
+# codigo_tarefa/label_log: Se informados, utiliza o índice para ler apenas os trechos correspondentes.
+#                          Os trechos do arquivo não cobertos pelo índice são varridos normalmente.
+# lista_termos: Termos que devem estar contidos na linha (sem distinção entre maiúsculas e minúsculas)
+def ler_linhas_log(arquivo_log, codigo_tarefa=None, label_log=None, lista_termos=None):
+
+    lista_termos = [t.lower() for t in (lista_termos or []) if t != ""]
+
+    for caminho in listar_arquivos_log(arquivo_log):
+        # O segmento pode ter sido compactado após a listagem
+        if not os.path.isfile(caminho) and os.path.isfile(caminho + ".gz"):
+            caminho = caminho + ".gz"
+        yield from _ler_linhas_segmento_log(caminho, codigo_tarefa, label_log, lista_termos)
+
+
+# Lê as linhas de um segmento do log (ver ler_linhas_log)
+def _ler_linhas_segmento_log(arquivo_log, codigo_tarefa, label_log, lista_termos):
+
+    # Nas linhas json, barras e aspas estão escapadas,
+    # de modo que o teste do termo sobre o bloco inteiro não é conclusivo
+    pre_filtro = all('\\' not in t and '"' not in t for t in lista_termos)
+
+    # Trechos que serão lidos: (inicio, fim, verificar_linha)
+    trechos_leitura = [(0, None, True)]
+    if codigo_tarefa is not None or label_log is not None:
+        trechos = _carregar_indice_log(arquivo_log)
+        if trechos is not None:
+            trechos_leitura = list()
+            posicao = 0
+            for (inicio, fim, codigo_trecho, label_trecho) in trechos:
+                # Lacuna não indexada
+                if inicio > posicao:
+                    trechos_leitura.append((posicao, inicio, True))
+                posicao = fim
+                if codigo_tarefa is not None and codigo_trecho != codigo_tarefa:
+                    continue
+                if label_log is not None and label_trecho != label_log:
+                    continue
+                # Junta com o trecho anterior, se for contíguo
+                if len(trechos_leitura) > 0 and trechos_leitura[-1][1] == inicio and not trechos_leitura[-1][2]:
+                    trechos_leitura[-1] = (trechos_leitura[-1][0], fim, False)
+                else:
+                    trechos_leitura.append((inicio, fim, False))
+            # Final do arquivo, ainda não indexado
+            trechos_leitura.append((posicao, None, True))
+
+    if arquivo_log.endswith(".gz"):
+        # Os trechos estão em ordem crescente, de modo que o seek no arquivo compactado é sempre para frente
+        sapi_log = gzip.open(arquivo_log, 'rb')
+    else:
+        sapi_log = open(arquivo_log, 'rb')
+
+    with sapi_log:
+        for (inicio, fim, verificar_linha) in trechos_leitura:
+            for linhas in _ler_blocos_log(sapi_log, inicio, fim):
+
+                # Descarta o bloco inteiro se não contém os termos
+                if pre_filtro and len(lista_termos) > 0:
+                    bloco = "\n".join(linhas).lower()
+                    if not all(t in bloco for t in lista_termos):
+                        continue
+
+                for linha in linhas:
+                    if linha.strip() == "":
+                        continue
+                    registro = interpretar_linha_log(linha)
+
+                    # Trecho não indexado: confere tarefa/label na própria linha
+                    if verificar_linha:
+                        if codigo_tarefa is not None and registro.get('codigo_tarefa', "") != codigo_tarefa:
+                            continue
+                        if label_log is not None and registro.get('label_log', "") != label_log:
+                            continue
+
+                    if len(lista_termos) > 0:
+                        texto = registro['texto'].lower()
+                        if not all(t in texto for t in lista_termos):
+                            continue
+
+                    yield registro
+
+
+# Exibe as linhas do log que atendem aos filtros (utilizada pelos exibir_log dos programas)
+# filtro_usuario no formato #codigo_tarefa: exibe o log da tarefa
+def exibir_conteudo_log(comando, filtro_base="", filtro_usuario="", codigo_tarefa=None):
 
     arquivo_log = obter_nome_arquivo_log()
 
+    # Grava linhas de log pendentes
+    log_descarregar()
+
     # Não tem arquivo de log
-    if (not os.path.isfile(arquivo_log)):
+    if len(listar_arquivos_log(arquivo_log)) == 0:
         print("*** Arquivo de log vazio ***")
         return
 
-    with codecs.open(arquivo_log, 'r', "utf-8") as sapi_log:
-        qtd=0
-        for linha in sapi_log:
-            exibir=True
-            if filtro_base!="" and filtro_base.lower() not in linha.lower():
-                exibir=False
-            if filtro_usuario!="" and filtro_usuario.lower() not in linha.lower():
-                exibir=False
-
-            # Sanitiza para utf8 na console
-            # ignora os ajustes efetuados
-            (linha, ajustes)=console_sanitiza_utf8(linha)
+    termo = filtro_usuario
+    if codigo_tarefa is None and termo.startswith("#") and termo[1:].isdigit():
+        codigo_tarefa = termo[1:]
+        termo = ""
 
-            if exibir:
-                qtd=qtd+1
-                print(format(qtd, '03d'),":", linha.strip())
+    qtd=0
+    for registro in ler_linhas_log(arquivo_log,
+                                   codigo_tarefa=codigo_tarefa,
+                                   lista_termos=[filtro_base, termo]):
+        # Sanitiza para utf8 na console
+        # ignora os ajustes efetuados
+        (linha, ajustes)=console_sanitiza_utf8(registro['texto'])
 
-    sapi_log.close()
+        qtd=qtd+1
+        print(format(qtd, '03d'),":", linha.strip())
 
     if qtd==0:
         print("*** Nenhuma mensagem de log disponível ***")
         return
 
-
     if filtro_usuario=="":
         print()
         print("- Dica: Para filtrar o log, forneça um string após comando.")
         print("  Exemplo: ",comando," erro => Lista apenas linhas que contém o termo 'erro'")
+        print("           ",comando," #1234 => Lista apenas o log da tarefa 1234")
+
+    return
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Exibe conteúdo do arquivo de log
+# ----------------------------------------------------------------------------------------------------------------------
+def exibir_log(comando, filtro_base="", filtro_usuario="", limpar_tela=True, codigo_tarefa=None):
+
+    # Filtros
+    filtro_base     =filtro_base.strip()
+    filtro_usuario  =filtro_usuario.strip()
+
+    # Limpa tela e imprime cabeçalho do programa
+    # --------------------------------------------------------------------------------
+    if limpar_tela:
+        cls()
+        print("Arquivo de log: ", obter_nome_arquivo_log())
+
+    print_centralizado()
+
+    if filtro_usuario!= "":
+       print("Contendo termo: ", filtro_usuario)
+       print_centralizado()
+
+    exibir_conteudo_log(comando, filtro_base=filtro_base, filtro_usuario=filtro_usuario, codigo_tarefa=codigo_tarefa)
 
     return
 
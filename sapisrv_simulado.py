@@ -0,0 +1,615 @@
+# -*- coding: utf-8 -*-
+# ======================================================================================================================
+# SAPI - Servidor simulado (substituto local do sapisrv do SETEC3)
+# ======================================================================================================================
+# Implementa, com estado em memória, os programas do servidor (sapisrv_*.php) invocados pela sapilib,
+# permitindo executar os agentes e testes de carga sem o SETEC3.
+# Não há persistência: Ao encerrar, as tarefas são descartadas.
+#
+# Utilização:
+#   python sapisrv_simulado.py [porta]
+# e nos agentes/testes:
+#   sapisrv_inicializar(..., ambiente='local')
+#
+# Além dos programas do sapisrv, existem alguns programas de administração do simulador:
+#   simulado_criar_tarefas.php: Cria tarefas aguardando processamento (tipo, quantidade, unidade, storage, item...)
+#   simulado_estatisticas.php: Contadores de requisições, situação das tarefas e tempos de captura (pickup)
+#   simulado_reiniciar.php: Descarta tarefas e estatísticas
+#
+# Histórico:
+#  - v1.0 : Versão inicial
+# ======================================================================================================================
+
+import gzip
+import http.server
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+import sapilib_2_0
+from sapilib_2_0 import GAguardandoProcessamento, GFilaExclusao, GEmExclusao, GEmAndamento, GManterSituacaoAtual, \
+    Gexecutando_intervalo_ini, Gexecutando_intervalo_fim
+
+Gprograma = "sapisrv_simulado"
+Gversao = "1.0"
+
+# Porta default: A mesma do ambiente 'local' da sapilib
+Gporta_default = sapilib_2_0.Gconf_ambiente['local']['servidor_porta']
+Gsistema = sapilib_2_0.Gconf_ambiente['local']['servidor_sistema']
+
+# Pasta de onde são servidos os arquivos do sapisrv_download.php (default: pasta deste programa)
+Gpasta_download = os.path.abspath(os.path.dirname(__file__))
+
+# Estado em memória
+# ----------------------------------------------------------------------------------------------------------------------
+# Todo acesso ao estado é feito sob Gcondicao, que também é utilizada para
+# acordar as requisições de sapisrv_aguardar_tarefa quando surge tarefa
+Gcondicao = threading.Condition()
+# codigo_tarefa (int) => tarefa (dict)
+Gtarefas = dict()
+Gproximo_codigo_tarefa = 1
+# (tipo_objeto, codigo_objeto, titulo) => conteúdo
+Gtextos = dict()
+# Envios de texto em partes em andamento: id_envio => conteúdo comprimido recebido até o momento
+Genvios_texto = dict()
+# Envios de texto concluídos (id_envio), para responder a repetição da última parte
+Genvios_texto_concluidos = set()
+# Erros reportados pelos clientes
+Gerros_cliente = list()
+# nome_agente => configuração registrada
+Gconfiguracao_clientes = dict()
+
+# Dados de referência, devolvidos pelos programas de consulta
+# Podem ser ajustados pelo chamador antes de iniciar o servidor
+Gdados_referencia = {
+    'storages': [
+        {'storage_id': 'local',
+         'id': 1,
+         'nome_storage': 'local',
+         'descricao': 'Storage simulado',
+         'tipo': 'trabalho',
+         'unidade': 'SETEC/PR',
+         'maquina_ip': '127.0.0.1',
+         'maquina_netbios': 'localhost',
+         'pasta_share': 'storage',
+         'usuario': 'sapi',
+         'senha': 'sapi',
+         'usuario_consulta': 'consulta',
+         'senha_consulta': 'consulta',
+         'habilitado': 1,
+         'desenvolvimento': 1,
+         'configuracao': None
+         }
+    ],
+    'perfil_iped': {},
+    'configuracao_agente': {},
+    'usuario': {'conta_usuario': 'simulado', 'nome_guerra': 'Simulado', 'tkcred': 'tkcred_simulado'}
+}
+
+# Estatísticas
+# ----------------------------------------------------------------------------------------------------------------------
+Gestatisticas_lock = threading.Lock()
+Gestatisticas_inicio = time.time()
+# programa => quantidade de requisições
+Gestatisticas_requisicoes = dict()
+# Tempo (segundos) entre a criação da tarefa e sua captura por um agente
+Gestatisticas_pickup = list()
+
+
+# Exceção que resulta em resposta com sucesso=0
+class ErroSimulado(Exception):
+    pass
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Funções auxiliares
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Obtém parâmetro obrigatório
+def _parametro(param, nome):
+    if nome not in param:
+        raise ErroSimulado("Parâmetro obrigatório não informado: " + nome)
+    return param[nome]
+
+
+# Obtém tarefa pelo código
+def _obter_tarefa(param):
+    try:
+        codigo_tarefa = int(_parametro(param, 'codigo_tarefa'))
+    except ValueError:
+        raise ErroSimulado("Código de tarefa inválido")
+    tarefa = Gtarefas.get(codigo_tarefa, None)
+    if tarefa is None:
+        raise ErroSimulado("Tarefa " + str(codigo_tarefa) + " não encontrada")
+    return tarefa
+
+
+# Verifica se tipo da tarefa corresponde ao filtro (aceita 'todos' e sufixo '%', como no sapisrv)
+def _tipo_corresponde(tipo_tarefa, filtro):
+    if filtro is None or filtro == 'todos':
+        return True
+    if filtro.endswith('%'):
+        return tipo_tarefa.startswith(filtro[:-1])
+    return tipo_tarefa == filtro
+
+
+# Verifica se tarefa atende aos critérios de obtenção de um agente
+def _tarefa_atende(tarefa, situacao, lista_tipos, param):
+    if int(tarefa['codigo_situacao_tarefa']) != situacao:
+        return False
+    if not any(_tipo_corresponde(tarefa['tipo'], tipo) for tipo in lista_tipos):
+        return False
+    if param.get('unidade', None) is not None and tarefa['unidade'] != param['unidade']:
+        return False
+    if param.get('storage', None) is not None and tarefa['dados_storage']['storage_id'] != param['storage']:
+        return False
+    tamanho = tarefa.get('tamanho_origem_bytes', 0)
+    if param.get('tamanho_minimo', None) is not None and tamanho < int(param['tamanho_minimo']):
+        return False
+    if param.get('tamanho_maximo', None) is not None and tamanho > int(param['tamanho_maximo']):
+        return False
+    return True
+
+
+# Troca a situação da tarefa (chamado sob Gcondicao)
+def _trocar_situacao(tarefa, codigo_situacao_tarefa, status, agente=None):
+    tarefa['codigo_situacao_tarefa'] = codigo_situacao_tarefa
+    tarefa['status'] = status
+    tarefa['data_hora_situacao'] = time.time()
+    if agente is not None:
+        tarefa['agente'] = agente
+    tarefa['executando'] = 0
+    if Gexecutando_intervalo_ini <= codigo_situacao_tarefa <= Gexecutando_intervalo_fim:
+        tarefa['executando'] = 1
+    # Tarefa voltou para fila: Acorda quem está aguardando
+    if codigo_situacao_tarefa in (GAguardandoProcessamento, GFilaExclusao):
+        Gcondicao.notify_all()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Programas do sapisrv
+# Cada função recebe os parâmetros (dict) e retorna os dados da resposta.
+# Para responder com insucesso (sucesso=0), gera ErroSimulado
+# ----------------------------------------------------------------------------------------------------------------------
+
+def sapisrv_solicitar_acesso(param):
+    return {'acesso_concedido': 1,
+            'storage_deployment': None,
+            'pasta_deployment_origem': None,
+            'explicacao': '',
+            'tipo_erro': ''}
+
+
+def sapisrv_obter_iniciar_tarefa(param):
+    lista_tipos = [_parametro(param, 'tipo')]
+    with Gcondicao:
+        for codigo_tarefa in sorted(Gtarefas):
+            tarefa = Gtarefas[codigo_tarefa]
+            if _tarefa_atende(tarefa, GAguardandoProcessamento, lista_tipos, param):
+                _trocar_situacao(tarefa, GEmAndamento, "Tarefa iniciada", param.get('execucao_nome_agente', None))
+                with Gestatisticas_lock:
+                    Gestatisticas_pickup.append(time.time() - tarefa['data_hora_criacao'])
+                return {'disponivel': 1, 'tarefa': dict(tarefa)}
+    return {'disponivel': 0}
+
+
+def sapisrv_obter_excluir_tarefa(param):
+    lista_tipos = [_parametro(param, 'tipo')]
+    with Gcondicao:
+        for codigo_tarefa in sorted(Gtarefas):
+            tarefa = Gtarefas[codigo_tarefa]
+            if _tarefa_atende(tarefa, GFilaExclusao, lista_tipos, param):
+                _trocar_situacao(tarefa, GEmExclusao, "Exclusão iniciada", param.get('execucao_nome_agente', None))
+                return {'disponivel': 1, 'tarefa': dict(tarefa)}
+    return {'disponivel': 0}
+
+
+# Long-poll: Mantém a requisição até surgir tarefa de um dos tipos ou esgotar a espera
+def sapisrv_aguardar_tarefa(param):
+    lista_tipos = _parametro(param, 'tipos').split(",")
+    limite = time.time() + min(int(param.get('espera', 60)), 300)
+
+    def existe_tarefa():
+        return any(_tarefa_atende(t, GAguardandoProcessamento, lista_tipos, param) or
+                   _tarefa_atende(t, GFilaExclusao, lista_tipos, param)
+                   for t in Gtarefas.values())
+
+    with Gcondicao:
+        while not existe_tarefa():
+            restante = limite - time.time()
+            if restante <= 0:
+                return {'disponivel': 0}
+            Gcondicao.wait(restante)
+    return {'disponivel': 1}
+
+
+def sapisrv_consultar_tarefa(param):
+    with Gcondicao:
+        return dict(_obter_tarefa(param))
+
+
+def sapisrv_atualizar_tarefa(param):
+    with Gcondicao:
+        tarefa = _obter_tarefa(param)
+        codigo_situacao_tarefa = int(_parametro(param, 'codigo_situacao_tarefa'))
+        status = param.get('status', '')
+        if codigo_situacao_tarefa == GManterSituacaoAtual:
+            tarefa['status'] = status
+        else:
+            _trocar_situacao(tarefa, codigo_situacao_tarefa, status)
+        if param.get('tamanho_destino_bytes', None) is not None:
+            tarefa['tamanho_destino_bytes'] = int(param['tamanho_destino_bytes'])
+        if param.get('dados_relevantes_json', None) is not None:
+            tarefa['dados_relevantes'] = json.loads(param['dados_relevantes_json'])
+        tarefa['data_hora_status'] = time.time()
+    return None
+
+
+# Atualiza apenas as tarefas que ainda estão em execução
+def sapisrv_atualizar_status_lote(param):
+    lote = json.loads(_parametro(param, 'lote_json'))
+    quantidade = 0
+    with Gcondicao:
+        for item in lote:
+            tarefa = Gtarefas.get(int(item['codigo_tarefa']), None)
+            if tarefa is None or not tarefa['executando']:
+                continue
+            tarefa['status'] = item['status']
+            if item.get('tamanho_destino_bytes', None) is not None:
+                tarefa['tamanho_destino_bytes'] = int(item['tamanho_destino_bytes'])
+            tarefa['data_hora_status'] = time.time()
+            quantidade += 1
+    return {'atualizadas': quantidade}
+
+
+def sapisrv_obter_tarefas(param):
+    tipo = param.get('tipo', 'todos')
+    lista = list()
+    with Gcondicao:
+        for codigo_tarefa in sorted(Gtarefas):
+            tarefa = Gtarefas[codigo_tarefa]
+            if not _tipo_corresponde(tarefa['tipo'], tipo):
+                continue
+            if param.get('codigo_solicitacao_exame_siscrim', None) is not None and \
+                    str(tarefa['codigo_solicitacao_exame_siscrim']) != param['codigo_solicitacao_exame_siscrim']:
+                continue
+            if param.get('item', None) is not None and tarefa['item'] != param['item']:
+                continue
+            lista.append(dict(tarefa))
+    return lista
+
+
+def sapisrv_excluir_tarefa(param):
+    with Gcondicao:
+        tarefa = _obter_tarefa(param)
+        del Gtarefas[tarefa['codigo_tarefa']]
+    return None
+
+
+def sapisrv_armazenar_texto(param):
+    chave = (_parametro(param, 'tipo_objeto'), str(_parametro(param, 'codigo_objeto')), _parametro(param, 'titulo'))
+    with Gcondicao:
+        Gtextos[chave] = _parametro(param, 'conteudo')
+    return None
+
+
+# Recebe uma parte de texto comprimido (gzip). Ver sapilib => _sapisrv_armazenar_texto_partes
+# A parte só é acrescentada se o deslocamento coincidir com o que já foi recebido;
+# caso contrário, apenas informa quanto já recebeu, para que o cliente continue dali
+def sapisrv_armazenar_texto_parte(param):
+    id_envio = _parametro(param, 'id_envio')
+    tamanho_total = int(_parametro(param, 'tamanho_total'))
+    deslocamento = int(_parametro(param, 'deslocamento'))
+    parte = param.get('conteudo_binario', b'')
+
+    with Gcondicao:
+        if id_envio in Genvios_texto_concluidos:
+            return {'recebido': tamanho_total, 'concluido': 1}
+
+        recebido = Genvios_texto.setdefault(id_envio, bytearray())
+        if deslocamento == len(recebido):
+            recebido.extend(parte[:tamanho_total - deslocamento])
+        if len(recebido) < tamanho_total:
+            return {'recebido': len(recebido), 'concluido': 0}
+
+        # Completo: descomprime e armazena
+        del Genvios_texto[id_envio]
+        try:
+            conteudo = gzip.decompress(bytes(recebido)).decode('utf-8')
+        except Exception as e:
+            raise ErroSimulado("Conteúdo comprimido inválido: " + str(e))
+        chave = (_parametro(param, 'tipo_objeto'), str(_parametro(param, 'codigo_objeto')), _parametro(param, 'titulo'))
+        Gtextos[chave] = conteudo
+        Genvios_texto_concluidos.add(id_envio)
+
+    return {'recebido': tamanho_total, 'concluido': 1}
+
+
+def sapisrv_download(param):
+    # Apenas o nome do arquivo (impede acesso fora da pasta de download)
+    arquivo = os.path.basename(_parametro(param, 'arquivo'))
+    caminho = os.path.join(Gpasta_download, arquivo)
+    if not os.path.isfile(caminho):
+        raise ErroSimulado("Arquivo " + arquivo + " não encontrado")
+    with open(caminho, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def sapisrv_reportar_erro_cliente(param):
+    with Gcondicao:
+        Gerros_cliente.append((param.get('execucao_nome_agente', None), _parametro(param, 'erro')))
+    return None
+
+
+def sapisrv_registrar_configuracao_cliente(param):
+    with Gcondicao:
+        Gconfiguracao_clientes[param.get('execucao_nome_agente', None)] = param.get('configuracao', None)
+    return None
+
+
+def sapisrv_registrar_storage(param):
+    storage_id = _parametro(param, 'storage_id')
+    with Gcondicao:
+        for storage in Gdados_referencia['storages']:
+            if storage['storage_id'] == storage_id:
+                storage['configuracao'] = param.get('configuracao', None)
+                return None
+    raise ErroSimulado("Storage " + storage_id + " não cadastrado")
+
+
+def sapisrv_obter_lista_storage(param):
+    return Gdados_referencia['storages']
+
+
+def sapisrv_consultar_storage(param):
+    storage_id = _parametro(param, 'storage_id')
+    for storage in Gdados_referencia['storages']:
+        if storage['storage_id'] == storage_id:
+            return storage
+    raise ErroSimulado("Storage " + storage_id + " não cadastrado")
+
+
+def sapisrv_obter_lista_perfil_iped(param):
+    return Gdados_referencia['perfil_iped']
+
+
+def sapisrv_obter_configuracao_agente(param):
+    return Gdados_referencia['configuracao_agente']
+
+
+def sapisrv_autenticar_credencial_usuario(param):
+    _parametro(param, 'usuario')
+    return Gdados_referencia['usuario']
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Programas de administração do simulador
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Cria tarefas aguardando processamento
+# Retorna lista com os códigos das tarefas criadas
+def simulado_criar_tarefas(param):
+    global Gproximo_codigo_tarefa
+
+    quantidade = int(param.get('quantidade', 1))
+    storage_id = param.get('storage', Gdados_referencia['storages'][0]['storage_id'])
+    dados_storage = None
+    for storage in Gdados_referencia['storages']:
+        if storage['storage_id'] == storage_id:
+            dados_storage = storage
+    if dados_storage is None:
+        raise ErroSimulado("Storage " + storage_id + " não cadastrado")
+
+    lista_codigos = list()
+    with Gcondicao:
+        for i in range(quantidade):
+            codigo_tarefa = Gproximo_codigo_tarefa
+            Gproximo_codigo_tarefa += 1
+            item = param.get('item', str(codigo_tarefa).zfill(2))
+            pasta_item = "Memorando_simulado/item" + item
+            Gtarefas[codigo_tarefa] = {
+                'codigo_tarefa': codigo_tarefa,
+                'tipo': param.get('tipo', 'iped-ocr'),
+                'unidade': param.get('unidade', 'SETEC/PR'),
+                'item': item,
+                'pasta_item': pasta_item,
+                'caminho_origem': pasta_item + "/item" + item + "_extracao",
+                'caminho_destino': pasta_item + "/item" + item + "_iped",
+                'codigo_solicitacao_exame_siscrim': param.get('codigo_solicitacao_exame_siscrim', '1'),
+                'dados_solicitacao_exame': {
+                    'codigo_documento_externo': param.get('codigo_solicitacao_exame_siscrim', '1')},
+                'dados_storage': dados_storage,
+                'tamanho_origem_bytes': int(param.get('tamanho_origem_bytes', 0)),
+                'tamanho_destino_bytes': None,
+                'codigo_situacao_tarefa': GAguardandoProcessamento,
+                'status': "Aguardando processamento",
+                'executando': 0,
+                'excluida': 0,
+                'agente': None,
+                'dados_relevantes': None,
+                'data_hora_criacao': time.time(),
+                'data_hora_situacao': time.time(),
+                'data_hora_status': None
+            }
+            lista_codigos.append(codigo_tarefa)
+        Gcondicao.notify_all()
+
+    return lista_codigos
+
+
+# Estatísticas do servidor
+def simulado_estatisticas(param):
+    situacoes = dict()
+    with Gcondicao:
+        for tarefa in Gtarefas.values():
+            chave = str(tarefa['codigo_situacao_tarefa'])
+            situacoes[chave] = situacoes.get(chave, 0) + 1
+    with Gestatisticas_lock:
+        requisicoes = dict(Gestatisticas_requisicoes)
+        pickup = list(Gestatisticas_pickup)
+        decorrido = time.time() - Gestatisticas_inicio
+    return {'decorrido': decorrido,
+            'requisicoes': requisicoes,
+            'total_requisicoes': sum(requisicoes.values()),
+            'situacoes': situacoes,
+            'pickup': pickup}
+
+
+# Descarta tarefas e estatísticas
+def simulado_reiniciar(param):
+    global Gproximo_codigo_tarefa
+    global Gestatisticas_inicio
+
+    with Gcondicao:
+        Gtarefas.clear()
+        Gtextos.clear()
+        Genvios_texto.clear()
+        Genvios_texto_concluidos.clear()
+        del Gerros_cliente[:]
+        Gproximo_codigo_tarefa = 1
+    with Gestatisticas_lock:
+        Gestatisticas_requisicoes.clear()
+        del Gestatisticas_pickup[:]
+        Gestatisticas_inicio = time.time()
+    return None
+
+
+# Programa => função
+Gprogramas = {
+    'sapisrv_solicitar_acesso.php': sapisrv_solicitar_acesso,
+    'sapisrv_obter_iniciar_tarefa.php': sapisrv_obter_iniciar_tarefa,
+    'sapisrv_obter_excluir_tarefa.php': sapisrv_obter_excluir_tarefa,
+    'sapisrv_aguardar_tarefa.php': sapisrv_aguardar_tarefa,
+    'sapisrv_consultar_tarefa.php': sapisrv_consultar_tarefa,
+    'sapisrv_atualizar_tarefa.php': sapisrv_atualizar_tarefa,
+    'sapisrv_atualizar_status_lote.php': sapisrv_atualizar_status_lote,
+    'sapisrv_obter_tarefas.php': sapisrv_obter_tarefas,
+    'sapisrv_excluir_tarefa.php': sapisrv_excluir_tarefa,
+    'sapisrv_armazenar_texto.php': sapisrv_armazenar_texto,
+    'sapisrv_armazenar_texto_parte.php': sapisrv_armazenar_texto_parte,
+    'sapisrv_download.php': sapisrv_download,
+    'sapisrv_reportar_erro_cliente.php': sapisrv_reportar_erro_cliente,
+    'sapisrv_registrar_configuracao_cliente.php': sapisrv_registrar_configuracao_cliente,
+    'sapisrv_registrar_storage.php': sapisrv_registrar_storage,
+    'sapisrv_obter_lista_storage.php': sapisrv_obter_lista_storage,
+    'sapisrv_consultar_storage.php': sapisrv_consultar_storage,
+    'sapisrv_obter_lista_perfil_iped.php': sapisrv_obter_lista_perfil_iped,
+    'sapisrv_obter_configuracao_agente.php': sapisrv_obter_configuracao_agente,
+    'sapisrv_autenticar_credencial_usuario.php': sapisrv_autenticar_credencial_usuario,
+    'simulado_criar_tarefas.php': simulado_criar_tarefas,
+    'simulado_estatisticas.php': simulado_estatisticas,
+    'simulado_reiniciar.php': simulado_reiniciar
+}
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Servidor HTTP
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Executa o programa solicitado e monta a resposta no formato do sapisrv: {sucesso, msg_erro, dados}
+def processar_requisicao(programa, param):
+    with Gestatisticas_lock:
+        Gestatisticas_requisicoes[programa] = Gestatisticas_requisicoes.get(programa, 0) + 1
+
+    # O ping responde apenas texto
+    if programa == 'sapisrv_ping.php':
+        return (200, "pong")
+
+    funcao = Gprogramas.get(programa, None)
+    if funcao is None:
+        return (404, "Programa " + programa + " inexistente")
+
+    try:
+        resposta = {'sucesso': "1", 'msg_erro': "", 'dados': funcao(param)}
+    except ErroSimulado as e:
+        resposta = {'sucesso': "0", 'msg_erro': str(e), 'dados': None}
+    except Exception as e:
+        resposta = {'sucesso': "0", 'msg_erro': "Erro no servidor simulado: " + repr(e), 'dados': None}
+
+    # Parâmetro apenas_dados=1: Devolve apenas os dados (ver sapisrv_chamar_programa_sucesso_ok)
+    if str(param.get('apenas_dados', '0')) == '1':
+        return (200, json.dumps(resposta['dados']))
+
+    return (200, json.dumps(resposta))
+
+
+class TratadorRequisicaoSimulado(http.server.BaseHTTPRequestHandler):
+    # Mantém a conexão aberta (keep-alive), como o pool de conexões da sapilib espera
+    protocol_version = "HTTP/1.1"
+    # Cabeçalho e corpo são enviados em escritas separadas: Sem isto, o Nagle (com o ACK atrasado do cliente)
+    # acrescenta ~40ms a cada resposta, mascarando as medições
+    disable_nagle_algorithm = True
+
+    def _responder(self, parametros_formatados, conteudo_binario=None):
+        caminho = urllib.parse.urlsplit(self.path).path
+        partes = caminho.strip("/").split("/")
+        if len(partes) != 2 or partes[0] != Gsistema:
+            (status, corpo) = (404, "Caminho " + caminho + " inexistente")
+        else:
+            param = dict(urllib.parse.parse_qsl(parametros_formatados, keep_blank_values=True))
+            if conteudo_binario is not None:
+                param['conteudo_binario'] = conteudo_binario
+            (status, corpo) = processar_requisicao(partes[1], param)
+
+        corpo = corpo.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def do_GET(self):
+        self._responder(urllib.parse.urlsplit(self.path).query)
+
+    def do_POST(self):
+        tamanho = int(self.headers.get('Content-Length', 0))
+        corpo = self.rfile.read(tamanho)
+        # Conteúdo binário (ex: partes de texto comprimido): Parâmetros vêm na url
+        if self.headers.get('Content-type', '').startswith('application/octet-stream'):
+            self._responder(urllib.parse.urlsplit(self.path).query, corpo)
+        else:
+            self._responder(corpo.decode('utf-8'))
+
+    # Não registra cada requisição na tela
+    def log_message(self, format, *args):
+        pass
+
+
+class ServidorSimulado(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # Comporta muitos agentes conectando ao mesmo tempo
+    request_queue_size = 128
+
+
+# Inicia o servidor simulado
+# Se em_background, o servidor é executado em thread e a função retorna o servidor (encerrar com shutdown())
+def iniciar_servidor_simulado(porta=None, em_background=False):
+    if porta is None:
+        porta = Gporta_default
+    servidor = ServidorSimulado(('127.0.0.1', porta), TratadorRequisicaoSimulado)
+    if em_background:
+        thread = threading.Thread(target=servidor.serve_forever, name="sapisrv_simulado")
+        thread.daemon = True
+        thread.start()
+        return servidor
+
+    print("Servidor simulado", Gprograma, Gversao, "em http://127.0.0.1:" + str(porta) + "/" + Gsistema + "/")
+    print("Para encerrar, CTRL-C")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    servidor.server_close()
+    return None
+
+
+if __name__ == '__main__':
+    porta = None
+    if len(sys.argv) > 1:
+        porta = int(sys.argv[1])
+    iniciar_servidor_simulado(porta)
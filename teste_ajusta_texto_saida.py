@@ -0,0 +1,72 @@
+# Micro-benchmark do ajusta_texto_saida (ip => netbios)
+# Compara o custo por linha do algoritmo antigo (vários replace por storage)
+# com a expressão regular compilada, à medida que aumenta a quantidade de storages
+import timeit
+
+import sapilib_2_0
+from sapilib_2_0 import *
+
+
+# Algoritmo anterior, mantido aqui apenas para comparação
+def ajusta_texto_saida_antigo(s, dic_storage):
+    if modo_debug():
+        return s
+    for caminho_storage in dic_storage:
+        nome_storage = dic_storage[caminho_storage]
+        s = s.replace(caminho_storage, nome_storage)
+        s = s.replace(caminho_storage.strip("\\"), nome_storage.strip("\\"))
+        ip = caminho_storage
+        ip = ip.replace("\\storage", "")
+        ip = ip.replace("\\", "")
+        ip = ip.replace("/", "")
+        netbios = nome_storage
+        netbios = netbios.replace("\\storage", "")
+        netbios = netbios.replace("\\", "")
+        netbios = netbios.replace("/", "")
+        s = s.replace(ip, netbios)
+    return s
+
+
+# prefixos: Os ips são distribuídos entre os prefixos (ex: storages em redes diferentes, sem prefixo comum)
+def montar_dic_storage(quantidade, prefixos=("10.41.87.",)):
+    dic = dict()
+    for i in range(quantidade):
+        prefixo = prefixos[i % len(prefixos)]
+        dic["\\\\" + prefixo + str(200 + i) + "\\storage"] = "\\\\gtpi-sto-" + str(i).zfill(2) + "\\storage"
+    return dic
+
+
+def benchmark():
+    repeticoes = 20000
+    linha = "[1234] : 2018-10-01 10:00 : [acompanhar:123] Copiando para " \
+            "\\\\?\\UNC\\10.41.87.201\\storage\\Memorando_1234-18\\item01\\item01_extracao arquivo 10.41.87.20"
+
+    # Ips com prefixo comum, e ips sem nenhum prefixo em comum (redes diferentes)
+    casos = [("10.41.87.x", ("10.41.87.",)),
+             ("10.x/192.x/20.x", ("10.41.87.", "192.168.0.", "20.1.1.")),
+             ("10.x/172.x", ("10.41.87.", "172.16.5."))]
+    for (rotulo, prefixos) in casos:
+        print()
+        print("Ips:", rotulo)
+        print("storages   antigo(us/linha)   compilado(us/linha)")
+        for quantidade in [1, 2, 5, 10, 20, 50]:
+            dic = montar_dic_storage(quantidade, prefixos)
+            sapilib_2_0.Gdic_storage = dic
+            # Linha com ips de todos os prefixos
+            linha_caso = linha + " " + " ".join(p + "201" for p in prefixos) + " " + prefixos[-1] + str(200 + quantidade - 1)
+
+            # Confere se o resultado é o mesmo
+            if ajusta_texto_saida(linha_caso) != ajusta_texto_saida_antigo(linha_caso, dic):
+                print("Resultado divergente:")
+                print(ajusta_texto_saida(linha_caso))
+                print(ajusta_texto_saida_antigo(linha_caso, dic))
+
+            t_antigo = timeit.timeit(lambda: ajusta_texto_saida_antigo(linha_caso, dic), number=repeticoes)
+            t_novo = timeit.timeit(lambda: ajusta_texto_saida(linha_caso), number=repeticoes)
+            print("%8d   %16.2f   %19.2f" % (quantidade,
+                                             t_antigo / repeticoes * 1000000,
+                                             t_novo / repeticoes * 1000000))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,160 @@
+# Teste de carga do sapisrv utilizando o servidor simulado (sapisrv_simulado.py)
+# Executa diversos agentes simulados (um processo por agente), que utilizam o mesmo caminho HTTP
+# da sapilib que os agentes reais (pool de conexões, long-poll, atualização de status), e mede:
+#  - requisições/segundo atendidas pelo servidor
+#  - latência da atualização de status (consulta + atualização da tarefa)
+#  - tempo de captura (pickup): entre a criação da tarefa e sua obtenção por um agente
+#
+# Utilização:
+#   python teste_carga_sapisrv.py [agentes] [tarefas] [tarefas_por_segundo]
+import multiprocessing
+import sys
+import time
+
+import sapilib_2_0
+from sapilib_2_0 import *
+
+import sapisrv_simulado
+
+Gcarga_agentes = 8
+Gcarga_tarefas = 200
+# Ritmo de criação de tarefas (tarefas por segundo)
+Gcarga_tarefas_por_segundo = 50
+Gcarga_tipo = 'iped-ocr'
+Gcarga_unidade = 'SETEC/PR'
+# Atualizações de status informativo por tarefa
+Gcarga_status_por_tarefa = 5
+# Espera no long-poll, quando não há tarefa
+Gcarga_espera = 2
+
+
+# Percentil de uma lista de valores (em segundos), formatado em milissegundos
+def percentil_ms(valores, p):
+    if len(valores) == 0:
+        return "-"
+    valores = sorted(valores)
+    indice = min(len(valores) - 1, int(round(p / 100.0 * (len(valores) - 1))))
+    return "%.1f" % (valores[indice] * 1000)
+
+
+# Executa a chamada e registra o tempo de resposta na lista
+def medir(lista, funcao, *args, **kwargs):
+    inicio = time.time()
+    resultado = funcao(*args, **kwargs)
+    lista.append(time.time() - inicio)
+    return resultado
+
+
+# Agente simulado (processo filho)
+# Obtém tarefas até o sinal de fim, atualizando o status e finalizando cada tarefa
+def agente_simulado(numero, dados_pai_para_filho, fim, fila_resultado):
+    restaura_dados_no_processo_filho(dados_pai_para_filho)
+    set_parini('nome_agente', "agente_simulado_" + str(numero).zfill(2))
+    # Long-poll com intervalo mínimo reduzido, para que a captura reflita o servidor
+    sapilib_2_0.Gaguardar_tarefa_intervalo_minimo = 0
+
+    tempos = {'obter_iniciar': list(), 'status': list(), 'finalizar': list()}
+    tarefas = 0
+    while not fim.is_set():
+        (disponivel, tarefa) = medir(tempos['obter_iniciar'], sapisrv_obter_iniciar_tarefa,
+                                     Gcarga_tipo, unidade=Gcarga_unidade)
+        if not disponivel:
+            sapisrv_aguardar_tarefa([Gcarga_tipo], unidade=Gcarga_unidade, espera=Gcarga_espera)
+            continue
+
+        codigo_tarefa = tarefa['codigo_tarefa']
+        for i in range(Gcarga_status_por_tarefa):
+            medir(tempos['status'], sapisrv_atualizar_status_tarefa_informativo,
+                  codigo_tarefa, "Processando: " + str((i + 1) * 100 // Gcarga_status_por_tarefa) + "%")
+        medir(tempos['finalizar'], sapisrv_troca_situacao_tarefa_loop,
+              codigo_tarefa, GFinalizadoComSucesso, "Finalizado (teste de carga)")
+        tarefas += 1
+
+    fila_resultado.put((numero, tarefas, tempos))
+
+
+# Chama programa de administração do servidor simulado
+def chamar_simulado(programa, parametros):
+    return sapisrv_chamar_programa_sucesso_ok(programa, parametros)
+
+
+def teste_carga(agentes, quantidade_tarefas, tarefas_por_segundo):
+    # Servidor simulado em processo separado, para não disputar o interpretador com o cliente
+    servidor = multiprocessing.Process(target=sapisrv_simulado.iniciar_servidor_simulado)
+    servidor.daemon = True
+    servidor.start()
+    time.sleep(1)
+
+    sapisrv_inicializar("teste_carga_sapisrv", "1.0", nome_agente="teste_carga", ambiente='local')
+    chamar_simulado("simulado_reiniciar.php", {})
+
+    print("Agentes:", agentes, " Tarefas:", quantidade_tarefas, " Criação:", tarefas_por_segundo, "tarefas/s")
+    fim = multiprocessing.Event()
+    fila_resultado = multiprocessing.Queue()
+    dados_pai_para_filho = obter_dados_para_processo_filho()
+    processos = list()
+    for numero in range(agentes):
+        p = multiprocessing.Process(target=agente_simulado,
+                                    args=(numero, dados_pai_para_filho, fim, fila_resultado))
+        p.start()
+        processos.append(p)
+
+    # Cria as tarefas no ritmo indicado
+    inicio = time.time()
+    criadas = 0
+    while criadas < quantidade_tarefas:
+        lote = min(max(1, tarefas_por_segundo // 10), quantidade_tarefas - criadas)
+        chamar_simulado("simulado_criar_tarefas.php",
+                        {'tipo': Gcarga_tipo, 'unidade': Gcarga_unidade, 'quantidade': lote})
+        criadas += lote
+        espera = inicio + criadas / float(tarefas_por_segundo) - time.time()
+        if espera > 0:
+            time.sleep(espera)
+
+    # Aguarda a finalização de todas as tarefas
+    while True:
+        estatisticas = chamar_simulado("simulado_estatisticas.php", {})
+        if estatisticas['situacoes'].get(str(GFinalizadoComSucesso), 0) >= quantidade_tarefas:
+            break
+        time.sleep(0.2)
+    decorrido = time.time() - inicio
+    fim.set()
+
+    # Resultados dos agentes
+    tempos = {'obter_iniciar': list(), 'status': list(), 'finalizar': list()}
+    for i in range(agentes):
+        (numero, tarefas, tempos_agente) = fila_resultado.get()
+        for chave in tempos:
+            tempos[chave].extend(tempos_agente[chave])
+    for p in processos:
+        p.join()
+    servidor.terminate()
+
+    print()
+    print("Tempo total: %.1f s" % decorrido)
+    print("Requisições: %d (%.1f req/s)" % (estatisticas['total_requisicoes'],
+                                            estatisticas['total_requisicoes'] / decorrido))
+    for programa in sorted(estatisticas['requisicoes']):
+        print("  %-45s %8d" % (programa, estatisticas['requisicoes'][programa]))
+    print()
+    print("%-28s %8s %8s %8s %8s" % ("Latência (ms)", "qtd", "p50", "p95", "p99"))
+    linhas = [("obter_iniciar_tarefa", tempos['obter_iniciar']),
+              ("atualizar status", tempos['status']),
+              ("finalizar tarefa", tempos['finalizar']),
+              ("pickup (criação=>captura)", estatisticas['pickup'])]
+    for (rotulo, valores) in linhas:
+        print("%-28s %8d %8s %8s %8s" % (rotulo, len(valores),
+                                         percentil_ms(valores, 50), percentil_ms(valores, 95),
+                                         percentil_ms(valores, 99)))
+
+
+if __name__ == '__main__':
+    parametros = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if len(parametros) > 0:
+        Gcarga_agentes = int(parametros[0])
+    if len(parametros) > 1:
+        Gcarga_tarefas = int(parametros[1])
+    if len(parametros) > 2:
+        Gcarga_tarefas_por_segundo = int(parametros[2])
+    teste_carga(Gcarga_agentes, Gcarga_tarefas, Gcarga_tarefas_por_segundo)
+    log_descarregar()
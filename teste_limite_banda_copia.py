@@ -0,0 +1,60 @@
+# Verifica o limite de banda do copiar_pasta_paralelo
+# Copia uma pasta de teste com vários limites e quantidades de threads, e compara a taxa obtida
+# com o limite configurado (a taxa não deve ultrapassar o limite, nem ficar muito abaixo dele)
+import os
+import shutil
+import tempfile
+import time
+
+from sapilib_2_0 import *
+
+
+def montar_pasta_origem(pasta, quantidade, tamanho):
+    os.makedirs(pasta)
+    for i in range(quantidade):
+        with open(os.path.join(pasta, "arquivo_" + str(i).zfill(3) + ".bin"), 'wb') as f:
+            f.write(os.urandom(tamanho))
+
+
+def medir(pasta_origem, pasta_destino, limite_banda, maximo_threads):
+    if os.path.exists(pasta_destino):
+        shutil.rmtree(pasta_destino)
+    inicio = time.monotonic()
+    resumo = copiar_pasta_paralelo(pasta_origem, pasta_destino, maximo_threads=maximo_threads,
+                                   tamanho_bloco=64 * 1024, limite_banda=limite_banda)
+    tempo = time.monotonic() - inicio
+    return resumo['bytes_copiados'] / tempo
+
+
+def verificar():
+    pasta = tempfile.mkdtemp(prefix="teste_limite_banda_")
+    try:
+        pasta_origem = os.path.join(pasta, "origem")
+        pasta_destino = os.path.join(pasta, "destino")
+        # 40 arquivos de 256 KB = 10 MB
+        montar_pasta_origem(pasta_origem, 40, 256 * 1024)
+
+        falhas = 0
+        print("limite(MB/s)   threads   obtido(MB/s)   razao")
+        for limite in [2, 5, 10]:
+            for threads in [1, 4, 8]:
+                taxa = medir(pasta_origem, pasta_destino, limite * 1024 * 1024, threads)
+                razao = taxa / (limite * 1024 * 1024)
+                situacao = ""
+                if razao > 1.05 or razao < 0.8:
+                    situacao = "  <= FORA DO LIMITE"
+                    falhas += 1
+                print("%12d   %7d   %12.2f   %5.2f%s" % (limite, threads, taxa / (1024 * 1024), razao, situacao))
+
+        print()
+        if falhas == 0:
+            print("OK: Taxa de cópia respeitou o limite em todos os casos")
+        else:
+            print("ERRO:", falhas, "caso(s) fora do limite")
+        return falhas == 0
+    finally:
+        shutil.rmtree(pasta, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    verificar()